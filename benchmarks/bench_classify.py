@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Benchmark of the single-pass instance classifier against the twin start/stop filter sweeps
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+import os
+import sys
+import timeit
+from datetime import datetime
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../src')
+
+import ec2_state_mgmt # pylint: disable=C0413
+from fleet import make_fleet # pylint: disable=C0413
+
+ec2_state_mgmt.logger.disabled = True
+
+def twin_sweeps(instances, current_hour, hour_phase, is_weekend):
+    ''' The handler's former approach; two copies of the instance list, each with its own filter. '''
+    start_instances = list(filter(
+        lambda instance: ec2_state_mgmt.filter_start_instances(instance, current_hour, hour_phase, is_weekend), instances[:]
+    ))
+    stop_instances = list(filter(
+        lambda instance: ec2_state_mgmt.filter_stop_instances(instance, current_hour, hour_phase), instances[:]
+    ))
+
+    return start_instances, stop_instances
+
+def main():
+    ''' Runs the benchmark. '''
+    now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+    current_hour, current_minute = ec2_state_mgmt.get_invoke_time(now)
+    hour_phase = ec2_state_mgmt.get_hour_phase(current_minute)
+    is_weekend = ec2_state_mgmt.check_if_weekend(now)
+
+    for count in [10000, 100000]:
+        fleet = make_fleet(count)
+        args = (fleet, current_hour, hour_phase, is_weekend)
+
+        assert twin_sweeps(*args) == ec2_state_mgmt.classify_instances(*args)
+
+        twin = min(timeit.repeat(lambda: twin_sweeps(*args), number=1, repeat=5)) # pylint: disable=W0640
+        single = min(timeit.repeat(lambda: ec2_state_mgmt.classify_instances(*args), number=1, repeat=5)) # pylint: disable=W0640
+
+        print(f'{count:>7} instances: twin sweeps {twin * 1000:8.1f}ms, single pass {single * 1000:8.1f}ms, speedup {twin / single:.2f}x')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Benchmark of bulk ec2_schedule evaluation against classic ec2_start/ec2_stop classification
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+import os
+import sys
+import timeit
+from datetime import datetime
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../src')
+
+import ec2_state_mgmt # pylint: disable=C0413
+from fleet import make_fleet # pylint: disable=C0413
+
+ec2_state_mgmt.logger.disabled = True
+
+def main():
+    ''' Runs the benchmark. '''
+    now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+    current_hour, current_minute = ec2_state_mgmt.get_invoke_time(now)
+    hour_phase = ec2_state_mgmt.get_hour_phase(current_minute)
+    is_weekend = ec2_state_mgmt.check_if_weekend(now)
+
+    for count in [10000, 50000]:
+        for cron_ratio in [0.0, 1.0]:
+            fleet = make_fleet(count, cron_ratio=cron_ratio)
+            args = (fleet, current_hour, hour_phase, is_weekend, now.weekday())
+
+            elapsed = min(timeit.repeat(lambda: ec2_state_mgmt.classify_instances(*args), number=1, repeat=5)) # pylint: disable=W0640
+            start_instances, stop_instances = ec2_state_mgmt.classify_instances(*args)
+
+            print(f'{count:>7} instances, {cron_ratio:4.0%} ec2_schedule: classified in {elapsed * 1000:7.1f}ms '
+                + f'({len(start_instances)} to start, {len(stop_instances)} to stop)')
+
+if __name__ == '__main__':
+    main()
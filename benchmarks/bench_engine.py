@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Benchmark of the asyncio engine against the thread pool engine, on a local mocked EC2 endpoint with injected latency
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from xml.sax.saxutils import escape
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../src')
+
+import boto3 # pylint: disable=C0413
+from botocore.config import Config # pylint: disable=C0413
+import ec2_state_mgmt # pylint: disable=C0413
+from fleet import make_fleet # pylint: disable=C0413
+
+ec2_state_mgmt.logger.disabled = True
+ec2_state_mgmt.metrics.emf_logger.disabled = True
+
+NOW = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+
+# per-request latency of the mocked endpoint, roughly that of a real EC2 API call
+LATENCY = 0.03
+
+# the fleet is spread over this many regions, each served by its own endpoint
+SCOPE_COUNT = 4
+
+# share of the fleet due to start in the benchmarked tick (e.g. the morning start of a development fleet)
+DUE_RATIO = 0.2
+
+ACTION_RESPONSE = '''<?xml version="1.0" encoding="UTF-8"?>
+<{action}Response xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">
+<requestId>00000000-0000-0000-0000-000000000000</requestId><instancesSet/></{action}Response>'''
+
+def render_instance(instance):
+    ''' Renders a synthetic instance as a DescribeInstances response item. '''
+    tags = ''.join(f'<item><key>{escape(tag["Key"])}</key><value>{escape(tag["Value"])}</value></item>' for tag in instance.tags)
+    code = 16 if instance.state['Name'] == 'running' else 80
+
+    return (f'<item><instanceId>{instance.id}</instanceId><instanceType>t3.micro</instanceType>'
+        + f'<instanceState><code>{code}</code><name>{instance.state["Name"]}</name></instanceState><tagSet>{tags}</tagSet></item>')
+
+def render_pages(fleet):
+    ''' Pre-renders the DescribeInstances response pages of a fleet. '''
+    pages = []
+    for number in range(0, max(1, len(fleet)), ec2_state_mgmt.DESCRIBE_PAGE_SIZE):
+        items = ''.join(render_instance(instance) for instance in fleet[number:number + ec2_state_mgmt.DESCRIBE_PAGE_SIZE])
+        next_token = f'<nextToken>{len(pages) + 1}</nextToken>' if number + ec2_state_mgmt.DESCRIBE_PAGE_SIZE < len(fleet) else ''
+        pages.append('<?xml version="1.0" encoding="UTF-8"?><DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">'
+            + '<requestId>00000000-0000-0000-0000-000000000000</requestId>'
+            + f'<reservationSet><item><reservationId>r-0</reservationId><instancesSet>{items}</instancesSet></item></reservationSet>'
+            + f'{next_token}</DescribeInstancesResponse>')
+
+    return [page.encode('utf-8') for page in pages]
+
+def make_endpoint(pages):
+    ''' Starts a mocked EC2 endpoint serving the given DescribeInstances pages, and accepting every start and stop. '''
+    class MockedEndpoint(BaseHTTPRequestHandler):
+        ''' Mocked EC2 endpoint. '''
+        def do_POST(self): # pylint: disable=C0103
+            ''' Handles an EC2 query API request. '''
+            params = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+            action = params['Action'][0]
+            if action == 'DescribeInstances':
+                body = pages[int(params.get('NextToken', ['0'])[0])]
+            else:
+                body = ACTION_RESPONSE.format(action=action).encode('utf-8')
+
+            time.sleep(LATENCY)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/xml')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args): # pylint: disable=W0221
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockedEndpoint)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+def make_due_fleet(count):
+    ''' Generates a synthetic fleet, a share of which is stopped and due to start in the benchmarked tick. '''
+    rng = random.Random(1)
+    fleet = make_fleet(count)
+    due_count = 0
+    for instance in fleet:
+        if rng.random() < DUE_RATIO:
+            instance.state = {'Name': 'stopped'}
+            instance.tags = [tag for tag in instance.tags if not tag['Key'].startswith('ec2_')] + [{'Key': 'ec2_start', 'Value': '07:00'}]
+            due_count += 1
+
+    return fleet, due_count
+
+def build_resources(servers):
+    ''' Builds EC2 resources against the mocked endpoints, one scope per endpoint. '''
+    session = boto3.session.Session(aws_access_key_id='stub', aws_secret_access_key='stub')
+    config = Config(max_pool_connections=ec2_state_mgmt.DEFAULT_MAX_ACTION_BATCHES * 2, retries={'mode': 'standard'})
+
+    return {f'bench-{number}': session.resource('ec2', region_name='us-east-1', config=config,
+        endpoint_url=f'http://127.0.0.1:{server.server_address[1]}') for number, server in enumerate(servers)}
+
+def main():
+    ''' Runs the benchmark. '''
+    event = {'inventory_source': ec2_state_mgmt.INVENTORY_SOURCE_CLIENT}
+
+    for count in [1000, 10000, 50000]:
+        fleet, due_count = make_due_fleet(count)
+        scope_size = -(-count // SCOPE_COUNT)
+        servers = [make_endpoint(render_pages(fleet[number:number + scope_size])) for number in range(0, count, scope_size)]
+        resources = build_resources(servers)
+
+        start = time.perf_counter()
+        thread_result = ec2_state_mgmt.process_regions(resources, event, NOW, ec2_state_mgmt.DEFAULT_MAX_REGION_WORKERS)
+        thread_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        async_result = ec2_state_mgmt.run_async_engine(event, NOW, resources, [], [])
+        async_time = time.perf_counter() - start
+
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+        assert thread_result == async_result, (thread_result, async_result)
+        print(f'{count:>6} instances ({due_count} due): '
+            + f'threads {thread_time * 1000:8.1f}ms, asyncio {async_time * 1000:8.1f}ms')
+
+if __name__ == '__main__':
+    main()
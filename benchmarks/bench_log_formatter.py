@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Benchmark of the built-in JSON log formatter against the python-json-logger based formatter it replaced
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+import logging
+import os
+import sys
+import timeit
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../src')
+
+from pythonjsonlogger import jsonlogger # pylint: disable=C0413
+import log_formatter # pylint: disable=C0413
+
+class CustomJsonFormatter(jsonlogger.JsonFormatter):
+    ''' The handler's former formatter. '''
+    def add_fields(self, log_record, record, message_dict):
+        super().add_fields(log_record, record, message_dict)
+
+        if log_record.get('level'):
+            log_record['level'] = log_record['level'].upper()
+        else:
+            log_record['level'] = record.levelname
+
+def make_records():
+    ''' Builds a mix of the records the handler logs: plain messages, and ones carrying structured extra fields. '''
+    plain = logging.LogRecord('root', logging.INFO, __file__, 0, 'Starting instances %s', ('i-0123456789abcdef0',), None)
+    structured = logging.LogRecord('root', logging.INFO, __file__, 0, 'Decision summary for %s', ('us-east-2',), None)
+    structured.decisions = {'reasons': {'start_due': 12, 'not_due': 988}, 'actioned': {'start': [f'i-{i:017x}' for i in range(12)]}}
+
+    return [plain] * 9 + [structured]
+
+def main():
+    ''' Runs the benchmark. '''
+    records = make_records()
+    formatters = [
+        ('python-json-logger', CustomJsonFormatter(timestamp=True)),
+        (f'built-in ({"orjson" if log_formatter.orjson is not None else "json"})', log_formatter.JsonFormatter())
+    ]
+
+    for name, formatter in formatters:
+        duration = min(timeit.repeat(lambda: [formatter.format(record) for record in records], number=1000, repeat=5)) # pylint: disable=W0640
+        print(f'{name:>20}: {len(records) * 1000 / duration:10.0f} records/s')
+
+if __name__ == '__main__':
+    main()
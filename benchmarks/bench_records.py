@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Benchmark of compact InstanceRecord objects against boto3 ec2.Instance resources
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+import os
+import sys
+import timeit
+import tracemalloc
+from datetime import datetime
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../src')
+
+import boto3 # pylint: disable=C0413
+from botocore.stub import Stubber # pylint: disable=C0413
+import ec2_state_mgmt # pylint: disable=C0413
+from fleet import make_fleet # pylint: disable=C0413
+
+ec2_state_mgmt.logger.disabled = True
+
+def to_descriptions(fleet):
+    ''' Converts a synthetic fleet into DescribeInstances instance entries. '''
+    return [{
+        'InstanceId': instance.id,
+        'InstanceType': 't3.micro',
+        'State': {'Code': 16 if instance.state['Name'] == 'running' else 80, 'Name': instance.state['Name']},
+        'Tags': instance.tags
+    } for instance in fleet]
+
+def build_resources(resource, fleet):
+    ''' Builds ec2.Instance resources by paginating a stubbed DescribeInstances through the resource collection. '''
+    descriptions = to_descriptions(fleet)
+    stubber = Stubber(resource.meta.client)
+    pages = [descriptions[i:i + ec2_state_mgmt.DESCRIBE_PAGE_SIZE] for i in range(0, len(descriptions), ec2_state_mgmt.DESCRIBE_PAGE_SIZE)]
+    for number, page in enumerate(pages):
+        response = {'Reservations': [{'Instances': page}]}
+        if number < len(pages) - 1:
+            response['NextToken'] = str(number)
+        stubber.add_response('describe_instances', response)
+
+    with stubber:
+        return list(resource.instances.all())
+
+def build_records(fleet):
+    ''' Builds InstanceRecords from describe payloads, which are discarded afterwards. '''
+    return [ec2_state_mgmt.InstanceRecord.from_description(description) for description in to_descriptions(fleet)]
+
+def measure_memory(build):
+    ''' Measures the memory retained by the result of a build function. '''
+    tracemalloc.start()
+    instances = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return instances, size
+
+def main():
+    ''' Runs the benchmark. '''
+    now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+    current_hour, current_minute = ec2_state_mgmt.get_invoke_time(now)
+    time_info = (current_hour, ec2_state_mgmt.get_hour_phase(current_minute), ec2_state_mgmt.check_if_weekend(now))
+    resource = boto3.session.Session().resource('ec2', region_name='us-east-1', aws_access_key_id='stub', aws_secret_access_key='stub')
+
+    for count in [10000, 50000]:
+        fleet = make_fleet(count)
+
+        resources, resource_bytes = measure_memory(lambda: build_resources(resource, fleet)) # pylint: disable=W0640
+        records, record_bytes = measure_memory(lambda: build_records(fleet)) # pylint: disable=W0640
+
+        resource_time = min(timeit.repeat(lambda: ec2_state_mgmt.classify_instances(resources, *time_info), number=1, repeat=5)) # pylint: disable=W0640
+        record_time = min(timeit.repeat(lambda: ec2_state_mgmt.classify_instances(records, *time_info), number=1, repeat=5)) # pylint: disable=W0640
+
+        print(f'{count:>6} instances: memory/instance resources {resource_bytes / count:8.0f}B, records {record_bytes / count:6.0f}B; '
+            + f'classification resources {resource_time * 1000:7.1f}ms, records {record_time * 1000:6.1f}ms')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Benchmark suite for the handler's hot paths, producing JSON results comparable between commits
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+import unittest.mock
+from datetime import datetime
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../src')
+
+import boto3 # pylint: disable=C0413
+from botocore.stub import Stubber # pylint: disable=C0413
+import ec2_state_mgmt # pylint: disable=C0413
+from bench_records import to_descriptions # pylint: disable=C0413
+from fleet import make_fleet # pylint: disable=C0413
+
+ec2_state_mgmt.logger.disabled = True
+ec2_state_mgmt.metrics.emf_logger.disabled = True
+
+NOW = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+
+THRESHOLDS_PATH = os.path.dirname(os.path.realpath(__file__)) + '/thresholds.json'
+
+def parse_states(value):
+    ''' Parses a "running=3,stopped=1" state distribution. '''
+    return {state: float(weight) for state, _, weight in (part.partition('=') for part in value.split(','))}
+
+def time_best(func, repeat=5):
+    ''' Times the fastest of several runs of a function, in milliseconds. '''
+    return min(timeit.repeat(func, number=1, repeat=repeat)) * 1000
+
+def stub_handler_calls(resource, fleet, time_info):
+    ''' Queues the DescribeInstances pages, then the StartInstances/StopInstances batches, the handler is expected to call. '''
+    stubber = Stubber(resource.meta.client)
+    descriptions = to_descriptions(fleet)
+    page_size = ec2_state_mgmt.DESCRIBE_PAGE_SIZE
+    for number in range(0, max(1, len(descriptions)), page_size):
+        response = {'Reservations': [{'Instances': descriptions[number:number + page_size]}]}
+        if number + page_size < len(descriptions):
+            response['NextToken'] = str(number)
+        stubber.add_response('describe_instances', response)
+
+    start_instances, stop_instances = ec2_state_mgmt.classify_instances(fleet, *time_info)
+    for operation, instances in [('start_instances', start_instances), ('stop_instances', stop_instances)]:
+        for _ in ec2_state_mgmt.chunk_list(instances, ec2_state_mgmt.DEFAULT_ACTION_BATCH_SIZE):
+            stubber.add_response(operation, {})
+
+    return stubber
+
+def make_resource():
+    ''' Builds an EC2 resource to be stubbed; built ahead of each run, as warm invocations reuse their clients. '''
+    return boto3.session.Session().resource('ec2', region_name='us-east-1', aws_access_key_id='stub', aws_secret_access_key='stub')
+
+def run_handler(resource, fleet, time_info):
+    ''' Runs lambda_handler end to end against a stubbed EC2 API, returning its duration in milliseconds. '''
+    stubber = stub_handler_calls(resource, fleet, time_info)
+
+    with stubber, \
+        unittest.mock.patch.dict(os.environ, {'AWS_REGION': 'us-east-1'}), \
+        unittest.mock.patch.object(ec2_state_mgmt, 'datetime', wraps=datetime) as mock_datetime, \
+        unittest.mock.patch.object(ec2_state_mgmt, 'get_ec2_resource', return_value=resource):
+        mock_datetime.now.return_value = NOW
+
+        start = time.perf_counter()
+        ec2_state_mgmt.lambda_handler({}, None)
+        duration = (time.perf_counter() - start) * 1000
+
+        stubber.assert_no_pending_responses()
+
+    return duration
+
+def measure_handler_peak(fleet, time_info):
+    ''' Measures the peak memory allocated during an end-to-end handler run, in bytes. '''
+    resource = make_resource()
+    tracemalloc.start()
+    run_handler(resource, fleet, time_info)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return peak
+
+def benchmark(count, args):
+    ''' Benchmarks the hot paths over a single fleet size. '''
+    fleet = make_fleet(count, args.seed, args.cron_ratio, args.scheduled_ratio, args.malformed_ratio, args.states)
+    current_hour, current_minute = ec2_state_mgmt.get_invoke_time(NOW)
+    hour_phase = ec2_state_mgmt.get_hour_phase(current_minute)
+    is_weekend = ec2_state_mgmt.check_if_weekend(NOW)
+    time_info = (current_hour, hour_phase, is_weekend, NOW.weekday())
+
+    start_instances, stop_instances = ec2_state_mgmt.classify_instances(fleet, *time_info)
+
+    return {
+        'count': count,
+        'start_count': len(start_instances),
+        'stop_count': len(stop_instances),
+        'classify_ms': time_best(lambda: ec2_state_mgmt.classify_instances(fleet, *time_info)),
+        'filter_start_ms': time_best(lambda: [i for i in fleet if ec2_state_mgmt.filter_start_instances(i, current_hour, hour_phase, is_weekend)]),
+        'filter_stop_ms': time_best(lambda: [i for i in fleet if ec2_state_mgmt.filter_stop_instances(i, current_hour, hour_phase)]),
+        'tag_list_to_dict_ms': time_best(lambda: [ec2_state_mgmt.tag_list_to_dict(instance.tags) for instance in fleet]),
+        'handler_ms': min(run_handler(make_resource(), fleet, time_info) for _ in range(3)),
+        'handler_peak_bytes': measure_handler_peak(fleet, time_info)
+    }
+
+def get_commit():
+    ''' Identifies the commit being benchmarked, if run from a git checkout. '''
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def check_thresholds(results, thresholds):
+    ''' Compares per-instance results against the regression thresholds, returning a description of each one exceeded. '''
+    failures = []
+    for result in results:
+        for metric, limit in thresholds.items():
+            value = result[metric.replace('_per_instance', '')] / result['count']
+            if value > limit:
+                failures.append(f'{metric} at {result["count"]} instances: {value:.3f} exceeds {limit}')
+
+    return failures
+
+def main():
+    ''' Runs the benchmark suite. '''
+    parser = argparse.ArgumentParser(description='Benchmarks the handler hot paths over synthetic fleets.')
+    parser.add_argument('--counts', type=lambda value: [int(count) for count in value.split(',')], default=[1000, 10000, 50000])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scheduled-ratio', type=float, default=0.1)
+    parser.add_argument('--cron-ratio', type=float, default=0.2)
+    parser.add_argument('--malformed-ratio', type=float, default=0.05)
+    parser.add_argument('--states', type=parse_states, default={'running': 1, 'stopped': 1}, help='e.g. running=3,stopped=1,pending=0.1')
+    parser.add_argument('--output', help='file to write the JSON results to (default: stdout)')
+    parser.add_argument('--check', action='store_true', help='exit non-zero when a regression threshold is exceeded')
+    args = parser.parse_args()
+
+    results = [benchmark(count, args) for count in args.counts]
+    report = {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'fleet': {
+            'seed': args.seed,
+            'scheduled_ratio': args.scheduled_ratio,
+            'cron_ratio': args.cron_ratio,
+            'malformed_ratio': args.malformed_ratio,
+            'states': args.states
+        },
+        'results': results
+    }
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.check:
+        with open(THRESHOLDS_PATH, encoding='utf-8') as file:
+            failures = check_thresholds(results, json.load(file))
+        for failure in failures:
+            print(f'regression: {failure}', file=sys.stderr)
+        if failures:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Synthetic EC2 fleet generation for benchmarking
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+import random
+
+class SyntheticInstance:
+    ''' Minimal stand-in for an ec2.Instance resource. '''
+    def __init__(self, instance_id, state, tags):
+        self.id = instance_id
+        self.state = {'Name': state}
+        self.tags = tags
+
+# a handful of distinct ec2_schedule values, as teams tend to share schedules
+CRON_SCHEDULES = [
+    'start 30 7 mon-thu; start 0 7 fri; stop 0 18 mon-fri',
+    'start 0 6 mon-fri; stop 0 20 mon-fri',
+    'start 0 8 *; stop 0 22 *',
+    'start 45 5 1-5; stop 15 17 1-5; stop 0 12 sat'
+]
+
+# incorrectly formatted tag values, as left behind by typos and manual edits
+MALFORMED_TIMES = ['7:00', '07:0', 'A7:00', '25:00', '07-00']
+MALFORMED_SCHEDULES = ['start 0 7', 'begin 0 7 mon-fri', 'start 0 25 *', 'stop 0 18 someday']
+
+def make_fleet(count, seed=0, cron_ratio=0.0, scheduled_ratio=0.1, malformed_ratio=0.0, states=None): # pylint: disable=R0913
+    '''
+    Generates a reproducible fleet of synthetic instances with a realistic mix of schedule tags.
+    scheduled_ratio is the share of instances carrying schedule tags, and cron_ratio the share of those using an
+    ec2_schedule tag rather than ec2_start/ec2_stop.  malformed_ratio is the share of scheduled instances with an
+    incorrectly formatted value, and states maps instance states to their relative weights (default: even running/stopped).
+    '''
+    rng = random.Random(seed)
+    states = states or {'running': 1, 'stopped': 1}
+    fleet = []
+    for i in range(count):
+        tags = [{'Key': 'Name', 'Value': f'synthetic-{i}'}]
+
+        if rng.random() < scheduled_ratio:
+            malformed = malformed_ratio and rng.random() < malformed_ratio
+            if cron_ratio and rng.random() < cron_ratio:
+                tags.append({'Key': 'ec2_schedule', 'Value': rng.choice(MALFORMED_SCHEDULES if malformed else CRON_SCHEDULES)})
+            else:
+                for key in ['ec2_start', 'ec2_stop']:
+                    if malformed:
+                        tags.append({'Key': key, 'Value': rng.choice(MALFORMED_TIMES)})
+                    else:
+                        tags.append({'Key': key, 'Value': f'{rng.randrange(24):02}:{rng.choice(["00", "15", "30", "45"])}'})
+                if rng.random() < 0.2:
+                    tags.append({'Key': 'ec2_start_on_weekends', 'Value': 'true'})
+
+        fleet.append(SyntheticInstance(f'i-{i:017x}', rng.choices(list(states), weights=list(states.values()))[0], tags))
+
+    return fleet
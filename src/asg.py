@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Scheduling of Auto Scaling groups as a whole, through a single capacity update per group
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
+
+from classify import ACTION_START, ACTION_STOP, classify_zoned_instances
+import decisions
+from inventory import SCHEDULE_TAG_KEYS, InstanceRecord
+from runtime import build_resource, get_scope_role, get_setting
+import tracing
+
+logger = logging.getLogger()
+
+# the capacity of a group ("min,max,desired") at the time it was scaled down, kept on the group until it is scaled back up
+CAPACITY_TAG = 'ec2_asg_capacity'
+
+# groups are only listed when carrying one of these tags
+SCHEDULE_FILTER = [{'Name': 'tag-key', 'Values': ['ec2_start', 'ec2_stop', 'ec2_schedule']}]
+
+# upper bound on the number of groups updated concurrently, per scope
+DEFAULT_MAX_ASG_WORKERS = 8
+
+# Auto Scaling clients of the lambda's own account, per region; assumed role clients are kept with their role's resources
+clients = {}
+
+def get_asg_client(scope, event=None):
+    ''' Retrieves the (cached) Auto Scaling client of a scope, assuming the account's role (see get_scope_role) where needed. '''
+    region = scope.rpartition('/')[2]
+    entry = get_scope_role(scope, event)
+    cache = clients if entry is None else entry.setdefault('asg_clients', {})
+    if region not in cache:
+        cache[region] = build_resource('autoscaling', region, entry['credentials'] if entry is not None else None, kind='client')
+
+    return cache[region]
+
+def to_record(group):
+    '''
+    Projects an Auto Scaling group down to a record classifiable as an instance: it is "running" while it has any capacity,
+    and "stopped" once scaled down to none.
+    '''
+    capacity = group['MinSize'] or group['DesiredCapacity']
+    tag_dict = {tag['Key']: tag['Value'] for tag in group.get('Tags', []) if tag['Key'] in SCHEDULE_TAG_KEYS}
+
+    return InstanceRecord(group['AutoScalingGroupName'], 'running' if capacity else 'stopped', tag_dict)
+
+def get_groups(client):
+    ''' Lists the scheduled Auto Scaling groups, keyed by name. '''
+    groups = {}
+    for page in client.get_paginator('describe_auto_scaling_groups').paginate(Filters=SCHEDULE_FILTER):
+        for group in page['AutoScalingGroups']:
+            groups[group['AutoScalingGroupName']] = group
+
+    return groups
+
+def stop_group(client, group):
+    ''' Scales a group down to no instances, first recording its capacity on the group. '''
+    name = group['AutoScalingGroupName']
+    capacity = f'{group["MinSize"]},{group["MaxSize"]},{group["DesiredCapacity"]}'
+    logger.info(f'Scaling down Auto Scaling group {name} (capacity {capacity})')
+
+    client.create_or_update_tags(Tags=[{
+        'ResourceId': name, 'ResourceType': 'auto-scaling-group', 'Key': CAPACITY_TAG, 'Value': capacity, 'PropagateAtLaunch': False
+    }])
+    client.update_auto_scaling_group(AutoScalingGroupName=name, MinSize=0, DesiredCapacity=0)
+
+def get_capacity(group):
+    ''' Retrieves the capacity recorded on a group when it was scaled down, if any. '''
+    return next((tag['Value'] for tag in group.get('Tags', []) if tag['Key'] == CAPACITY_TAG), None)
+
+def start_group(client, group):
+    ''' Scales a group back up to the capacity recorded when it was scaled down. '''
+    name = group['AutoScalingGroupName']
+    capacity = get_capacity(group)
+    min_size, max_size, desired_capacity = (int(value) for value in capacity.split(','))
+    logger.info(f'Scaling up Auto Scaling group {name} (capacity {capacity})')
+
+    client.update_auto_scaling_group(AutoScalingGroupName=name, MinSize=min_size, MaxSize=max_size, DesiredCapacity=desired_capacity)
+    client.delete_tags(Tags=[{'ResourceId': name, 'ResourceType': 'auto-scaling-group', 'Key': CAPACITY_TAG}])
+
+def process_groups(client, now, max_workers):
+    '''
+    Classifies a scope's scheduled Auto Scaling groups by their tags (as instances are), then scales the groups due
+    down or up concurrently, one capacity update per group.
+    Returns the number of groups which could not be updated.
+    '''
+    groups = get_groups(client)
+    with tracing.subsegment('auto_scaling_groups', groups_seen=len(groups)):
+        start_records, stop_records = classify_zoned_instances([to_record(group) for group in groups.values()], now)
+
+    # groups without any capacity which were not scaled down by the lambda have no capacity to restore
+    unrestorable = {record.id for record in start_records if get_capacity(groups[record.id]) is None}
+    for name in sorted(unrestorable):
+        logger.warning(f'Auto Scaling group {name} has no "{CAPACITY_TAG}" tag to restore its capacity from, skipping')
+    start_records = [record for record in start_records if record.id not in unrestorable]
+
+    tasks = [(start_group, groups[record.id]) for record in start_records] + [(stop_group, groups[record.id]) for record in stop_records]
+    if not tasks:
+        logger.info('No Auto Scaling groups to scale up or down.')
+        return 0
+
+    decision_log = decisions.current()
+    if decision_log is not None:
+        decision_log.add_actioned(f'{ACTION_START}_group', [record.id for record in start_records])
+        decision_log.add_actioned(f'{ACTION_STOP}_group', [record.id for record in stop_records])
+
+    failure_count = 0
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tasks)))) as executor:
+        futures = {executor.submit(tracing.wrap(action), client, group): group['AutoScalingGroupName'] for action, group in tasks}
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as ex: # pylint: disable=W0703
+                logger.error(f'Failed to update Auto Scaling group {futures[future]}', exc_info=ex)
+                failure_count += 1
+
+    return failure_count
+
+def process_scope_groups(scope, event, now):
+    '''
+    Schedules the Auto Scaling groups of a scope.  Returns the number of groups which could not be updated;
+    failing to list the groups at all counts as a single failure, so it never holds up the scope's instances.
+    '''
+    max_workers = int(get_setting(event, 'max_asg_workers', 'STATE_MGMT_MAX_ASG_WORKERS', DEFAULT_MAX_ASG_WORKERS))
+
+    try:
+        return process_groups(get_asg_client(scope, event), now, max_workers)
+    except Exception as ex: # pylint: disable=W0703
+        logger.error(f'Failed to schedule the Auto Scaling groups of {scope}', exc_info=ex)
+        return 1
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# asyncio execution engine, running every scope and action batch of an invocation on one event loop
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import logging
+
+from continuation import DeadlineReached
+from inventory import chunk_list
+import metrics
+import runtime
+from runtime import collect_region, get_account_resources, send_batch
+import tracing
+
+logger = logging.getLogger()
+
+class AsyncEngine:
+    '''
+    Runs the processing of every scope (across regions and accounts alike), and every StartInstances/StopInstances
+    batch they send, concurrently on a single event loop.
+
+    boto3 calls are blocking, so they are run on two bounded thread pools: one for scope processing (inventory and
+    classification), and one for action batches, so that scopes waiting on their batches can never starve them.
+    Each scope is processed through process_scope(ec2_resource, event, now, scope), returning its instance failure count.
+    max_scopes caps the scopes in flight, and max_batches the action batches in flight across every scope.
+    '''
+    def __init__(self, process_scope, max_scopes, max_batches):
+        self.process_scope = process_scope
+        self.max_scopes = max(1, max_scopes)
+        self.max_batches = max(1, max_batches)
+        self.loop = None
+        self.scope_executor = None
+        self.batch_executor = None
+        self.batch_semaphore = None
+
+    def run(self, event, now, resources=None, role_arns=None, regions=None):
+        '''
+        Processes the given {scope: ec2_resource} resources, or every region of the accounts behind the given role ARNs.
+        Returns the combined instance failure count and the list of accounts and scopes which could not be processed.
+        '''
+        return asyncio.run(self._run(event, now, resources, role_arns or [], regions or []))
+
+    async def _run(self, event, now, resources, role_arns, regions):
+        self.loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=self.max_scopes) as scope_executor, \
+            ThreadPoolExecutor(max_workers=self.max_batches) as batch_executor:
+            self.scope_executor = scope_executor
+            self.batch_executor = batch_executor
+            self.batch_semaphore = asyncio.Semaphore(self.max_batches)
+
+            failed_targets = []
+            if resources is None:
+                resources, failed_targets = await self._get_account_resources(role_arns, regions)
+
+            scope_semaphore = asyncio.Semaphore(self.max_scopes)
+            outcomes = await asyncio.gather(*(
+                self._process_scope(scope_semaphore, scope, resource, event, now) for scope, resource in resources.items()
+            ))
+
+        failure_count = sum(scope_failures for scope_failures, _ in outcomes)
+        failed_targets.extend(scope for scope, (_, failed) in zip(resources, outcomes) if failed)
+
+        return failure_count, failed_targets
+
+    async def _get_account_resources(self, role_arns, regions):
+        ''' Assumes every account's role concurrently, flattening their regions into a single set of scopes. '''
+        lookups = await asyncio.gather(*(
+            self.loop.run_in_executor(self.scope_executor, get_account_resources, role_arn, regions) for role_arn in role_arns
+        ), return_exceptions=True)
+
+        resources = {}
+        failed_targets = []
+        for role_arn, lookup in zip(role_arns, lookups):
+            if isinstance(lookup, Exception):
+                logger.error(f'Failed to process account via role {role_arn}', exc_info=lookup)
+                failed_targets.append(role_arn.split(':')[4])
+            else:
+                resources.update(lookup)
+
+        return resources, failed_targets
+
+    async def _process_scope(self, semaphore, scope, resource, event, now):
+        async with semaphore:
+            future = self.loop.run_in_executor(self.scope_executor, tracing.wrap(self.process_scope), resource, event, now, scope)
+            await asyncio.wait([future])
+
+        return collect_region(scope, future)
+
+    async def _send_batch(self, send, action, batch):
+        ''' Sends a single action batch, returning its failure count, or None if the deadline was reached first. '''
+        async with self.batch_semaphore:
+            if runtime.continuation.deadline_reached():
+                return None
+
+            return await self.loop.run_in_executor(self.batch_executor, send, action, batch)
+
+    async def _control_action(self, send, action, batches, recorder):
+        ''' Sends every batch of a single action concurrently, timing the action as a whole. '''
+        with recorder.stage(f'{action.title()}Time'):
+            return await asyncio.gather(*(self._send_batch(send, action, batch) for batch in batches))
+
+    async def control_actions(self, send, actions, batch_size, recorder=metrics.NULL_METRICS):
+        '''
+        Sends every batch of a dict of {action: instance_ids} concurrently, through send(action, batch).
+        Returns the number of instances which could not be actioned; batches not sent by the deadline are raised as DeadlineReached.
+        '''
+        batches = {action: chunk_list(instance_ids, batch_size) for action, instance_ids in actions.items() if instance_ids}
+        results = await asyncio.gather(*(self._control_action(send, action, batches[action], recorder) for action in batches))
+
+        failure_count = 0
+        pending = {}
+        for action, action_results in zip(batches, results):
+            for batch, result in zip(batches[action], action_results):
+                if result is None:
+                    pending.setdefault(action, []).extend(batch)
+                else:
+                    failure_count += result
+        if pending:
+            raise DeadlineReached(pending, failure_count)
+
+        return failure_count
+
+    def run_actions(self, ec2_client, actions, batch_size):
+        '''
+        Hands a scope's actions over to the event loop from its processing thread, waiting on their outcome.
+        Batches are traced and measured under the scope, though sent from the batch thread pool.
+        '''
+        coroutine = self.control_actions(partial(tracing.wrap(send_batch), ec2_client), actions, batch_size, metrics.current())
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
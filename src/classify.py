@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Classification of instances into those to start and to stop, according to their schedule tags
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+from datetime import datetime, timedelta
+from enum import Enum
+from functools import lru_cache
+import logging
+import re
+
+from cron_schedule import (
+    SLOTS_PER_WEEK, compile_cron_schedule, compile_slot_schedule, get_cron_due, get_latest_transitions, get_week_slot
+)
+from decisions import decide
+from inventory import get_instance_tags
+from schedule import ASG_MEMBER_TAG, SLOTS_PER_HOUR, TIME_PATTERN, get_schedule, parse_schedule_slot
+
+try:
+    from zoneinfo import ZoneInfo as get_timezone
+except ImportError: # python < 3.9
+    from pytz import timezone as get_timezone
+
+logger = logging.getLogger()
+
+class StateManagementPhase(Enum):
+    ''' Helper enum '''
+    PHASE_ONE = 1   # :00 - :14
+    PHASE_TWO = 2   # :15 - :29
+    PHASE_THREE = 3 # :30 - :44
+    PHASE_FOUR = 4  # :45 - :59
+
+ACTION_START = 'start'
+ACTION_STOP = 'stop'
+ACTION_HIBERNATE = 'hibernate'
+
+# supports {'ec2_timezone' => 'Europe/Paris'}
+# notes:
+# - the instance's schedule tags are evaluated in the given IANA timezone, rather than the configured STATE_MGMT_TIMEZONE
+TIMEZONE_TAG = 'ec2_timezone'
+
+# cap on the distinct timezones kept resolved across warm invocations
+TIMEZONE_CACHE_SIZE = 64
+
+def get_invoke_time(now):
+    ''' Get the invocation time. '''
+    return now.strftime('%H:%M').split(':')
+
+def check_if_weekend(now):
+    ''' Check to see if the specified date is a weekend. '''
+    return now.weekday() in [5, 6] # 5-6 are Saturday, Sunday ordinally
+
+@lru_cache(maxsize=TIMEZONE_CACHE_SIZE)
+def get_zone(name):
+    ''' Resolves an IANA timezone name, caching it across warm invocations.  Returns None for unknown timezones. '''
+    try:
+        return get_timezone(name)
+    except (KeyError, ValueError): # zoneinfo and pytz both raise KeyError subclasses for unknown names
+        return None
+
+def get_hour_phase(current_minute):
+    ''' Identifies which segment of the hour the current invocation falls into. '''
+    if 0 <= int(current_minute) < 15:
+        return StateManagementPhase.PHASE_ONE
+
+    if 15 <= int(current_minute) < 30:
+        return StateManagementPhase.PHASE_TWO
+
+    if 30 <= int(current_minute) < 45:
+        return StateManagementPhase.PHASE_THREE
+
+    return StateManagementPhase.PHASE_FOUR
+
+def check_tag_time_format(instance, time_type, time_value):
+    ''' Check to see if the time specified for an ec2_start or ec2_stop value is correctly formatted. '''
+    if not re.match(TIME_PATTERN, time_value):
+        logger.warning('Instance %s tag value for "%s" tag is incorrectly formatted, ignoring', instance.id, time_type)
+        return False
+
+    return True
+
+def check_configured_time(instance, time_type, minute_value):
+    ''' Massages user-specified minute value for ec2_start and ec2_stop to a sane value. '''
+    if 0 < int(minute_value) < 15:
+        logger.warning(f'Invalid minute specifier for instance {instance.id} {time_type} time (specified :{minute_value}, assuming :00)')
+        minute_value = '00'
+    elif 15 < int(minute_value) < 30:
+        logger.warning(f'Invalid minute specifier for instance {instance.id} {time_type} time (specified :{minute_value}, assuming :15)')
+        minute_value = '15'
+    elif 30 < int(minute_value) < 45:
+        logger.warning(f'Invalid minute specifier for instance {instance.id} {time_type} time (specified :{minute_value}, assuming :30)')
+        minute_value = '30'
+    elif 45 < int(minute_value) < 60:
+        logger.warning(f'Invalid minute specifier for instance {instance.id} {time_type} time (specified :{minute_value}, assuming :45)')
+        minute_value = '45'
+
+    return minute_value
+
+def get_slot(current_hour, hour_phase):
+    ''' Identifies the quarter-hour slot of the day for the given hour and hour_phase. '''
+    return int(current_hour) * SLOTS_PER_HOUR + (hour_phase.value - 1)
+
+def check_schedule_time(instance, time_type, time_value, current_slot):
+    ''' Checks whether an ec2_start or ec2_stop value falls within the current quarter-hour slot. '''
+    tag_slot = parse_schedule_slot(time_value)
+    if tag_slot is None:
+        logger.warning('Instance %s tag value for "%s" tag is incorrectly formatted, ignoring', instance.id, time_type)
+        return False
+
+    return tag_slot == current_slot
+
+def _classify_schedule_time(instance, time_type, time_value, current_slot, action):
+    tag_slot = parse_schedule_slot(time_value)
+    if tag_slot is None:
+        logger.warning('Instance %s tag value for "%s" tag is incorrectly formatted, ignoring', instance.id, time_type)
+        return decide(instance.id, 'malformed_schedule')
+
+    if tag_slot != current_slot:
+        return decide(instance.id, 'not_due')
+
+    return decide(instance.id, f'{action}_due', action)
+
+def _classify_cron_instance(instance, state, value, week_slot, cron_due):
+    if week_slot is None:
+        return decide(instance.id, 'cron_no_weekday')
+
+    # each distinct schedule is only evaluated once per classification pass
+    if value not in cron_due:
+        cron_due[value] = get_cron_due(value, week_slot)
+
+    start_due, stop_due = cron_due[value]
+    if state == 'stopped' and start_due:
+        return decide(instance.id, 'cron_start_due', ACTION_START)
+    if state == 'running' and stop_due:
+        return decide(instance.id, 'cron_stop_due', ACTION_STOP)
+
+    return decide(instance.id, 'cron_not_due')
+
+def _classify_instance(instance, current_slot, is_weekend, week_slot=None, cron_due=None): # pylint: disable=R0911
+    state = instance.state.get('Name')
+    if state not in ['stopped', 'running']:
+        return decide(instance.id, 'not_stopped_or_running')
+
+    tags = get_instance_tags(instance)
+    if ASG_MEMBER_TAG in tags:
+        return decide(instance.id, 'asg_member')
+
+    # supports {'ec2_schedule' => 'start 30 7 mon-thu; start 0 7 fri; stop 0 18 mon-fri'}
+    # notes:
+    # - takes precedence over the ec2_start, ec2_stop and ec2_start_on_weekends tags
+    if 'ec2_schedule' in tags:
+        return _classify_cron_instance(instance, state, tags['ec2_schedule'], week_slot, {} if cron_due is None else cron_due)
+
+    if state == 'stopped':
+        # supports {'ec2_start_on_weekends' => 'true'}
+        # notes:
+        # - forces start events to process during weekends if the ec2_start_on_weekends tag is set to "true"
+        if is_weekend and tags.get('ec2_start_on_weekends', '').lower() != 'true':
+            return decide(instance.id, 'weekend')
+
+        # supports {'ec2_start' => 'XX:00'}, {'ec2_start' => 'XX:15'}, {'ec2_start' => 'XX:30'} and {'ec2_start' => 'XX:45'}
+        # notes:
+        # - additional specificity in the ec2 tag is ignored! don't try to be cheeky and say XX:48.  it will not be supported.
+        if 'ec2_start' in tags:
+            return _classify_schedule_time(instance, 'ec2_start', tags['ec2_start'], current_slot, ACTION_START)
+
+        # catchall; do not send any start events
+        return decide(instance.id, 'unscheduled')
+
+    # supports {'ec2_stop' => 'XX:00'}, {'ec2_stop' => 'XX:15'}, {'ec2_stop' => 'XX:30'} and {'ec2_stop' => 'XX:45'}
+    # notes:
+    # - additional specificity in the ec2 tag is ignored! don't try to be cheeky and say XX:48.  it will not be supported.
+    if 'ec2_stop' in tags:
+        return _classify_schedule_time(instance, 'ec2_stop', tags['ec2_stop'], current_slot, ACTION_STOP)
+
+    # catchall; do not send any stop events
+    return decide(instance.id, 'unscheduled')
+
+def classify_instance(instance, current_hour, hour_phase, is_weekend, weekday=None):
+    '''
+    Identifies which action (if any) an instance qualifies for, reading its state and tags only once.
+    ec2_schedule tags are only evaluated when the weekday (0 is Monday) is provided.
+    Returns ACTION_START, ACTION_STOP or None.
+    '''
+    current_slot = get_slot(current_hour, hour_phase)
+    week_slot = get_week_slot(weekday, current_slot) if weekday is not None else None
+
+    return _classify_instance(instance, current_slot, is_weekend, week_slot)
+
+def classify_instances(instances, current_hour, hour_phase, is_weekend, weekday=None):
+    '''
+    Sorts instances into start and stop buckets in a single pass; instances qualifying for neither are dropped.
+    ec2_schedule tags are only evaluated when the weekday (0 is Monday) is provided.
+    Returns the lists of instances to start and to stop.
+    '''
+    current_slot = get_slot(current_hour, hour_phase)
+    week_slot = get_week_slot(weekday, current_slot) if weekday is not None else None
+    cron_due = {}
+
+    buckets = {ACTION_START: [], ACTION_STOP: [], None: []}
+    for instance in instances:
+        buckets[_classify_instance(instance, current_slot, is_weekend, week_slot, cron_due)].append(instance)
+
+    return buckets[ACTION_START], buckets[ACTION_STOP]
+
+def get_time_info(now):
+    ''' Breaks a time down into the (current_hour, hour_phase, is_weekend, weekday) arguments of classify_instances. '''
+    current_hour, current_minute = get_invoke_time(now)
+
+    return current_hour, get_hour_phase(current_minute), check_if_weekend(now), now.weekday()
+
+def classify_by_timezone(instances, now, classify):
+    '''
+    Groups instances by their ec2_timezone tag, then classifies each group with classify(instances, now), now being
+    converted to the group's timezone (untagged instances keep the given now).  Time is only broken down once per distinct timezone.
+    Instances tagged with an unknown timezone are dropped.  Returns the lists of instances to start and to stop.
+    '''
+    groups = {}
+    for instance in instances:
+        groups.setdefault(get_instance_tags(instance).get(TIMEZONE_TAG), []).append(instance)
+
+    start_instances, stop_instances = [], []
+    for name, group in groups.items():
+        zone = get_zone(name) if name is not None else now.tzinfo
+        if zone is None:
+            logger.warning('Unknown timezone "%s" in the "%s" tag of %d instances, ignoring', name, TIMEZONE_TAG, len(group))
+            for instance in group:
+                decide(instance.id, 'unknown_timezone')
+            continue
+
+        group_start, group_stop = classify(group, now.astimezone(zone) if name is not None else now)
+        start_instances += group_start
+        stop_instances += group_stop
+
+    return start_instances, stop_instances
+
+def classify_zoned_instances(instances, now):
+    ''' Sorts instances into start and stop buckets as classify_instances does, each in its own timezone (see classify_by_timezone). '''
+    return classify_by_timezone(instances, now, lambda group, zoned_now: classify_instances(group, *get_time_info(zoned_now)))
+
+def get_catch_up_window(watermark, now):
+    '''
+    Identifies the (first week slot, slot count) window of quarter-hour slots elapsed after the watermark's, up to and including now's.
+    Without a watermark, the window is just the current slot; it never spans more than a week.
+    '''
+    current_hour, current_minute = get_invoke_time(now)
+    current_slot = get_week_slot(now.weekday(), get_slot(current_hour, get_hour_phase(current_minute)))
+    if watermark is None:
+        return current_slot, 1
+
+    last_run = datetime.fromtimestamp(watermark, now.tzinfo)
+    if now - last_run >= timedelta(days=7):
+        return (current_slot + 1) % SLOTS_PER_WEEK, SLOTS_PER_WEEK
+
+    last_hour, last_minute = get_invoke_time(last_run)
+    last_slot = get_week_slot(last_run.weekday(), get_slot(last_hour, get_hour_phase(last_minute)))
+
+    return (last_slot + 1) % SLOTS_PER_WEEK, (current_slot - last_slot) % SLOTS_PER_WEEK
+
+def classify_catch_up(instances, first_slot, slot_count):
+    '''
+    Sorts instances into start and stop buckets by their desired state; the one set by the latest transition of their
+    schedule within the window.  Instances already in their desired state, or without a transition in the window, are dropped.
+    Each distinct schedule is only evaluated once per pass.
+    '''
+    transitions = {}
+    buckets = {ACTION_START: [], ACTION_STOP: [], None: []}
+    for instance in instances:
+        state = instance.state.get('Name')
+        tags = get_instance_tags(instance) if state in ['stopped', 'running'] else {}
+        key = tags['ec2_schedule'] if 'ec2_schedule' in tags and ASG_MEMBER_TAG not in tags else get_schedule(tags)
+        if key is None:
+            buckets[decide(instance.id, 'unscheduled' if state in ['stopped', 'running'] else 'not_stopped_or_running')].append(instance)
+            continue
+
+        if key not in transitions:
+            schedule = compile_cron_schedule(key) if isinstance(key, str) else compile_slot_schedule(key)
+            transitions[key] = get_latest_transitions(schedule, first_slot, slot_count) if schedule else (-1, -1)
+
+        last_start, last_stop = transitions[key]
+        if state == 'stopped' and last_start >= 0 and last_start >= last_stop:
+            buckets[decide(instance.id, 'catch_up_start', ACTION_START)].append(instance)
+        elif state == 'running' and last_stop >= 0 and last_stop >= last_start:
+            buckets[decide(instance.id, 'catch_up_stop', ACTION_STOP)].append(instance)
+        else:
+            buckets[decide(instance.id, 'in_desired_state')].append(instance)
+
+    return buckets[ACTION_START], buckets[ACTION_STOP]
+
+def classify_zoned_catch_up(instances, watermark, now, retries=None):
+    '''
+    Sorts instances into start and stop buckets as classify_catch_up does, over each timezone's window (see classify_by_timezone).
+    Instances listed in retries ({instance_id: watermark}) are caught up from their own watermark instead.
+    '''
+    windows = {}
+    for instance in instances:
+        windows.setdefault((retries or {}).get(instance.id, watermark), []).append(instance)
+
+    start_instances, stop_instances = [], []
+    for window_watermark, group in windows.items():
+        window_start, window_stop = classify_by_timezone(group, now,
+            lambda zoned, zoned_now, since=window_watermark: classify_catch_up(zoned, *get_catch_up_window(since, zoned_now)))
+        start_instances.extend(window_start)
+        stop_instances.extend(window_stop)
+
+    return start_instances, stop_instances
+
+def _filter_start_instances(instance, current_hour, hour_phase, is_weekend):
+    state = instance.state.get('Name')
+    if state != 'stopped':
+        logger.debug('Instance %s is not stopped (status: %s), ignoring', instance.id, state)
+        return False
+
+    return classify_instance(instance, current_hour, hour_phase, is_weekend) == ACTION_START
+
+def _filter_stop_instances(instance, current_hour, hour_phase):
+    '''
+    Function to filter out which instances should be stopped, given the current hour and hour_phase (quarter hour)
+    '''
+    state = instance.state.get('Name')
+    if state != 'running':
+        logger.debug('Instance %s is not running (status: %s), ignoring', instance.id, state)
+        return False
+
+    # weekends only ever restrict start events
+    return classify_instance(instance, current_hour, hour_phase, False) == ACTION_STOP
+
+def filter_start_instances(instance, current_hour, hour_phase, is_weekend):
+    ''' Tiny wrapper around the filter_start_instances function to shim in some extra logging. '''
+    result = _filter_start_instances(instance, current_hour, hour_phase, is_weekend)
+
+    if result:
+        logger.debug('Instance %s identified as qualifying for sending start event', instance.id)
+    else:
+        logger.debug('Instance %s does not qualify for start event, ignoring', instance.id)
+
+    return result
+
+def filter_stop_instances(instance, current_hour, hour_phase):
+    ''' Tiny wrapper around the filter_stop_instances function to shim in some extra logging. '''
+    result = _filter_stop_instances(instance, current_hour, hour_phase)
+
+    if result:
+        logger.debug('Instance %s identified as qualifying for sending stop event', instance.id)
+    else:
+        logger.debug('Instance %s does not qualify for stop event, ignoring', instance.id)
+
+    return result
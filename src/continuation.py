@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Deadline tracking for invocations, and the work deferred past their deadline
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+import threading
+
+class DeadlineReached(Exception):
+    '''
+    Raised once an invocation's deadline is reached, to stop taking on new work.
+    pending holds the {action: instance_ids} actions not yet sent, or None if the whole scope is still to be processed.
+    '''
+    def __init__(self, pending=None, failure_count=0):
+        super().__init__('invocation deadline reached')
+        self.pending = pending
+        self.failure_count = failure_count
+
+class Continuation:
+    '''
+    Tracks an invocation's deadline, and the per-scope work deferred past it.
+
+    The deadline falls margin_ms ahead of the Lambda timeout, as reported by the invocation context;
+    without a context, it is never reached.
+    '''
+    def __init__(self, context=None, margin_ms=0):
+        self.context = context
+        self.margin_ms = margin_ms
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def deadline_reached(self):
+        ''' Checks whether the invocation is too close to its timeout to take on more work. '''
+        return self.context is not None and self.context.get_remaining_time_in_millis() <= self.margin_ms
+
+    def check_deadline(self, pending=None, failure_count=0):
+        ''' Raises DeadlineReached, carrying the given pending work, once the deadline is reached. '''
+        if self.deadline_reached():
+            raise DeadlineReached(pending, failure_count)
+
+    def defer(self, scope, pending):
+        ''' Records the work (as carried by DeadlineReached) a scope deferred past the deadline. '''
+        with self.lock:
+            self.pending[scope] = pending
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Compilation of cron-style ec2_schedule tags into bitsets over the week's quarter-hour slots
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+from collections import namedtuple
+from functools import lru_cache
+import logging
+
+from schedule import SCHEDULE_CACHE_SIZE, SLOTS_PER_DAY, SLOTS_PER_HOUR
+
+logger = logging.getLogger()
+
+# week slots run from Monday 00:00 (slot 0) through Sunday 23:45 (slot 671)
+DAYS_PER_WEEK = 7
+SLOTS_PER_WEEK = DAYS_PER_WEEK * SLOTS_PER_DAY
+
+# day of week names, in python's weekday() order
+DAY_NAMES = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+CRON_ACTIONS = ['start', 'stop']
+
+# bit masks of the week slots in which an instance should be started and stopped
+CronSchedule = namedtuple('CronSchedule', ['start_mask', 'stop_mask'])
+
+def _parse_value(value, names):
+    value = value.lower()
+    if value in names:
+        return names.index(value)
+
+    if not value.isdigit():
+        raise ValueError(f'invalid value "{value}"')
+
+    return int(value)
+
+def _parse_field(field, low, high, names=None):
+    '''
+    Parses a cron field ("*", "7", "1-5", "mon-fri", "0,30", "*/15", "8-18/2") into the sorted list of values it covers.
+    Ranges may wrap around (e.g. "fri-mon").
+    '''
+    names = names or []
+    values = set()
+    for part in field.split(','):
+        part, _, step = part.partition('/')
+        step = int(step) if step else 1
+        if step < 1:
+            raise ValueError(f'invalid step in "{field}"')
+
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (_parse_value(value, names) for value in part.split('-', 1))
+        else:
+            start = end = _parse_value(part, names)
+
+        if not (low <= start <= high and low <= end <= high):
+            raise ValueError(f'value out of range in "{field}"')
+
+        span = (end - start) % (high - low + 1)
+        values.update(low + (start - low + offset) % (high - low + 1) for offset in range(0, span + 1, step))
+
+    return sorted(values)
+
+def _parse_days(field):
+    # cron numbering (0 and 7 are Sunday) is accepted alongside day names
+    if any(part.strip('*/').isdigit() for part in field.replace('-', ',').split(',')):
+        return sorted({(day + 6) % DAYS_PER_WEEK for day in _parse_field(field.replace('7', '0'), 0, 6)})
+
+    return _parse_field(field, 0, 6, DAY_NAMES)
+
+@lru_cache(maxsize=SCHEDULE_CACHE_SIZE)
+def compile_cron_schedule(value):
+    '''
+    Compiles an ec2_schedule tag value into a CronSchedule, or None if it is incorrectly formatted.
+
+    The value is a ";"-separated list of "<start|stop> <minute> <hour> <day of week>" rules, using cron field syntax;
+    e.g. "start 30 7 mon-thu; start 0 7 fri; stop 0 18 mon-fri".  Minutes are rounded down to their quarter hour.
+    Results are cached, so each distinct tag value is only ever compiled once per container.
+    '''
+    masks = {action: 0 for action in CRON_ACTIONS}
+    try:
+        for rule in filter(None, (rule.strip() for rule in value.split(';'))):
+            fields = rule.split()
+            if len(fields) != 4 or fields[0].lower() not in CRON_ACTIONS:
+                raise ValueError(f'expected "<start|stop> <minute> <hour> <day of week>", got "{rule}"')
+
+            quarters = {minute // 15 for minute in _parse_field(fields[1], 0, 59)}
+            hours = _parse_field(fields[2], 0, 23)
+            for day in _parse_days(fields[3]):
+                for hour in hours:
+                    for quarter in quarters:
+                        masks[fields[0].lower()] |= 1 << (day * SLOTS_PER_DAY + hour * SLOTS_PER_HOUR + quarter)
+    except ValueError as ex:
+        logger.warning(f'Schedule "{value}" is incorrectly formatted ({ex}), ignoring')
+        return None
+
+    if not masks['start'] and not masks['stop']:
+        logger.warning(f'Schedule "{value}" contains no rules, ignoring')
+        return None
+
+    return CronSchedule(masks['start'], masks['stop'])
+
+def get_week_slot(weekday, slot):
+    ''' Identifies the quarter-hour slot of the week for a weekday (0 is Monday) and quarter-hour slot of the day. '''
+    return weekday * SLOTS_PER_DAY + slot
+
+def get_cron_due(value, week_slot):
+    ''' Returns whether an ec2_schedule tag value is due to start, and due to stop, in the given week slot. '''
+    schedule = compile_cron_schedule(value)
+    if schedule is None:
+        return False, False
+
+    bit = 1 << week_slot
+
+    return bool(schedule.start_mask & bit), bool(schedule.stop_mask & bit)
+
+def compile_slot_schedule(schedule):
+    '''
+    Expresses an ec2_start/ec2_stop (start_slot, stop_slot, start_on_weekends) schedule as a CronSchedule.
+    Starts fall on weekdays (and weekends, if enabled), stops on every day.
+    '''
+    start_slot, stop_slot, start_on_weekends = schedule
+    start_mask = stop_mask = 0
+    for day in range(DAYS_PER_WEEK):
+        if start_slot is not None and (day < 5 or start_on_weekends):
+            start_mask |= 1 << get_week_slot(day, start_slot)
+        if stop_slot is not None:
+            stop_mask |= 1 << get_week_slot(day, stop_slot)
+
+    return CronSchedule(start_mask, stop_mask)
+
+def get_latest_transitions(schedule, first_slot, slot_count):
+    '''
+    Finds the latest start and stop transitions of a CronSchedule within a window of week slots (which may wrap around the week).
+    Returns their offsets into the window, or -1 where the window holds none.
+    '''
+    window_mask = (1 << slot_count) - 1
+
+    def latest(mask):
+        rotated = (mask >> first_slot) | (mask << (SLOTS_PER_WEEK - first_slot))
+        return (rotated & window_mask).bit_length() - 1
+
+    return latest(schedule.start_mask), latest(schedule.stop_mask)
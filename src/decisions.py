@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Classification decision logging: one summary record per scope and tick, or lazily formatted per-instance debug lines
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+from collections import Counter
+from contextlib import contextmanager
+import logging
+import random
+import threading
+
+logger = logging.getLogger()
+
+# decision log modes:
+# - summary: a single record per scope and tick, counting decisions by reason and listing the instances actioned
+# - detailed: a debug line per instance and decision (only formatted when debug logging is enabled)
+DECISION_LOG_SUMMARY = 'summary'
+DECISION_LOG_DETAILED = 'detailed'
+DECISION_LOG_MODES = [DECISION_LOG_SUMMARY, DECISION_LOG_DETAILED]
+
+# cap on the per-instance decisions sampled into a summary
+DEFAULT_MAX_SAMPLES = 100
+
+# decision reasons, and how they read in per-instance lines
+REASONS = {
+    'not_stopped_or_running': 'is neither stopped nor running, ignoring',
+    'asg_member': 'is a member of an Auto Scaling group, which is scheduled as a whole instead, ignoring',
+    'unscheduled': 'carries no schedule applying to its state, ignoring',
+    'malformed_schedule': 'carries an incorrectly formatted schedule tag, ignoring',
+    'weekend': 'is not tagged with "ec2_start_on_weekends" and it is a weekend, ignoring',
+    'not_due': 'is not due in the current slot, ignoring',
+    'start_due': 'qualifies for a start event',
+    'stop_due': 'qualifies for a stop event',
+    'cron_no_weekday': 'is tagged with "ec2_schedule" but no weekday was provided, ignoring',
+    'cron_not_due': 'is not due on its "ec2_schedule" in the current slot, ignoring',
+    'cron_start_due': 'qualifies for a start event on its "ec2_schedule"',
+    'cron_stop_due': 'qualifies for a stop event on its "ec2_schedule"',
+    'unknown_timezone': 'is tagged with an unknown "ec2_timezone", ignoring',
+    'in_desired_state': 'is already in the state its latest schedule transition calls for, ignoring',
+    'catch_up_start': 'missed the start its latest schedule transition calls for',
+    'catch_up_stop': 'missed the stop its latest schedule transition calls for'
+}
+
+_local = threading.local()
+
+class DecisionLog:
+    '''
+    Collects the classification decisions of a single scope: counts per reason, the instances actioned, and a random
+    sample (at most max_samples, each decision kept with probability sample_rate) of per-instance reasons.
+    Only ever written to by the thread processing the scope.
+    '''
+    def __init__(self, sample_rate=0.0, max_samples=DEFAULT_MAX_SAMPLES):
+        self.sample_rate = sample_rate
+        self.max_samples = max_samples
+        self.reasons = Counter()
+        self.actioned = {}
+        self.samples = []
+
+    def record(self, instance_id, reason):
+        ''' Counts a decision, sampling it. '''
+        self.reasons[reason] += 1
+        if self.sample_rate and len(self.samples) < self.max_samples and random.random() < self.sample_rate:
+            self.samples.append({'instance_id': instance_id, 'reason': reason})
+
+    def add_actioned(self, action, instance_ids):
+        ''' Lists instances an action was sent for. '''
+        self.actioned.setdefault(action, []).extend(instance_ids)
+
+    def to_record(self):
+        ''' Renders the summary record. '''
+        record = {'reasons': dict(self.reasons), 'actioned': self.actioned}
+        if self.sample_rate:
+            record['samples'] = self.samples
+
+        return record
+
+def current():
+    ''' Retrieves the decision log of the scope being processed by the current thread, if any. '''
+    return getattr(_local, 'log', None)
+
+@contextmanager
+def recording(decision_log):
+    ''' Records decisions made by the current thread into the given DecisionLog (or per-instance lines, if None). '''
+    previous = getattr(_local, 'log', None)
+    _local.log = decision_log
+    try:
+        yield decision_log
+    finally:
+        _local.log = previous
+
+def decide(instance_id, reason, action=None):
+    ''' Records why an instance was (or was not) classified for an action, returning the action. '''
+    decision_log = getattr(_local, 'log', None)
+    if decision_log is not None:
+        decision_log.record(instance_id, reason)
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Instance %s %s', instance_id, REASONS[reason])
+
+    return action
@@ -9,277 +9,776 @@
 #
 '''
 
-from datetime import datetime
-from enum import Enum
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 import json
 import logging
-import re
+import time
 from os import environ
 
-import boto3
-import pytz
-from aws_xray_sdk.core import patch_all
-from pythonjsonlogger import jsonlogger
+from classify import ( # pylint: disable=W0611
+    ACTION_HIBERNATE, ACTION_START, ACTION_STOP, TIMEZONE_TAG, StateManagementPhase,
+    check_configured_time, check_if_weekend, check_schedule_time, check_tag_time_format,
+    classify_by_timezone, classify_catch_up, classify_instance, classify_instances, classify_zoned_catch_up, classify_zoned_instances,
+    filter_start_instances, filter_stop_instances, get_catch_up_window, get_hour_phase, get_invoke_time, get_slot, get_time_info,
+    get_timezone, get_zone, _classify_instance,
+    _filter_start_instances, _filter_stop_instances
+)
+from continuation import Continuation, DeadlineReached
+import decisions
+import hibernation
+from log_formatter import JsonFormatter
+import metrics
+import tracing
+from inventory import ( # pylint: disable=W0611
+    DESCRIBE_PAGE_SIZE, INVENTORY_MODE_FILTERED, INVENTORY_MODE_FULL, INVENTORY_MODES,
+    INVENTORY_SOURCE_CLIENT, INVENTORY_SOURCE_RESOURCE, INVENTORY_SOURCES, REFRESH_CHUNK_SIZE,
+    SCHEDULE_TAG_KEYS, SCHEDULED_FILTERS, START_CANDIDATE_FILTERS, STOP_CANDIDATE_FILTERS,
+    InstanceRecord, chunk_list, get_cached_inventory, get_instance_tags, get_inventory, inventory_cache,
+    iter_instance_pages, iter_inventory_pages, iter_record_pages, refresh_records, tag_list_to_dict
+)
+from schedule import ( # pylint: disable=W0611
+    SLOTS_PER_HOUR, SLOTS_PER_DAY, TIME_PATTERN,
+    get_schedule, parse_schedule_slot
+)
+import runtime
+from runtime import (
+    LAMBDA_NAME, scope_decisions, scope_metrics,
+    collect_region, get_account_resources, get_client, get_ec2_resource, get_role_arns, get_scope_ec2_resource, get_setting, send_batch
+)
+from schedule_store import DynamoDBScheduleStore, MemoryScheduleStore
+from timing_wheel import DynamoDBWheelBackend, FileWheelBackend, S3WheelBackend, TimingWheel
+
+tracing.configure(tracing.get_xray_mode(environ.get('STATE_MGMT_XRAY')))
 
-patch_all()
-
-LAMBDA_NAME = 'ec2-state-mgmt'
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG if environ.get('DEBUG_MODE') == 'true' else logging.INFO)
 
-class CustomJsonFormatter(jsonlogger.JsonFormatter):
-    '''
-    Customizations for JSON formatting
-    '''
-    def add_fields(self, log_record, record, message_dict):
-        '''
-        Add level field for our use.
-        '''
-        super().add_fields(log_record, record, message_dict)
-
-        if log_record.get('level'):
-            log_record['level'] = log_record['level'].upper()
-        else:
-            log_record['level'] = record.levelname
-
 for handler in logger.handlers:
-    handler.setFormatter(CustomJsonFormatter(timestamp=True))
+    handler.setFormatter(JsonFormatter())
+
+# the asyncio engine running the current invocation, if any; its action batches are sent from its event loop.
+#   reassigned by every asyncio invocation, so it is state rather than a constant
+engine = None # pylint: disable=C0103
 
-if environ.get('CI') != 'true':
-    ec2 = boto3.resource('ec2', region_name=environ.get('AWS_REGION'))
-    sns = boto3.resource('sns', region_name=environ.get('AWS_REGION'))
+# schedule stores, timing wheels and their document backends are built once per container
+schedule_stores = {}
+timing_wheels = {}
+document_backends = {}
 
 # note: time should be specified in 24hr time and according to the configured STATE_MGMT_TIMEZONE
 HARDCODED_START = '06:00'.split(':')[0]
 HARDCODED_STOP = '18:00'.split(':')[0]
-TIME_PATTERN = re.compile('^([01][0-9]|2[0-3]):[0-5][0-9]$')
 
-class StateManagementPhase(Enum):
-    ''' Helper enum '''
-    PHASE_ONE = 1   # :00 - :14
-    PHASE_TWO = 2   # :15 - :29
-    PHASE_THREE = 3 # :30 - :44
-    PHASE_FOUR = 4  # :45 - :59
+# schedule store backends
+SCHEDULE_STORE_DYNAMODB = 'dynamodb'
+SCHEDULE_STORE_MEMORY = 'memory'
+SCHEDULE_STORES = [SCHEDULE_STORE_DYNAMODB, SCHEDULE_STORE_MEMORY]
+
+# document backends, keeping the timing wheel and catch-up watermarks
+DOCUMENT_BACKEND_S3 = 's3'
+DOCUMENT_BACKEND_DYNAMODB = 'dynamodb'
+DOCUMENT_BACKEND_FILE = 'file'
+DOCUMENT_BACKENDS = [DOCUMENT_BACKEND_S3, DOCUMENT_BACKEND_DYNAMODB, DOCUMENT_BACKEND_FILE]
+
+# schedule stores and timing wheels are fully reconciled against DescribeInstances at least this often (seconds), to repair any drift
+DEFAULT_RECONCILE_INTERVAL = 86400
+
+# upper bound on the number of regions processed concurrently
+DEFAULT_MAX_REGION_WORKERS = 8
+
+# upper bound on the number of accounts processed concurrently
+DEFAULT_MAX_ACCOUNT_WORKERS = 4
+
+# checkpointed invocations stop taking on new work this many seconds ahead of the Lambda timeout
+DEFAULT_DEADLINE_MARGIN = 30
+
+# upper bound on the chain of self-invocations finishing a single tick
+DEFAULT_MAX_CONTINUATIONS = 10
+
+# execution engines; scopes run on thread pools, or scopes and action batches on a single asyncio event loop
+ENGINE_THREADS = 'threads'
+ENGINE_ASYNCIO = 'asyncio'
+ENGINES = [ENGINE_THREADS, ENGINE_ASYNCIO]
+
+# cap on the action batches in flight across every scope, under the asyncio engine
+DEFAULT_MAX_ACTION_BATCHES = 8
+
+# bulk StartInstances/StopInstances requests are split into batches of at most this many instance IDs
+DEFAULT_ACTION_BATCH_SIZE = 50
 
 class RecoveredError(Exception): # pylint: disable=C0115
     pass
 
-def get_invoke_time(now):
-    ''' Get the invocation time. '''
-    return now.strftime('%H:%M').split(':')
-
-def check_if_weekend(now):
-    ''' Check to see if the specified date is a weekend. '''
-    return now.weekday() in [5, 6] # 5-6 are Saturday, Sunday ordinally
-
-def get_hour_phase(current_minute):
-    ''' Identifies which segment of the hour the current invocation falls into. '''
-    if 0 <= int(current_minute) < 15:
-        return StateManagementPhase.PHASE_ONE
-
-    if 15 <= int(current_minute) < 30:
-        return StateManagementPhase.PHASE_TWO
-
-    if 30 <= int(current_minute) < 45:
-        return StateManagementPhase.PHASE_THREE
-
-    return StateManagementPhase.PHASE_FOUR
-
-def check_tag_time_format(instance, time_type, time_value):
-    ''' Check to see if the time specified for an ec2_start or ec2_stop value is correctly formatted. '''
-    if not re.match(TIME_PATTERN, time_value):
-        logger.warning(f'Instance {instance.id} tag value for "{time_type}" tag is incorrectly formatted, ignoring')
-        return False
-
-    return True
-
-def tag_list_to_dict(tags):
-    ''' Collapses the list of tags that AWS provides for EC2s down into a simple dict. '''
-    return {t['Key']:t['Value'] for t in tags}
-
-def check_configured_time(instance, time_type, minute_value):
-    ''' Massages user-specified minute value for ec2_start and ec2_stop to a sane value. '''
-    if 0 < int(minute_value) < 15:
-        logger.warning(f'Invalid minute specifier for instance {instance.id} {time_type} time (specified :{minute_value}, assuming :00)')
-        minute_value = '00'
-    elif 15 < int(minute_value) < 30:
-        logger.warning(f'Invalid minute specifier for instance {instance.id} {time_type} time (specified :{minute_value}, assuming :15)')
-        minute_value = '15'
-    elif 30 < int(minute_value) < 45:
-        logger.warning(f'Invalid minute specifier for instance {instance.id} {time_type} time (specified :{minute_value}, assuming :30)')
-        minute_value = '30'
-    elif 45 < int(minute_value) < 60:
-        logger.warning(f'Invalid minute specifier for instance {instance.id} {time_type} time (specified :{minute_value}, assuming :45)')
-        minute_value = '45'
-
-    return minute_value
-
-def _filter_start_instances(instance, current_hour, hour_phase, is_weekend):
-    state = instance.state.get('Name')
-    if state != 'stopped':
-        logger.debug(f'Instance {instance.id} is not stopped (status: {state}), ignoring')
-        return False
-
-    tags = tag_list_to_dict(instance.tags)
-
-    # supports {'ec2_start_on_weekends' => 'true'}
-    # notes:
-    # - forces start events to process during weekends if the ec2_start_on_weekends tag is set to "true"
-    if is_weekend and ('ec2_start_on_weekends' not in tags or tags['ec2_start_on_weekends'].lower() != 'true'):
-        logger.debug(f'Instance {instance.id} is not tagged with "ec2_start_on_weekends" and it is a weekend, ignoring')
-        return False
-
-    # supports {'ec2_start' => 'XX:00'}, {'ec2_start' => 'XX:15'}, {'ec2_start' => 'XX:30'} and {'ec2_start' => 'XX:45'}
-    # notes:
-    # - additional specificity in the ec2 tag is ignored! don't try to be cheeky and say XX:48.  it will not be supported.
-    if 'ec2_start' in tags:
-        logger.debug(f'Instance {instance.id} is tagged with "ec2_start" tag')
-
-        if not check_tag_time_format(instance, 'ec2_start', tags['ec2_start']):
-            return False
-
-        tag_hour, tag_minute = tags['ec2_start'].split(':')
-        if current_hour == tag_hour:
-            tag_minute = check_configured_time(instance, 'ec2_start', tag_minute)
-
-            if ((hour_phase == StateManagementPhase.PHASE_ONE and tag_minute == '00') # pylint: disable=R0916
-                or (hour_phase == StateManagementPhase.PHASE_TWO and tag_minute == '15')
-                or (hour_phase == StateManagementPhase.PHASE_THREE and tag_minute == '30')
-                or (hour_phase == StateManagementPhase.PHASE_FOUR and tag_minute == '45')
-            ):
-                return True
-
-    # catchall; do not send any start events
-    return False
-
-def _filter_stop_instances(instance, current_hour, hour_phase): # pylint: disable=R0911
-    '''
-    Function to filter out which instances should be stopped, given the current hour and hour_phase (quarter hour)
-    '''
-    state = instance.state.get('Name')
-    if state != 'running':
-        logger.debug(f'Instance {instance.id} is not running (status: {state}), ignoring')
-        return False
-
-    tags = tag_list_to_dict(instance.tags)
-
-    # supports {'ec2_stop' => 'XX:00'}, {'ec2_stop' => 'XX:15'}, {'ec2_stop' => 'XX:30'} and {'ec2_stop' => 'XX:45'}
-    # notes:
-    # - additional specificity in the ec2 tag is ignored! don't try to be cheeky and say XX:48.  it will not be supported.
-    if 'ec2_stop' in tags:
-        logger.debug(f'Instance {instance.id} is tagged with "ec2_stop" tag')
-
-        if not check_tag_time_format(instance, 'ec2_stop', tags['ec2_stop']):
-            return False
-
-        tag_hour, tag_minute = tags['ec2_stop'].split(':')
-        if current_hour == tag_hour:
-            tag_minute = check_configured_time(instance, 'ec2_stop', tag_minute)
-
-            if ((hour_phase == StateManagementPhase.PHASE_ONE and tag_minute == '00') # pylint: disable=too-many-boolean-expressions
-                or (hour_phase == StateManagementPhase.PHASE_TWO and tag_minute == '15')
-                or (hour_phase == StateManagementPhase.PHASE_THREE and tag_minute == '30')
-                or (hour_phase == StateManagementPhase.PHASE_FOUR and tag_minute == '45')
-            ):
-                return True
-
-    # catchall; do not send any stop events
-    return False
-
-def filter_start_instances(instance, current_hour, hour_phase, is_weekend):
-    ''' Tiny wrapper around the filter_start_instances function to shim in some extra logging. '''
-    result = _filter_start_instances(instance, current_hour, hour_phase, is_weekend)
-
-    if result:
-        logger.debug(f'Instance {instance.id} identified as qualifying for sending start event')
-    else:
-        logger.debug(f'Instance {instance.id} does not qualify for start event, ignoring')
-
-    return result
-
-def filter_stop_instances(instance, current_hour, hour_phase):
-    ''' Tiny wrapper around the filter_stop_instances function to shim in some extra logging. '''
-    result = _filter_stop_instances(instance, current_hour, hour_phase)
-
-    if result:
-        logger.debug(f'Instance {instance.id} identified as qualifying for sending stop event')
-    else:
-        logger.debug(f'Instance {instance.id} does not qualify for stop event, ignoring')
-
-    return result
+def get_decision_log(event):
+    ''' Builds a scope's decision log, or None when decisions are to be logged per instance (the "detailed" decision log). '''
+    mode = get_setting(event, 'decision_log', 'STATE_MGMT_DECISION_LOG', decisions.DECISION_LOG_SUMMARY)
+    if mode not in decisions.DECISION_LOG_MODES:
+        raise ValueError(f'Unknown decision log mode "{mode}"')
 
-def lambda_handler(_event, _context):
-    ''' Lambda handler '''
+    if mode == decisions.DECISION_LOG_DETAILED:
+        return None
+
+    return decisions.DecisionLog(float(get_setting(event, 'decision_sample_rate', 'STATE_MGMT_DECISION_SAMPLE_RATE', 0)))
+
+def control_instances(ec2_client, action, instance_ids, batch_size=DEFAULT_ACTION_BATCH_SIZE):
+    '''
+    Sends bulk StartInstances/StopInstances requests for the specified instances.
+    Returns the number of instances which could not be actioned.
+    '''
+    if action not in [ACTION_START, ACTION_STOP, ACTION_HIBERNATE]:
+        raise ValueError(f'Unknown instance control action "{action}"')
+
+    failure_count = 0
+    batches = chunk_list(instance_ids, batch_size)
+    for index, batch in enumerate(batches):
+        # no new batches are sent once the invocation's deadline is reached
+        if runtime.continuation.deadline_reached():
+            raise DeadlineReached({action: [instance_id for pending in batches[index:] for instance_id in pending]}, failure_count)
+
+        failure_count += send_batch(ec2_client, action, batch)
+
+    return failure_count
+
+def control_actions(ec2_client, actions, batch_size):
+    '''
+    Sends the bulk requests for a dict of {action: instance_ids}, in order.
+    Returns the number of instances which could not be actioned; once the deadline is reached,
+    raises DeadlineReached carrying every action not yet sent.
+    '''
+    decision_log = decisions.current()
+    pending = {}
     try:
+        if engine is not None:
+            return engine.run_actions(ec2_client, actions, batch_size)
 
-        timezone = pytz.timezone(environ.get('STATE_MGMT_TIMEZONE') or 'UTC')
-        now = datetime.now(timezone)
+        return _control_actions(ec2_client, actions, batch_size)
+    except DeadlineReached as ex:
+        pending = ex.pending
+        raise
+    finally:
+        if decision_log is not None:
+            for action, instance_ids in actions.items():
+                deferred = set(pending.get(action, []))
+                if instance_ids:
+                    decision_log.add_actioned(action, [instance_id for instance_id in instance_ids if instance_id not in deferred])
+
+def _control_actions(ec2_client, actions, batch_size):
+    failure_count = 0
+    actions = [(action, instance_ids) for action, instance_ids in actions.items() if instance_ids]
+    for index, (action, instance_ids) in enumerate(actions):
+        try:
+            with metrics.current().stage(f'{action.title()}Time'):
+                failure_count += control_instances(ec2_client, action, instance_ids, batch_size)
+        except DeadlineReached as ex:
+            raise DeadlineReached({**ex.pending, **dict(actions[index + 1:])}, failure_count + ex.failure_count) from ex
+
+    return failure_count
+
+def action_instances(ec2_client, start_instances, stop_instances, batch_size):
+    '''
+    Starts and stops (or hibernates, see hibernation.split_stops) the given instances, hibernating and stopping in separate batches.
+    Returns the number of instances which could not be actioned.
+    '''
+    hibernate_instances, stop_instances = hibernation.split_stops(stop_instances)
+
+    return control_actions(ec2_client, {
+        ACTION_START: [instance.id for instance in start_instances],
+        ACTION_STOP: [instance.id for instance in stop_instances],
+        ACTION_HIBERNATE: [instance.id for instance in hibernate_instances]
+    }, batch_size)
+
+def stream_region(ec2_client, pages, now, batch_size):
+    '''
+    Classifies and actions each inventory page as it arrives, so memory use is bounded by page size rather than fleet size.
+    Returns the number of instances which could not be actioned.
+    '''
+    started_at = time.monotonic()
+    first_action_at = None
+    failure_count = 0
+    start_count = 0
+    stop_count = 0
+
+    for page in pages:
+        with metrics.current().stage('ClassificationTime'):
+            start_instances, stop_instances = classify_zoned_instances(page, now)
+        metrics.current().add('StartDue', len(start_instances))
+        metrics.current().add('StopDue', len(stop_instances))
+        if not start_instances and not stop_instances:
+            continue
+
+        if first_action_at is None:
+            first_action_at = time.monotonic()
+            logger.info(f'Time to first action: {(first_action_at - started_at) * 1000:.0f}ms')
+
+        start_count += len(start_instances)
+        stop_count += len(stop_instances)
+        try:
+            failure_count += action_instances(ec2_client, start_instances, stop_instances, batch_size)
+        except DeadlineReached as ex:
+            # later pages are yet to be classified, so the whole scope is deferred; instances already actioned no longer qualify
+            raise DeadlineReached(None, failure_count + ex.failure_count) from ex
+
+    if first_action_at is None:
+        logger.info('No instances to start or stop.')
+
+    logger.debug(f'Streamed {start_count} instances to start and {stop_count} instances to stop total')
+
+    return failure_count
+
+def get_schedule_store(event=None):
+    ''' Retrieves the configured (cached) schedule store, or None if the schedule store is not in use. '''
+    kind = get_setting(event, 'schedule_store', 'STATE_MGMT_SCHEDULE_STORE')
+    if not kind:
+        return None
+
+    if kind not in SCHEDULE_STORES:
+        raise ValueError(f'Unknown schedule store "{kind}"')
+
+    if kind not in schedule_stores:
+        if kind == SCHEDULE_STORE_DYNAMODB:
+            schedule_stores[kind] = DynamoDBScheduleStore(get_client('dynamodb'), environ.get('STATE_MGMT_SCHEDULE_TABLE'))
+        else:
+            schedule_stores[kind] = MemoryScheduleStore()
+
+    return schedule_stores[kind]
+
+def get_document_backend(kind, location):
+    ''' Retrieves the (cached) S3 ("bucket[/prefix]"), DynamoDB (table name) or file (directory) document backend at a location. '''
+    if kind not in DOCUMENT_BACKENDS:
+        raise ValueError(f'Unknown document backend "{kind}"')
+
+    if (kind, location) not in document_backends:
+        if kind == DOCUMENT_BACKEND_S3:
+            bucket, _, prefix = location.partition('/')
+            document_backends[(kind, location)] = S3WheelBackend(get_client('s3'), bucket, f'{prefix}/' if prefix else '')
+        elif kind == DOCUMENT_BACKEND_DYNAMODB:
+            document_backends[(kind, location)] = DynamoDBWheelBackend(get_client('dynamodb'), location)
+        else:
+            document_backends[(kind, location)] = FileWheelBackend(location)
+
+    return document_backends[(kind, location)]
+
+def get_timing_wheel(event=None):
+    ''' Retrieves the configured (cached) timing wheel, or None if the timing wheel is not in use. '''
+    kind = get_setting(event, 'timing_wheel', 'STATE_MGMT_TIMING_WHEEL')
+    if not kind:
+        return None
+
+    location = environ.get('STATE_MGMT_TIMING_WHEEL_LOCATION')
+    if (kind, location) not in timing_wheels:
+        timing_wheels[(kind, location)] = TimingWheel(get_document_backend(kind, location))
+
+    return timing_wheels[(kind, location)]
+
+def get_watermark_backend(event=None):
+    ''' Retrieves the configured document backend keeping catch-up watermarks, or None if catch-up mode is not in use. '''
+    kind = get_setting(event, 'catch_up', 'STATE_MGMT_CATCH_UP')
+    if not kind:
+        return None
+
+    return get_document_backend(kind, environ.get('STATE_MGMT_CATCH_UP_LOCATION'))
+
+def get_checkpoint_backend(event=None):
+    ''' Retrieves the configured document backend keeping continuation checkpoints, or None if deadline-aware execution is not in use. '''
+    kind = get_setting(event, 'checkpoint_store', 'STATE_MGMT_CHECKPOINT_STORE')
+    if not kind:
+        return None
+
+    return get_document_backend(kind, environ.get('STATE_MGMT_CHECKPOINT_LOCATION'))
+
+def get_schedule_entries(instances):
+    '''
+    Compiles the {instance_id: (schedule, state)} schedule store entries for the scheduled instances in a list.
+    Store and wheel slots are in STATE_MGMT_TIMEZONE, so instances tagged with another ec2_timezone are left out
+    (with a warning) rather than actioned at the wrong local time.
+    '''
+    default_timezone = environ.get('STATE_MGMT_TIMEZONE') or 'UTC'
+    entries = {}
+    zoned_ids = []
+    for instance in instances:
+        tags = get_instance_tags(instance)
+        schedule = get_schedule(tags)
+        if schedule is None:
+            continue
+
+        if tags.get(TIMEZONE_TAG, default_timezone) != default_timezone:
+            zoned_ids.append(instance.id)
+            continue
+
+        entries[instance.id] = (schedule, instance.state.get('Name'))
+
+    if zoned_ids:
+        logger.warning(f'Instances {", ".join(zoned_ids)} are tagged with an "{TIMEZONE_TAG}" other than {default_timezone}, '
+            'which the schedule store and timing wheel do not support; they will not be scheduled by them')
+
+    return entries
+
+def check_reconcile_due(event, reconciled_at):
+    ''' Checks whether a schedule store or timing wheel scope is due (or has been asked) for a full reconciliation. '''
+    if isinstance(event, dict) and str(event.get('reconcile')).lower() == 'true':
+        return True
+
+    reconcile_interval = int(get_setting(event, 'reconcile_interval', 'STATE_MGMT_RECONCILE_INTERVAL', DEFAULT_RECONCILE_INTERVAL))
+
+    return reconciled_at is None or time.time() - reconciled_at >= reconcile_interval
+
+def reconcile_schedule_store(store, scope, ec2_client):
+    ''' Rebuilds a scope of the schedule store from a full DescribeInstances sweep, repairing any drift. '''
+    records = [record for page in iter_instance_pages(iter_record_pages(ec2_client), 'reconciliation') for record in page]
+    store.replace_scope(scope, get_schedule_entries(records))
+
+def process_region_from_store(store, scope, ec2_resource, event, now):
+    '''
+    Actions the instances the schedule store lists as due, without calling DescribeInstances.
+    Returns the number of instances which could not be actioned.
+    '''
+    current_hour, current_minute = get_invoke_time(now)
+    slot = get_slot(current_hour, get_hour_phase(current_minute))
+
+    if check_reconcile_due(event, store.get_reconciled_at(scope)):
+        reconcile_schedule_store(store, scope, ec2_resource.meta.client)
+
+    with metrics.current().stage('InventoryTime'):
+        start_ids, stop_ids = store.due(scope, slot, check_if_weekend(now))
+    metrics.current().add('StartDue', len(start_ids))
+    metrics.current().add('StopDue', len(stop_ids))
+    logger.info(f'Schedule store lists {len(start_ids)} instances to start and {len(stop_ids)} instances to stop in {scope}')
+
+    batch_size = int(get_setting(event, 'action_batch_size', 'STATE_MGMT_ACTION_BATCH_SIZE', DEFAULT_ACTION_BATCH_SIZE))
+
+    return control_actions(ec2_resource.meta.client, {ACTION_START: start_ids, ACTION_STOP: stop_ids}, batch_size)
+
+def filter_actionable(ec2_client, start_ids, stop_ids):
+    '''
+    Checks the current state of just the given instances,
+    keeping those to start which are stopped and those to stop which are running.
+    '''
+    states = {}
+    if start_ids or stop_ids:
+        records, _ = refresh_records(ec2_client, sorted(set(start_ids + stop_ids)))
+        states = {record.id: record.state.get('Name') for record in records}
+
+    return ([instance_id for instance_id in start_ids if states.get(instance_id) == 'stopped'],
+        [instance_id for instance_id in stop_ids if states.get(instance_id) == 'running'])
 
-        current_hour, current_minute = get_invoke_time(now)
-        is_weekend = check_if_weekend(now)
-        hour_phase = get_hour_phase(current_minute)
+def resume_region(ec2_resource, event, pending):
+    '''
+    Re-sends the actions an earlier invocation deferred past its deadline.
+    Instances which have since left the state to act on are skipped, so repeated resends are harmless.
+    Returns the number of instances which could not be actioned.
+    '''
+    hibernate_ids = set(pending.get(ACTION_HIBERNATE, []))
+    start_ids, stop_ids = filter_actionable(ec2_resource.meta.client,
+        pending.get(ACTION_START, []), pending.get(ACTION_STOP, []) + sorted(hibernate_ids))
+    logger.info(f'Resuming {len(start_ids)} deferred starts and {len(stop_ids)} deferred stops')
+
+    batch_size = int(get_setting(event, 'action_batch_size', 'STATE_MGMT_ACTION_BATCH_SIZE', DEFAULT_ACTION_BATCH_SIZE))
 
-        # due to us needing to interact with both started and stopped EC2 instances with
-        #   filtering more complex than AWS's APIs can support, it's more efficient to just
-        #   get a full instance list and roll with it up front.
-        #
-        # also, pylint apparently doesn't understand that LAMBDA.ec2 is lazy-loaded...
-        instances = list(ec2.instances.all()) # pylint: disable=E1101
+    return control_actions(ec2_resource.meta.client, {
+        ACTION_START: start_ids,
+        ACTION_STOP: [instance_id for instance_id in stop_ids if instance_id not in hibernate_ids],
+        ACTION_HIBERNATE: [instance_id for instance_id in stop_ids if instance_id in hibernate_ids]
+    }, batch_size)
 
-        logger.debug(f'Retrieved {len(instances)} instances total')
+def process_region_from_wheel(wheel, scope, ec2_resource, event, now):
+    '''
+    Actions the instances in the current slot of the timing wheel, checking the state of only those instances.
+    Returns the number of instances which could not be actioned.
+    '''
+    current_hour, current_minute = get_invoke_time(now)
+    slot = get_slot(current_hour, get_hour_phase(current_minute))
 
-        start_instances = list(filter(
-            lambda instance_list: filter_start_instances(instance_list, current_hour, hour_phase, is_weekend), instances[:]
-        ))
-        stop_instances = list(filter(
-            lambda instance_list: filter_stop_instances(instance_list, current_hour, hour_phase), instances[:]
-        ))
+    if check_reconcile_due(event, wheel.get_rebuilt_at(scope)):
+        records = [record for page in iter_instance_pages(iter_record_pages(ec2_resource.meta.client), 'wheel-rebuild') for record in page]
+        wheel.rebuild(scope, {instance_id: schedule for instance_id, (schedule, _) in get_schedule_entries(records).items()})
 
-        logger.debug(f'Filtered instances to start down to {len(start_instances)} instances total')
-        logger.debug(f'Filtered instances to stop down to {len(stop_instances)} instances total')
+    with metrics.current().stage('InventoryTime'):
+        start_ids, stop_ids = filter_actionable(ec2_resource.meta.client, *wheel.read(scope, slot, check_if_weekend(now)))
+    metrics.current().add('StartDue', len(start_ids))
+    metrics.current().add('StopDue', len(stop_ids))
+    logger.info(f'Timing wheel lists {len(start_ids)} instances to start and {len(stop_ids)} instances to stop in {scope}')
+
+    batch_size = int(get_setting(event, 'action_batch_size', 'STATE_MGMT_ACTION_BATCH_SIZE', DEFAULT_ACTION_BATCH_SIZE))
+
+    return control_actions(ec2_resource.meta.client, {ACTION_START: start_ids, ACTION_STOP: stop_ids}, batch_size)
+
+def process_region(ec2_resource, event, now, scope=None):
+    '''
+    Inventories and actions the instances of a single region, recording the scope's metrics until it is collected.
+    Returns the number of instances which could not be actioned.
+    '''
+    account, _, region = (scope or '').rpartition('/')
+    recorder = metrics.ScopeMetrics(account or metrics.own_account, region, get_hour_phase(get_invoke_time(now)[1]).name)
+    scope_metrics[scope] = recorder
+    decision_log = scope_decisions[scope] = get_decision_log(event)
 
+    with metrics.recording(recorder), decisions.recording(decision_log), recorder.stage('TotalTime'), \
+        tracing.subsegment('process_region', scope=scope or '') as trace:
         failure_count = 0
-        if (len(start_instances)) > 0:
-            for instance in start_instances:
-                logger.info(f'Starting instance {instance.id}')
-
-                try:
-                    instance.start()
-                except Exception as ex: # pylint: disable=W0703
-                    logger.error(f'Failed to start instance {instance.id}', exc_info=ex)
-                    failure_count += 1
+        # Auto Scaling groups are scheduled as a whole, once per tick; continuations only carry on with deferred instance actions
+        resuming = isinstance(event, dict) and event.get('resume')
+        if not resuming and str(get_setting(event, 'auto_scaling_groups', 'STATE_MGMT_AUTO_SCALING_GROUPS', 'false')).lower() == 'true':
+            from asg import process_scope_groups # pylint: disable=C0415
+            failure_count += process_scope_groups(scope or environ.get('AWS_REGION'), event, now)
+
+        failure_count += _process_region(ec2_resource, event, now, scope)
+        trace.put_annotation('failed', failure_count)
+
+    return failure_count
+
+def _process_region(ec2_resource, event, now, scope):
+    # resumed invocations only carry on with the work deferred by the previous one
+    resume = (event.get('resume') or {}) if isinstance(event, dict) else {}
+    runtime.continuation.check_deadline(resume.get(scope))
+    if resume.get(scope) is not None:
+        return resume_region(ec2_resource, event, resume[scope])
+
+    store = get_schedule_store(event)
+    if store is not None:
+        return process_region_from_store(store, scope, ec2_resource, event, now)
+
+    wheel = get_timing_wheel(event)
+    if wheel is not None:
+        return process_region_from_wheel(wheel, scope, ec2_resource, event, now)
+
+    inventory_mode = get_setting(event, 'inventory_mode', 'STATE_MGMT_INVENTORY_MODE', INVENTORY_MODE_FULL)
+    inventory_source = get_setting(event, 'inventory_source', 'STATE_MGMT_INVENTORY_SOURCE', INVENTORY_SOURCE_RESOURCE)
+    batch_size = int(get_setting(event, 'action_batch_size', 'STATE_MGMT_ACTION_BATCH_SIZE', DEFAULT_ACTION_BATCH_SIZE))
+
+    if str(get_setting(event, 'streaming', 'STATE_MGMT_STREAMING', 'false')).lower() == 'true':
+        pages = iter_inventory_pages(ec2_resource, inventory_mode, inventory_source)
+        return stream_region(ec2_resource.meta.client, pages, now, batch_size)
+
+    cache_ttl = int(get_setting(event, 'inventory_cache_ttl', 'STATE_MGMT_INVENTORY_CACHE_TTL', 0))
+    with metrics.current().stage('InventoryTime'), tracing.subsegment('inventory') as trace:
+        if cache_ttl > 0:
+            full_rescan = isinstance(event, dict) and str(event.get('full_rescan')).lower() == 'true'
+            instances = get_cached_inventory(ec2_resource, scope, inventory_mode, inventory_source, ttl=cache_ttl, full_rescan=full_rescan)
+        else:
+            instances = get_inventory(ec2_resource, inventory_mode, inventory_source)
+        trace.put_annotation('instances_seen', len(instances))
+
+    logger.debug(f'Retrieved {len(instances)} instances total')
+
+    return process_region_from_inventory(ec2_resource, instances, event, now, scope)
+
+def process_region_from_inventory(ec2_resource, instances, event, now, scope):
+    '''
+    Classifies and actions an inventory snapshot of a region's instances, catching up on missed transitions in catch-up mode.
+    Returns the number of instances which could not be actioned.
+    '''
+    # catch-up mode acts on every transition since the last run, not just those in the current slot
+    watermarks = get_watermark_backend(event)
+    if watermarks is not None:
+        document = watermarks.get(f'{scope}/watermark') or {}
+        watermark, retries = document.get('watermark'), document.get('retries') or {}
+        logger.info(f'Catching up on {get_catch_up_window(watermark, now)[1]} quarter-hour slots since the last run, '
+            + f'retrying {len(retries)} instances which failed before')
+
+    with metrics.current().stage('ClassificationTime'), tracing.subsegment('classification') as trace:
+        if watermarks is not None:
+            start_instances, stop_instances = classify_zoned_catch_up(instances, watermark, now, retries)
+        else:
+            start_instances, stop_instances = classify_zoned_instances(instances, now)
+        trace.put_annotation('start_due', len(start_instances))
+        trace.put_annotation('stop_due', len(stop_instances))
+    metrics.current().add('StartDue', len(start_instances))
+    metrics.current().add('StopDue', len(stop_instances))
+
+    logger.debug(f'Filtered instances to start down to {len(start_instances)} instances total')
+    logger.debug(f'Filtered instances to stop down to {len(stop_instances)} instances total')
+
+    if not start_instances:
+        logger.info('No instances to start.')
+    if not stop_instances:
+        logger.info('No instances to stop.')
+
+    batch_size = int(get_setting(event, 'action_batch_size', 'STATE_MGMT_ACTION_BATCH_SIZE', DEFAULT_ACTION_BATCH_SIZE))
+    failure_count = action_instances(ec2_resource.meta.client, start_instances, stop_instances, batch_size)
+
+    # the watermark always advances; only the instances which failed are carried forward, to be retried by the next run
+    if watermarks is not None:
+        if failure_count:
+            retries = get_catch_up_retries(ec2_resource.meta.client, start_instances + stop_instances, watermark, retries, now)
+        else:
+            retries = {}
+        watermarks.put(f'{scope}/watermark', {'watermark': now.timestamp(), 'retries': retries})
+
+    return failure_count
+
+def get_catch_up_retries(ec2_client, actioned, watermark, retries, now):
+    '''
+    Identifies the instances a catch-up run failed to action; those still in the state they were to be actioned from.
+    Returns them keyed to the watermark they are to be caught up from again (the one of their first failed run), so the next
+    run re-derives their action from every transition since, rather than blindly repeating it.
+    '''
+    if watermark is None:
+        # runs without a watermark only caught up on the current slot
+        watermark = (now - timedelta(hours=1) / SLOTS_PER_HOUR).timestamp()
+
+    start_ids, stop_ids = filter_actionable(ec2_client,
+        [instance.id for instance in actioned if instance.state.get('Name') == 'stopped'],
+        [instance.id for instance in actioned if instance.state.get('Name') == 'running'])
+
+    return {instance_id: retries.get(instance_id, watermark) for instance_id in start_ids + stop_ids}
+
+def process_regions(ec2_resources, event, now, max_workers):
+    '''
+    Processes each region concurrently on a bounded thread pool.
+    Resources are keyed by their scope; the region, prefixed with the account ID for assumed roles.
+    Returns the combined instance failure count and the list of scopes which could not be processed.
+    '''
+    failure_count = 0
+    failed_regions = []
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(ec2_resources)))) as executor:
+        futures = {
+            executor.submit(tracing.wrap(process_region), resource, event, now, region): region
+            for region, resource in ec2_resources.items()
+        }
+
+        # regions are collected as they finish, so a slow region never holds up reporting on the others
+        for future in as_completed(futures):
+            region_failures, failed = collect_region(futures[future], future)
+            failure_count += region_failures
+            if failed:
+                failed_regions.append(futures[future])
+
+    return failure_count, failed_regions
+
+def get_regions(event):
+    ''' Identifies the regions to be processed this invocation, defaulting to the region the lambda runs in. '''
+    regions = get_setting(event, 'regions', 'STATE_MGMT_REGIONS')
+    if not regions:
+        return [environ.get('AWS_REGION')]
+
+    if isinstance(regions, str):
+        regions = regions.split(',')
+
+    # dedupe while preserving order
+    return list(dict.fromkeys(region.strip() for region in regions if region.strip()))
+
+def process_account(role_arn, regions, event, now):
+    '''
+    Processes every region of a single account via an assumed role.
+    Returns the account's instance failure count and the list of regions which could not be processed.
+    '''
+    max_workers = int(get_setting(event, 'max_region_workers', 'STATE_MGMT_MAX_REGION_WORKERS', DEFAULT_MAX_REGION_WORKERS))
+
+    return process_regions(get_account_resources(role_arn, regions), event, now, max_workers)
+
+def process_accounts(role_arns, regions, event, now):
+    '''
+    Processes each account concurrently, capping the number of accounts in flight.
+    Returns the combined instance failure count and the list of accounts and regions which could not be processed.
+    '''
+    failure_count = 0
+    failed_targets = []
+    max_workers = int(get_setting(event, 'max_account_workers', 'STATE_MGMT_MAX_ACCOUNT_WORKERS', DEFAULT_MAX_ACCOUNT_WORKERS))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(role_arns)))) as executor:
+        futures = {executor.submit(tracing.wrap(process_account), role_arn, regions, event, now): role_arn for role_arn in role_arns}
+
+        for future in as_completed(futures):
+            role_arn = futures[future]
+            try:
+                account_failures, account_failed_targets = future.result()
+                failure_count += account_failures
+                failed_targets.extend(account_failed_targets)
+            except Exception as ex: # pylint: disable=W0703
+                logger.error(f'Failed to process account via role {role_arn}', exc_info=ex)
+                failed_targets.append(role_arn.split(':')[4])
+
+    return failure_count, failed_targets
+
+def send_error_notification():
+    ''' Publishes an error notification to the configured SNS topic, if there is one. '''
+    if environ.get('NOTIFICATION_ARN'):
+        log_stream = environ.get('AWS_LAMBDA_LOG_STREAM_NAME')
+
+        # the SNS client is only built when a notification actually needs to be sent
+        get_client('sns').publish(
+            TargetArn=environ.get('NOTIFICATION_ARN'),
+            Message=json.dumps({'default':
+                json.dumps({
+                    'type': 'error',
+                    'lambda': LAMBDA_NAME,
+                    'message': f'{LAMBDA_NAME} lambda error notification; reference logstream {log_stream}'
+                })
+            }),
+            MessageStructure='json'
+        )
+
+def refresh_scheduled_instances(scope, ec2_client, instance_ids, store=None, wheel=None):
+    ''' Re-describes instances whose tags changed, updating (or dropping) their schedule store and timing wheel entries. '''
+    records, _ = refresh_records(ec2_client, instance_ids)
+    entries = get_schedule_entries(records)
+
+    if store is not None:
+        for instance_id in instance_ids:
+            if instance_id in entries:
+                schedule, state = entries[instance_id]
+                store.put(scope, instance_id, schedule, state)
+            else:
+                store.delete(scope, instance_id)
+
+    if wheel is not None:
+        wheel.update(scope, {instance_id: entries[instance_id][0] if instance_id in entries else None for instance_id in instance_ids})
+
+    logger.info(f'Refreshed schedules of {len(instance_ids)} instances in {scope}; {len(entries)} remain scheduled')
+
+def event_handler(event, context):
+    '''
+    Schedule store, timing wheel and resume latency tracking event handler.
+    Consumes EC2 instance state-change notifications and CloudTrail CreateTags/DeleteTags events.
+    '''
+    try:
+        store = get_schedule_store()
+        wheel = get_timing_wheel()
+        if store is None and wheel is None and not hibernation.check_tracking():
+            raise ValueError('A schedule store, timing wheel or resume latency tracking must be configured to handle events')
+
+        own_account_id = context.invoked_function_arn.split(':')[4] if context else None
+        scope = event['region'] if event.get('account') in [None, own_account_id] else f'{event["account"]}/{event["region"]}'
+        detail = event.get('detail') or {}
+
+        if event.get('detail-type') == 'EC2 Instance State-change Notification':
+            if detail['state'] == 'running' and hibernation.check_tracking():
+                hibernation.record_resume_latency(get_scope_ec2_resource(scope).meta.client, event)
+
+            # the timing wheel only tracks schedules; instance state is checked at tick time instead
+            if store is None:
+                pass
+            elif detail['state'] == 'terminated':
+                store.delete(scope, detail['instance-id'])
+            elif not store.update_state(scope, detail['instance-id'], detail['state']):
+                logger.debug(f'Instance {detail["instance-id"]} is not in the schedule store, ignoring state change')
+        elif event.get('detail-type') == 'AWS API Call via CloudTrail' and detail.get('eventName') in ['CreateTags', 'DeleteTags']:
+            if (store is None and wheel is None) or hibernation.check_tracking_event(detail):
+                return
+
+            resources = ((detail.get('requestParameters') or {}).get('resourcesSet') or {}).get('items', [])
+            instance_ids = [item['resourceId'] for item in resources if item.get('resourceId', '').startswith('i-')]
+            if instance_ids:
+                refresh_scheduled_instances(scope, get_scope_ec2_resource(scope).meta.client, instance_ids, store, wheel)
         else:
-            logger.info('No instances to start.')
+            logger.warning(f'Ignoring unsupported event (detail-type: {event.get("detail-type")})')
+    except Exception as ex:
+        logger.error('Fatal error during script runtime', exc_info=ex)
+
+        send_error_notification()
 
-        if (len(stop_instances)) > 0:
-            for instance in stop_instances:
-                logger.info(f'Stopping instance {instance.id}')
+        raise
 
-                try:
-                    instance.stop()
-                except Exception as ex: # pylint: disable=W0703
-                    logger.error(f'Failed to stop instance {instance.id}', exc_info=ex)
-                    failure_count += 1
+def continue_invocation(checkpoints, event, context, now):
+    '''
+    Checkpoints the work deferred past the invocation's deadline, then re-invokes the lambda asynchronously to finish the tick.
+    The continuation carries the original event payload, plus the key of its checkpoint.
+    '''
+    event = event if isinstance(event, dict) else {}
+    depth = int(event.get('continuation_depth') or 0) + 1
+    max_continuations = int(get_setting(event, 'max_continuations', 'STATE_MGMT_MAX_CONTINUATIONS', DEFAULT_MAX_CONTINUATIONS))
+    if depth > max_continuations:
+        raise RecoveredError(f'work still pending in {", ".join(runtime.continuation.pending)} after {max_continuations} continuations')
+
+    key = f'checkpoints/{context.aws_request_id}'
+    checkpoints.put(key, {'tick': now.isoformat(), 'scopes': runtime.continuation.pending, 'done': False})
+
+    payload = {name: value for name, value in event.items() if name != 'resume'}
+    payload.update({'resume_checkpoint': key, 'continuation_depth': depth})
+    get_client('lambda').invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps(payload).encode('utf-8')
+    )
+    logger.info(f'Deferred work in {", ".join(runtime.continuation.pending)} to continuation {depth}, checkpointed as {key}')
+
+def run_async_engine(event, now, resources, role_arns, regions):
+    '''
+    Runs the invocation on the asyncio engine; see AsyncEngine.run.
+    The engine is only imported when selected, keeping it off the cold start path of the default thread pool engine.
+    '''
+    global engine # pylint: disable=W0603
+    from async_engine import AsyncEngine # pylint: disable=C0415
+
+    engine = AsyncEngine(
+        process_region,
+        int(get_setting(event, 'max_region_workers', 'STATE_MGMT_MAX_REGION_WORKERS', DEFAULT_MAX_REGION_WORKERS)),
+        int(get_setting(event, 'max_action_batches', 'STATE_MGMT_MAX_ACTION_BATCHES', DEFAULT_MAX_ACTION_BATCHES))
+    )
+    try:
+        return engine.run(event, now, resources, role_arns, regions)
+    finally:
+        engine = None
+
+def run_engine(event, now, resources, role_arns, regions):
+    '''
+    Processes the given {scope: ec2_resource} resources, or every region of the accounts behind the given role ARNs,
+    on the configured execution engine.
+    Returns the combined instance failure count and the list of accounts and scopes which could not be processed.
+    '''
+    if get_setting(event, 'engine', 'STATE_MGMT_ENGINE', ENGINE_THREADS) == ENGINE_ASYNCIO:
+        return run_async_engine(event, now, resources, role_arns, regions)
+
+    if resources is not None:
+        max_workers = int(get_setting(event, 'max_region_workers', 'STATE_MGMT_MAX_REGION_WORKERS', DEFAULT_MAX_REGION_WORKERS))
+        return process_regions(resources, event, now, max_workers)
+
+    return process_accounts(role_arns, regions, event, now)
+
+def lambda_handler(event, context):
+    ''' Lambda handler '''
+    try:
+
+        timezone = get_timezone(environ.get('STATE_MGMT_TIMEZONE') or 'UTC')
+        now = datetime.now(timezone)
+
+        regions = get_regions(event)
+        role_arns = get_role_arns(event)
+
+        if context is not None:
+            metrics.own_account = context.invoked_function_arn.split(':')[4]
+
+        checkpoints = get_checkpoint_backend(event) if context is not None else None
+        margin = float(get_setting(event, 'deadline_margin', 'STATE_MGMT_DEADLINE_MARGIN', DEFAULT_DEADLINE_MARGIN))
+        runtime.continuation = Continuation(context if checkpoints is not None else None, margin * 1000)
+
+        checkpoint = None
+        checkpoint_key = event.get('resume_checkpoint') if isinstance(event, dict) else None
+        if checkpoints is not None and checkpoint_key:
+            # continuations are delivered at least once; a checkpoint already seen through is not acted on again
+            checkpoint = checkpoints.get(checkpoint_key)
+            if checkpoint is None or checkpoint.get('done'):
+                logger.info(f'Checkpoint {checkpoint_key} has already been completed, ignoring')
+                return
+
+            # the tick being finished is the one the checkpoint was taken in, not the current one
+            now = datetime.fromisoformat(checkpoint['tick'])
+            event = {**event, 'resume': checkpoint['scopes']}
+            resources = {scope: get_scope_ec2_resource(scope, event) for scope in checkpoint['scopes']}
+        elif role_arns:
+            resources = None
         else:
-            logger.info('No instances to stop.')
+            resources = {region: get_ec2_resource(region) for region in regions}
+
+        failure_count, failed_targets = run_engine(event, now, resources, role_arns, regions)
+
+        if runtime.continuation.pending:
+            continue_invocation(checkpoints, event, context, now)
+        if checkpoint is not None:
+            checkpoints.put(checkpoint_key, {**checkpoint, 'done': True})
 
+        errors = []
         if failure_count:
-            raise RecoveredError(f'{failure_count} instance control failures occurred')
+            errors.append(f'{failure_count} instance control failures occurred')
+        if failed_targets:
+            errors.append(f'processing failed for {", ".join(failed_targets)}')
+        if errors:
+            raise RecoveredError('; '.join(errors))
     except Exception as ex:
         logger.error('Fatal error during script runtime', exc_info=ex)
 
-        if environ.get('NOTIFICATION_ARN'):
-            log_stream = environ.get('AWS_LAMBDA_LOG_STREAM_NAME')
-            sns.publish(
-                TargetArn=environ.get('NOTIFICATION_ARN'),
-                Message=json.dumps({'default':
-                    json.dumps({
-                        'type': 'error',
-                        'lambda': LAMBDA_NAME,
-                        'message': f'{LAMBDA_NAME} lambda error notification; reference logstream {log_stream}'
-                    })
-                }),
-                MessageStructure='json'
-            )
+        send_error_notification()
 
         raise
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Hibernation of instances on scheduled stops, and measurement of the time instances take to resume
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+from datetime import datetime
+import logging
+import time
+from os import environ
+
+from classify import ACTION_START, ACTION_STOP
+from inventory import check_hibernation_configured, get_instance_tags
+import metrics
+
+logger = logging.getLogger()
+
+# supports {'ec2_hibernate' => 'true'} (or 'false', overriding STATE_MGMT_HIBERNATE)
+HIBERNATE_TAG = 'ec2_hibernate'
+
+# bookkeeping tags of resume latency tracking: how an instance was last stopped, and when its latest start was requested
+STOP_MODE_TAG = 'ec2_stop_mode'
+START_REQUESTED_TAG = 'ec2_start_requested_at'
+TRACKING_TAGS = frozenset([STOP_MODE_TAG, START_REQUESTED_TAG])
+
+# error codes of hibernation requests for instances which cannot be hibernated; these are stopped normally instead
+FALLBACK_ERROR_CODES = ['UnsupportedHibernationConfiguration', 'UnsupportedOperation']
+
+def check_default():
+    ''' Checks whether instances not tagged with ec2_hibernate are hibernated on stop. '''
+    return str(environ.get('STATE_MGMT_HIBERNATE') or 'false').lower() == 'true'
+
+def check_tracking():
+    ''' Checks whether resume latency tracking is enabled. '''
+    return str(environ.get('STATE_MGMT_TRACK_RESUME_LATENCY') or 'false').lower() == 'true'
+
+def split_stops(instances):
+    '''
+    Splits the instances to stop into those to hibernate (per their ec2_hibernate tag, or the default) and those to stop normally.
+    Instances not launched with hibernation enabled are always stopped normally, rather than failing their hibernation batch.
+    '''
+    default = 'true' if check_default() else 'false'
+    hibernate_instances, stop_instances = [], []
+    for instance in instances:
+        if get_instance_tags(instance).get(HIBERNATE_TAG, default).lower() != 'true':
+            stop_instances.append(instance)
+        elif not check_hibernation_configured(instance):
+            logger.debug('Instance %s is not configured for hibernation, stopping it instead', instance.id)
+            stop_instances.append(instance)
+        else:
+            hibernate_instances.append(instance)
+
+    return hibernate_instances, stop_instances
+
+def tag_actioned(ec2_client, action, instance_ids):
+    '''
+    Tags the instances of a successful batch for resume latency tracking, if enabled: with how they were stopped,
+    or when their start was requested.  Tracking is best effort, so failing to tag never fails the batch.
+    '''
+    if not check_tracking():
+        return
+
+    key, value = (START_REQUESTED_TAG, f'{time.time():.3f}') if action == ACTION_START else (STOP_MODE_TAG, action)
+    try:
+        ec2_client.create_tags(Resources=instance_ids, Tags=[{'Key': key, 'Value': value}])
+    except Exception as ex: # pylint: disable=W0703
+        logger.warning(f'Failed to tag instances {", ".join(instance_ids)} for resume latency tracking', exc_info=ex)
+
+def check_tracking_event(detail):
+    ''' Checks whether a CloudTrail CreateTags/DeleteTags event only touched resume latency tracking tags. '''
+    items = ((detail.get('requestParameters') or {}).get('tagSet') or {}).get('items', [])
+
+    return bool(items) and all(item.get('key') in TRACKING_TAGS for item in items)
+
+def record_resume_latency(ec2_client, event):
+    '''
+    Reports the time an instance took from its start request to running, by how it was last stopped, as an EMF record.
+    Consumes an EC2 instance state-change notification for the running state; each start is only reported once.
+    Returns the latency in seconds, or None for instances whose start was not requested by the lambda.
+    '''
+    instance_id = event['detail']['instance-id']
+    filters = [{'Name': 'resource-id', 'Values': [instance_id]}, {'Name': 'key', 'Values': sorted(TRACKING_TAGS)}]
+    tags = {tag['Key']: tag['Value'] for tag in ec2_client.describe_tags(Filters=filters)['Tags']}
+    if START_REQUESTED_TAG not in tags:
+        return None
+
+    ec2_client.delete_tags(Resources=[instance_id], Tags=[{'Key': START_REQUESTED_TAG}])
+
+    latency = datetime.fromisoformat(event['time'].replace('Z', '+00:00')).timestamp() - float(tags[START_REQUESTED_TAG])
+    stop_mode = tags.get(STOP_MODE_TAG, ACTION_STOP)
+    logger.info(f'Instance {instance_id} resumed from {stop_mode} in {latency:.1f}s')
+
+    metrics.emit_value('ResumeLatency', latency * 1000, {'Account': event['account'], 'Region': event['region'], 'StopMode': stop_mode},
+        environ.get('STATE_MGMT_METRICS_NAMESPACE') or metrics.DEFAULT_NAMESPACE)
+
+    return latency
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# EC2 instance inventory: DescribeInstances pagination, compact instance records and the warm-container inventory cache
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+import logging
+import time
+
+import metrics
+from schedule import ASG_MEMBER_TAG
+
+logger = logging.getLogger()
+
+# scheduled instance inventories survive across warm invocations, keyed by (scope, inventory mode, inventory source);
+#   keying on the scope rather than its EC2 resource keeps entries stable across assumed role credential refreshes
+inventory_cache = {}
+
+# inventory modes:
+# - full: list every instance in the region and filter everything client-side
+# - filtered: push tag and state filtering down into DescribeInstances, running separate start and stop candidate queries
+INVENTORY_MODE_FULL = 'full'
+INVENTORY_MODE_FILTERED = 'filtered'
+INVENTORY_MODES = [INVENTORY_MODE_FULL, INVENTORY_MODE_FILTERED]
+
+# inventory sources:
+# - resource: boto3 ec2.Instance resource objects
+# - client: low-level DescribeInstances pages projected down to compact InstanceRecord objects
+INVENTORY_SOURCE_RESOURCE = 'resource'
+INVENTORY_SOURCE_CLIENT = 'client'
+INVENTORY_SOURCES = [INVENTORY_SOURCE_RESOURCE, INVENTORY_SOURCE_CLIENT]
+
+# DescribeInstances page size used by both inventory sources (the API maximum)
+DESCRIBE_PAGE_SIZE = 1000
+
+# refreshes of cached inventories look instances up by ID in chunks of this many (the filter value limit)
+REFRESH_CHUNK_SIZE = 200
+
+# the only tags scheduling ever reads; everything else is dropped from instance records
+SCHEDULE_TAG_KEYS = frozenset([
+    'ec2_start', 'ec2_stop', 'ec2_start_on_weekends', 'ec2_schedule', 'ec2_timezone', 'ec2_hibernate', ASG_MEMBER_TAG
+])
+
+START_CANDIDATE_FILTERS = [
+    {'Name': 'instance-state-name', 'Values': ['stopped']},
+    {'Name': 'tag-key', 'Values': ['ec2_start', 'ec2_schedule']}
+]
+STOP_CANDIDATE_FILTERS = [
+    {'Name': 'instance-state-name', 'Values': ['running']},
+    {'Name': 'tag-key', 'Values': ['ec2_stop', 'ec2_schedule']}
+]
+
+# every scheduled instance, whatever its state; fills the inventory cache in filtered mode
+SCHEDULED_FILTERS = [
+    {'Name': 'tag-key', 'Values': ['ec2_start', 'ec2_stop', 'ec2_schedule']}
+]
+
+def tag_list_to_dict(tags):
+    ''' Collapses the list of tags that AWS provides for EC2s down into a simple dict. '''
+    return {t['Key']:t['Value'] for t in tags}
+
+def get_instance_tags(instance):
+    ''' Retrieves an instance's tags as a dict, whether it is an ec2.Instance resource or an InstanceRecord. '''
+    if isinstance(instance, InstanceRecord):
+        return instance.tag_dict or {}
+
+    return tag_list_to_dict(instance.tags or [])
+
+def check_hibernation_configured(instance):
+    ''' Checks whether an instance (an ec2.Instance resource or an InstanceRecord) was launched with hibernation enabled. '''
+    if isinstance(instance, InstanceRecord):
+        return instance.hibernation_configured
+
+    return bool((instance.hibernation_options or {}).get('Configured'))
+
+class InstanceRecord:
+    '''
+    Compact projection of a DescribeInstances entry, holding only what scheduling reads.
+    Quacks like an ec2.Instance resource as far as the filter functions are concerned.
+    '''
+    __slots__ = ('id', 'state', 'tag_dict', 'hibernation_configured')
+
+    # state dicts are shared between records rather than allocated per instance
+    _states = {}
+
+    def __init__(self, instance_id, state_name, tag_dict=None, hibernation_configured=False):
+        self.id = instance_id
+        self.state = self._states.setdefault(state_name, {'Name': state_name})
+        self.tag_dict = tag_dict or None
+        self.hibernation_configured = hibernation_configured
+
+    @property
+    def tags(self):
+        ''' The retained tags, in the list form AWS provides. '''
+        return [{'Key': key, 'Value': value} for key, value in (self.tag_dict or {}).items()]
+
+    @classmethod
+    def from_instance(cls, instance):
+        ''' Projects an ec2.Instance resource (or another record) down to a record. '''
+        tag_dict = {key: value for key, value in get_instance_tags(instance).items() if key in SCHEDULE_TAG_KEYS}
+
+        return cls(instance.id, instance.state.get('Name'), tag_dict, check_hibernation_configured(instance))
+
+    @classmethod
+    def from_description(cls, description):
+        ''' Projects a DescribeInstances instance entry down to a record. '''
+        tag_dict = {tag['Key']: tag['Value'] for tag in description.get('Tags', []) if tag['Key'] in SCHEDULE_TAG_KEYS}
+
+        return cls(description['InstanceId'], description['State']['Name'], tag_dict,
+            description.get('HibernationOptions', {}).get('Configured', False))
+
+def iter_instance_pages(pages, query_name):
+    ''' Passes through pages of instances, reporting how much the query fetched once drained. '''
+    instance_count = 0
+    page_count = 0
+    for page in pages:
+        page_count += 1
+        instance_count += len(page)
+        metrics.current().add('PagesFetched', 1)
+        metrics.current().add('InstancesSeen', len(page))
+        yield page
+
+    logger.info(f'Inventory query "{query_name}" fetched {instance_count} instances across {page_count} pages')
+
+def iter_record_pages(ec2_client, filters=None):
+    ''' Yields DescribeInstances pages from the low-level client, projected down to compact instance records. '''
+    kwargs = {'PaginationConfig': {'PageSize': DESCRIBE_PAGE_SIZE}}
+    if filters:
+        kwargs['Filters'] = filters
+
+    for page in ec2_client.get_paginator('describe_instances').paginate(**kwargs):
+        yield [InstanceRecord.from_description(instance) for reservation in page['Reservations'] for instance in reservation['Instances']]
+
+def iter_query_pages(ec2_resource, query_name, filters, inventory_source=INVENTORY_SOURCE_RESOURCE):
+    ''' Yields pages of the instances matching a single DescribeInstances query (every instance, without filters). '''
+    if inventory_source not in INVENTORY_SOURCES:
+        raise ValueError(f'Unknown inventory source "{inventory_source}"')
+
+    if inventory_source == INVENTORY_SOURCE_CLIENT:
+        pages = iter_record_pages(ec2_resource.meta.client, filters)
+    elif filters:
+        pages = ec2_resource.instances.filter(Filters=filters).page_size(DESCRIBE_PAGE_SIZE).pages()
+    else:
+        # without a page size no MaxResults is sent, and DescribeInstances returns the whole fleet as a single page
+        pages = ec2_resource.instances.all().page_size(DESCRIBE_PAGE_SIZE).pages()
+
+    yield from iter_instance_pages(pages, query_name)
+
+def iter_inventory_pages(ec2_resource, inventory_mode, inventory_source=INVENTORY_SOURCE_RESOURCE):
+    ''' Yields pages of candidate instances according to the configured inventory mode and source. '''
+    if inventory_mode not in INVENTORY_MODES:
+        raise ValueError(f'Unknown inventory mode "{inventory_mode}"')
+    if inventory_source not in INVENTORY_SOURCES:
+        raise ValueError(f'Unknown inventory source "{inventory_source}"')
+
+    if inventory_mode == INVENTORY_MODE_FILTERED:
+        queries = [('start-candidates', START_CANDIDATE_FILTERS), ('stop-candidates', STOP_CANDIDATE_FILTERS)]
+    else:
+        # due to us needing to interact with both started and stopped EC2 instances with
+        #   filtering more complex than AWS's APIs can support, it's more efficient to just
+        #   get a full instance list and roll with it up front.
+        queries = [('all', None)]
+
+    for query_name, filters in queries:
+        yield from iter_query_pages(ec2_resource, query_name, filters, inventory_source)
+
+def get_inventory(ec2_resource, inventory_mode, inventory_source=INVENTORY_SOURCE_RESOURCE):
+    ''' Retrieves the candidate instances according to the configured inventory mode and source. '''
+    return [instance for page in iter_inventory_pages(ec2_resource, inventory_mode, inventory_source) for instance in page]
+
+def refresh_records(ec2_client, instance_ids):
+    '''
+    Re-describes known instances by ID, returning fresh records and the number of pages fetched.
+    Instances which no longer exist are silently dropped.
+    '''
+    records = []
+    page_count = 0
+    for chunk in chunk_list(instance_ids, REFRESH_CHUNK_SIZE):
+        # an instance-id filter (rather than InstanceIds) avoids failing the whole call over a since-deleted instance
+        for page in iter_record_pages(ec2_client, [{'Name': 'instance-id', 'Values': chunk}]):
+            page_count += 1
+            records.extend(page)
+
+    return records, page_count
+
+def get_cached_inventory(ec2_resource, scope, inventory_mode, inventory_source, *, ttl, full_rescan=False): # pylint: disable=R0913
+    '''
+    Retrieves the candidate instances, reusing the warm container's inventory cache while it is fresh.
+    Fresh caches only refresh the instances already known to carry schedule tags, skipping the full rescan.
+    In filtered mode, the cache is filled with every scheduled instance whatever its state (rather than the state-filtered
+    candidates), as instances missing from the cache would be missed until it expires.
+    '''
+    started_at = time.monotonic()
+    cache_key = (scope, inventory_mode, inventory_source)
+    cached = inventory_cache.get(cache_key)
+
+    if cached and not full_rescan and started_at - cached['fetched_at'] < ttl:
+        records, page_count = refresh_records(ec2_resource.meta.client, [record.id for record in cached['records']])
+        cached['records'] = records
+
+        logger.info(f'Inventory cache hit (age {started_at - cached["fetched_at"]:.0f}s); refreshed {len(records)} scheduled instances '
+            + f'across {page_count} pages in {(time.monotonic() - started_at) * 1000:.0f}ms')
+
+        return records
+
+    if full_rescan:
+        reason = 'full rescan requested'
+    else:
+        reason = 'expired' if cached else 'empty'
+
+    if inventory_mode == INVENTORY_MODE_FILTERED:
+        pages = iter_query_pages(ec2_resource, 'scheduled', SCHEDULED_FILTERS, inventory_source)
+        instances = [instance for page in pages for instance in page]
+    else:
+        instances = get_inventory(ec2_resource, inventory_mode, inventory_source)
+    inventory_cache[cache_key] = {
+        'fetched_at': started_at,
+        'records': [
+            InstanceRecord.from_instance(instance) for instance in instances
+            if not {'ec2_start', 'ec2_stop', 'ec2_schedule'}.isdisjoint(get_instance_tags(instance))
+        ]
+    }
+
+    logger.info(f'Inventory cache miss ({reason}); full inventory of {len(instances)} instances '
+        + f'took {(time.monotonic() - started_at) * 1000:.0f}ms')
+
+    return instances
+
+def chunk_list(items, size):
+    ''' Splits a list into consecutive chunks of at most the specified size. '''
+    return [items[i:i + size] for i in range(0, len(items), size)]
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Low-overhead JSON log formatter, serializing with orjson when available
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+from datetime import date, datetime, time, timezone
+import json
+import logging
+
+try:
+    import orjson
+except ImportError: # orjson is optional; the standard library json is used without it
+    orjson = None
+
+# LogRecord attributes which are not carried over as extra fields
+RESERVED_ATTRS = frozenset(vars(logging.LogRecord('', logging.INFO, '', 0, '', None, None))) | {'message', 'asctime', 'taskName'}
+
+def _default(value):
+    ''' Serializes values JSON does not support natively. '''
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+
+    return str(value)
+
+def dumps(log_record):
+    ''' Serializes a log record to a JSON string. '''
+    if orjson is not None:
+        # orjson is a C extension pylint cannot introspect
+        return orjson.dumps(log_record, default=_default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8') # pylint: disable=E1101
+
+    return json.dumps(log_record, default=_default)
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Formats log records as single-line JSON objects: the message, any extra fields, the formatted exception (if any),
+    a UTC timestamp and the upper-cased level.  Dict messages are merged into the object, with an empty message.
+    '''
+    def format(self, record):
+        if isinstance(record.msg, dict):
+            log_record = {'message': '', **record.msg}
+        else:
+            log_record = {'message': record.getMessage()}
+
+        for key, value in record.__dict__.items():
+            if key not in RESERVED_ATTRS:
+                log_record[key] = value
+
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+            log_record['exc_info'] = record.exc_text
+        if record.stack_info:
+            log_record['stack_info'] = self.formatStack(record.stack_info)
+
+        log_record['timestamp'] = datetime.fromtimestamp(record.created, timezone.utc).isoformat()
+        log_record['level'] = log_record['level'].upper() if log_record.get('level') else record.levelname
+
+        return dumps(log_record)
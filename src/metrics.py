@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Per-scope performance metrics, emitted as CloudWatch Embedded Metric Format records
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+from contextlib import contextmanager
+import json
+import logging
+import sys
+import threading
+import time
+
+DEFAULT_NAMESPACE = 'ec2-state-mgmt'
+
+# account dimension of scopes in the lambda's own account, replaced by its account ID once known from the invocation context
+#   (so it is state rather than a constant)
+own_account = 'self' # pylint: disable=C0103
+
+# stage timings (accumulated, in milliseconds) and counts
+TIMING_METRICS = ['InventoryTime', 'ClassificationTime', 'StartTime', 'StopTime', 'HibernateTime', 'TotalTime', 'RateLimiterWaitTime']
+COUNT_METRICS = ['PagesFetched', 'InstancesSeen', 'StartDue', 'StopDue', 'ApiCalls', 'Throttles', 'Failures']
+
+DIMENSIONS = ['Account', 'Region', 'HourPhase']
+
+# EMF records are written as bare JSON lines, bypassing the JSON log formatter (which would wrap them)
+emf_logger = logging.getLogger('ec2_state_mgmt.metrics')
+emf_logger.propagate = False
+emf_logger.setLevel(logging.INFO)
+if not emf_logger.handlers:
+    emf_logger.addHandler(logging.StreamHandler(sys.stdout))
+
+_local = threading.local()
+
+class ScopeMetrics:
+    '''
+    Collects the stage timings and counts of processing a single scope.
+    Thread-safe, as a scope's action batches may be sent from other threads.
+    '''
+    def __init__(self, account, region, hour_phase):
+        self.dimensions = {'Account': account, 'Region': region, 'HourPhase': hour_phase}
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, value):
+        ''' Adds to a metric. '''
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name):
+        ''' Times a stage, adding its duration to the named timing metric. '''
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - started_at) * 1000)
+
+    def to_emf(self, namespace, timestamp=None):
+        ''' Renders the metrics as an EMF record. '''
+        with self.lock:
+            values = dict(self.values)
+
+        metrics = [{'Name': name, 'Unit': 'Milliseconds'} for name in TIMING_METRICS if name in values]
+        metrics += [{'Name': name, 'Unit': 'Count'} for name in COUNT_METRICS if name in values]
+
+        return {
+            '_aws': {
+                'Timestamp': int((timestamp if timestamp is not None else time.time()) * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace,
+                    'Dimensions': [DIMENSIONS[:2], DIMENSIONS],
+                    'Metrics': metrics
+                }]
+            },
+            **self.dimensions,
+            **{name: round(value, 3) if isinstance(value, float) else value for name, value in values.items()}
+        }
+
+class NullMetrics:
+    ''' Discards metrics recorded outside of scope processing (e.g. in direct calls from tests). '''
+    def add(self, name, value):
+        ''' Discards a metric. '''
+
+    @contextmanager
+    def stage(self, _name):
+        ''' Runs a stage untimed. '''
+        yield
+
+NULL_METRICS = NullMetrics()
+
+def current():
+    ''' Retrieves the metrics of the scope being processed by the current thread. '''
+    return getattr(_local, 'metrics', None) or NULL_METRICS
+
+@contextmanager
+def recording(metrics):
+    ''' Records metrics of the current thread into the given ScopeMetrics. '''
+    previous = getattr(_local, 'metrics', None)
+    _local.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _local.metrics = previous
+
+def emit(metrics, namespace=DEFAULT_NAMESPACE):
+    ''' Writes a scope's metrics out as a single EMF record. '''
+    emf_logger.info(json.dumps(metrics.to_emf(namespace)))
+
+def emit_value(name, value, dimensions, namespace=DEFAULT_NAMESPACE, unit='Milliseconds'):
+    ''' Writes a single metric value out as its own EMF record, with its own dimensions. '''
+    emf_logger.info(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{'Namespace': namespace, 'Dimensions': [list(dimensions)], 'Metrics': [{'Name': name, 'Unit': unit}]}]
+        },
+        **dimensions,
+        name: round(value, 3)
+    }))
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Token bucket rate limiting of AWS API calls, with adaptive, jittered backoff on throttling
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger()
+
+# error codes AWS uses to signal that a caller is being throttled
+THROTTLING_ERROR_CODES = frozenset([
+    'RequestLimitExceeded',
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException'
+])
+
+class RateLimiter: # pylint: disable=R0902
+    '''
+    Token bucket rate limiter, shared by every client making calls against the same API rate limit.
+
+    Tokens refill at the fill rate up to the burst capacity; callers take one token per request, waiting when none are left.
+    Each throttle cuts the fill rate (down to min_rate), and each successful call recovers part of it, so the
+    limiter settles just under whatever rate AWS is actually allowing.  Throttled requests are retried after
+    an exponential backoff with full jitter, so concurrent callers do not retry in lockstep.
+    '''
+    decrease_factor = 0.5
+    recovery_step = 0.05
+    min_rate = 1.0
+    base_delay = 0.1
+    max_delay = 5.0
+    max_attempts = 8
+
+    def __init__(self, rate, burst=None):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.updated_at = None
+        self.lock = threading.Lock()
+        # clock and sleep are swapped out by tests, to run the limiter without waiting
+        self.clock = time.monotonic
+        self.sleep = time.sleep
+        self.metrics = self._empty_metrics()
+
+    @staticmethod
+    def _empty_metrics():
+        return {'calls': 0, 'throttles': 0, 'wait_seconds': 0.0}
+
+    def acquire(self):
+        '''
+        Takes a token, sleeping until the bucket has refilled enough if it is empty; returns the time spent waiting.
+        Tokens are reserved up front, so concurrent callers queue up behind each other rather than racing.
+        '''
+        with self.lock:
+            now = self.clock()
+            if self.updated_at is not None:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+            self.metrics['calls'] += 1
+            self.metrics['wait_seconds'] += wait
+
+        if wait:
+            self.sleep(wait)
+
+        return wait
+
+    def record_success(self):
+        ''' Recovers part of the fill rate after a successful call. '''
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * self.recovery_step)
+
+    def record_throttle(self):
+        ''' Cuts the fill rate after a throttled call. '''
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self.metrics['throttles'] += 1
+
+        logger.debug(f'Request throttled, rate limit reduced to {self.rate:.1f} calls/s')
+
+    def get_backoff(self, attempt):
+        ''' Picks the (full jitter) delay before retrying a request throttled on the given attempt, counting it as time spent waiting. '''
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        with self.lock:
+            self.metrics['wait_seconds'] += delay
+
+        return delay
+
+    def pop_metrics(self):
+        ''' Returns the calls made, throttles absorbed and time spent waiting since the last call, resetting them. '''
+        with self.lock:
+            metrics, self.metrics = self.metrics, self._empty_metrics()
+
+        return metrics
+
+    def before_send(self, **_kwargs):
+        ''' botocore before-send handler; paces every request sent. '''
+        self.acquire()
+
+    def needs_retry(self, response=None, attempts=None, **_kwargs):
+        '''
+        botocore needs-retry handler; adapts the fill rate to each response, and decides on the retries of throttled requests.
+        Returns the backoff delay, False once out of attempts, or None to leave any other response to botocore's own retry handler.
+        '''
+        if response is None:
+            return None
+
+        http_response, parsed = response
+        if parsed.get('Error', {}).get('Code') not in THROTTLING_ERROR_CODES:
+            if http_response.status_code < 400:
+                self.record_success()
+            return None
+
+        self.record_throttle()
+        if attempts >= self.max_attempts:
+            return False
+
+        return self.get_backoff(attempts)
+
+def attach_rate_limiter(client, limiter):
+    '''
+    Routes every request (retries included) a botocore client sends through a rate limiter, and takes over
+    its retries of throttled requests.  Clients without an event system (e.g. test doubles) are left untouched.
+    '''
+    events = getattr(getattr(client, 'meta', None), 'events', None)
+    if events is None:
+        return
+
+    service = client.meta.service_model.service_id.hyphenize()
+    events.register(f'before-send.{service}', limiter.before_send, unique_id=f'rate-limiter-send-{id(limiter)}')
+    # registered first, so the limiter's backoff is used ahead of botocore's own retry handler
+    events.register_first(f'needs-retry.{service}', limiter.needs_retry, unique_id=f'rate-limiter-retry-{id(limiter)}')
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Shared runtime of the lambda and its execution engines: settings, the boto3 session and its clients, assumed roles,
+#   and the per-scope state of the current invocation
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+import logging
+import threading
+from os import environ
+
+from classify import ACTION_HIBERNATE, ACTION_START, ACTION_STOP
+from continuation import Continuation, DeadlineReached
+import hibernation
+import metrics
+from rate_limiter import RateLimiter, attach_rate_limiter
+import tracing
+
+LAMBDA_NAME = 'ec2-state-mgmt'
+logger = logging.getLogger()
+
+# a single session is shared by every region, with a connection pool sized for concurrent region processing.
+#   the session (and boto3 itself) is only loaded on first use, to keep cold starts cheap; session and client_config
+#   are assigned then by get_session, so they are state rather than constants.
+MAX_POOL_CONNECTIONS = int(environ.get('STATE_MGMT_MAX_POOL_CONNECTIONS') or 25)
+session = None # pylint: disable=C0103
+client_config = None # pylint: disable=C0103
+session_lock = threading.RLock()
+ec2_resources = {}
+clients = {}
+
+# assumed role credentials (and the resources built from them) survive across warm invocations
+assumed_roles = {}
+assumed_roles_lock = threading.Lock()
+
+# deadline and deferred work of the current invocation; never reaches its deadline outside of a checkpointed invocation
+continuation = Continuation()
+
+# metrics and decision logs of the scopes being processed, until they are collected
+scope_metrics = {}
+scope_decisions = {}
+
+# EC2 API rate limiters are kept per scope (region, or account/region), as EC2 rate limits are per account and region
+rate_limiters = {}
+
+# assumed role credentials are refreshed once they are this close to expiring
+CREDENTIAL_REFRESH_MARGIN = timedelta(minutes=5)
+
+# EC2 API calls are paced per scope to this many per second, with bursts of up to this many calls
+DEFAULT_EC2_RATE_LIMIT = 20
+DEFAULT_EC2_BURST = 100
+
+# how each action reads in logs
+ACTION_VERBS = {ACTION_START: 'Starting', ACTION_STOP: 'Stopping', ACTION_HIBERNATE: 'Hibernating'}
+
+# error codes which are caused by individual instance IDs within a batch;
+#   batches failing with one of these are bisected so the healthy instances still get actioned
+BISECTABLE_ERROR_CODES = [
+    'IncorrectInstanceState',
+    'IncorrectState',
+    'InsufficientInstanceCapacity',
+    'InvalidInstanceID',
+    'InvalidInstanceID.Malformed',
+    'InvalidInstanceID.NotFound',
+    'UnsupportedHibernationConfiguration',
+    'UnsupportedOperation'
+]
+
+def get_setting(event, key, env_name, default=None):
+    ''' Resolves a configuration value, preferring the invocation payload over environment variables. '''
+    if isinstance(event, dict) and event.get(key) is not None:
+        return event[key]
+
+    return environ.get(env_name) or default
+
+def get_error_code(ex):
+    ''' Extracts the AWS error code from a botocore ClientError, if there is one. '''
+    return getattr(ex, 'response', {}).get('Error', {}).get('Code')
+
+def _control_batch(ec2_client, action, instance_ids):
+    try:
+        if action == ACTION_START:
+            ec2_client.start_instances(InstanceIds=instance_ids)
+        else:
+            ec2_client.stop_instances(InstanceIds=instance_ids, **({'Hibernate': True} if action == ACTION_HIBERNATE else {}))
+        hibernation.tag_actioned(ec2_client, action, instance_ids)
+
+        return 0
+    except Exception as ex: # pylint: disable=W0703
+        if len(instance_ids) == 1 and action == ACTION_HIBERNATE and get_error_code(ex) in hibernation.FALLBACK_ERROR_CODES:
+            logger.warning(f'Instance {instance_ids[0]} cannot be hibernated, stopping it instead')
+            return _control_batch(ec2_client, ACTION_STOP, instance_ids)
+
+        bisectable = get_error_code(ex) in BISECTABLE_ERROR_CODES
+        if len(instance_ids) == 1 or not bisectable:
+            for instance_id in instance_ids:
+                logger.error(f'Failed to {action} instance {instance_id}', exc_info=ex)
+
+            return len(instance_ids)
+
+        logger.warning(f'Failed to {action} batch of {len(instance_ids)} instances, splitting batch and retrying')
+
+        middle = len(instance_ids) // 2
+        return (_control_batch(ec2_client, action, instance_ids[:middle])
+            + _control_batch(ec2_client, action, instance_ids[middle:]))
+
+def send_batch(ec2_client, action, batch):
+    '''
+    Sends a single StartInstances/StopInstances batch, traced as its own subsegment.
+    Returns the number of instances which could not be actioned.
+    '''
+    logger.info(f'{ACTION_VERBS[action]} instances {", ".join(batch)}')
+    with tracing.subsegment(f'{action}_batch', action=action, batch_size=len(batch)) as trace:
+        failure_count = _control_batch(ec2_client, action, batch)
+        trace.put_annotation('failed', failure_count)
+
+    return failure_count
+
+def collect_region(region, future):
+    '''
+    Collects the outcome of a region's (concurrent.futures or asyncio) processing future,
+    deferring its remaining work if the deadline was reached.
+    Returns the region's instance failure count, and whether the region as a whole failed.
+    '''
+    failure_count, failed = 0, False
+    try:
+        failure_count = future.result()
+    except DeadlineReached as ex:
+        logger.warning(f'Invocation deadline reached, deferring the remaining work in {region}')
+        failure_count = ex.failure_count
+        continuation.defer(region, ex.pending)
+    except Exception as ex: # pylint: disable=W0703
+        logger.error(f'Failed to process region {region}', exc_info=ex)
+        failed = True
+
+    limiter_metrics = log_rate_limiter_metrics(region)
+
+    decision_log = scope_decisions.pop(region, None)
+    if decision_log is not None:
+        logger.info('Decision summary for %s', region, extra={'decisions': decision_log.to_record()})
+
+    recorder = scope_metrics.pop(region, None)
+    if recorder is not None and str(environ.get('STATE_MGMT_METRICS') or 'true').lower() == 'true':
+        recorder.add('Failures', failure_count)
+        if limiter_metrics is not None:
+            recorder.add('ApiCalls', limiter_metrics['calls'])
+            recorder.add('Throttles', limiter_metrics['throttles'])
+            recorder.add('RateLimiterWaitTime', limiter_metrics['wait_seconds'] * 1000)
+        metrics.emit(recorder, environ.get('STATE_MGMT_METRICS_NAMESPACE') or metrics.DEFAULT_NAMESPACE)
+
+    return failure_count, failed
+
+def get_session():
+    ''' Retrieves the shared boto3 session, loading boto3 on first use. '''
+    global session, client_config # pylint: disable=W0603
+
+    with session_lock:
+        if session is None:
+            import boto3 # pylint: disable=C0415
+            from botocore.config import Config # pylint: disable=C0415
+
+            client_config = Config(max_pool_connections=MAX_POOL_CONNECTIONS)
+            session = boto3.session.Session()
+
+        return session
+
+def build_resource(service, region, credentials=None, kind='resource'):
+    ''' Builds a resource (or, of kind "client", a client) on the shared session, optionally using explicitly provided credentials. '''
+    kwargs = {}
+    if credentials:
+        kwargs = {
+            'aws_access_key_id': credentials['AccessKeyId'],
+            'aws_secret_access_key': credentials['SecretAccessKey'],
+            'aws_session_token': credentials['SessionToken']
+        }
+
+    # sessions are not thread safe, so resource creation is serialized
+    with session_lock:
+        return getattr(get_session(), kind)(service, region_name=region, config=client_config, **kwargs)
+
+def get_rate_limiter(scope):
+    ''' Retrieves the (cached) EC2 API rate limiter of a scope, or None if rate limiting is disabled. '''
+    rate = float(environ.get('STATE_MGMT_EC2_RATE_LIMIT') or DEFAULT_EC2_RATE_LIMIT)
+    if rate <= 0:
+        return None
+
+    with session_lock:
+        if scope not in rate_limiters:
+            rate_limiters[scope] = RateLimiter(rate, float(environ.get('STATE_MGMT_EC2_BURST') or DEFAULT_EC2_BURST))
+
+        return rate_limiters[scope]
+
+def build_ec2_resource(scope, region, credentials=None):
+    ''' Builds an EC2 resource, with every call it makes paced by the scope's rate limiter. '''
+    resource = build_resource('ec2', region, credentials)
+
+    limiter = get_rate_limiter(scope)
+    if limiter is not None:
+        attach_rate_limiter(resource.meta.client, limiter)
+
+    return resource
+
+def log_rate_limiter_metrics(scope):
+    '''
+    Reports (and resets) the calls made, throttles absorbed and time spent waiting by a scope's rate limiter.
+    Returns them, or None if the scope has no rate limiter.
+    '''
+    limiter = rate_limiters.get(scope)
+    if limiter is None:
+        return None
+
+    limiter_metrics = limiter.pop_metrics()
+    if limiter_metrics['calls']:
+        logger.info(f'EC2 API calls in {scope}: {limiter_metrics["calls"]} calls, {limiter_metrics["throttles"]} throttles absorbed, '
+            + f'{limiter_metrics["wait_seconds"]:.2f}s spent waiting on the rate limiter')
+
+    return limiter_metrics
+
+def get_client(service):
+    ''' Retrieves the (cached) client for a service in the lambda's own account and region, creating it on first use. '''
+    with session_lock:
+        if service not in clients:
+            clients[service] = get_session().client(service, region_name=environ.get('AWS_REGION'), config=client_config)
+
+        return clients[service]
+
+def get_ec2_resource(region):
+    ''' Retrieves the (cached) EC2 resource for a region, built on the shared session and its tuned connection pool. '''
+    if region not in ec2_resources:
+        ec2_resources[region] = build_ec2_resource(region, region)
+
+    return ec2_resources[region]
+
+def get_role_arns(event):
+    ''' Identifies the roles to assume this invocation; an empty list means only the lambda's own account is processed. '''
+    role_arns = get_setting(event, 'role_arns', 'STATE_MGMT_ROLE_ARNS')
+    if not role_arns:
+        return []
+
+    if isinstance(role_arns, str):
+        role_arns = role_arns.split(',')
+
+    return list(dict.fromkeys(role_arn.strip() for role_arn in role_arns if role_arn.strip()))
+
+def get_assumed_role(role_arn):
+    ''' Retrieves the cached credentials for a role, only assuming the role again once the credentials are close to expiry. '''
+    with assumed_roles_lock:
+        cached = assumed_roles.get(role_arn)
+
+    if cached and cached['expiration'] - datetime.now(dt_timezone.utc) > CREDENTIAL_REFRESH_MARGIN:
+        return cached
+
+    logger.info(f'Assuming role {role_arn}')
+
+    credentials = get_client('sts').assume_role(RoleArn=role_arn, RoleSessionName=LAMBDA_NAME)['Credentials']
+    entry = {
+        'credentials': credentials,
+        'expiration': credentials['Expiration'],
+        'resources': {}
+    }
+
+    with assumed_roles_lock:
+        assumed_roles[role_arn] = entry
+
+    return entry
+
+def get_account_resources(role_arn, regions):
+    ''' Retrieves the EC2 resources of an account's regions via an assumed role, keyed by their account/region scope. '''
+    account_id = role_arn.split(':')[4]
+    entry = get_assumed_role(role_arn)
+
+    resources = {}
+    for region in regions:
+        if region not in entry['resources']:
+            entry['resources'][region] = build_ec2_resource(f'{account_id}/{region}', region, entry['credentials'])
+        resources[f'{account_id}/{region}'] = entry['resources'][region]
+
+    return resources
+
+def get_scope_role(scope, event=None):
+    '''
+    Retrieves the assumed role (credentials and cached resources) of an account/region scope, or None for the lambda's own account.
+    The account's role is looked up among the invocation's role ARNs (from its payload, or the environment), then the roles already assumed.
+    '''
+    if '/' not in scope:
+        return None
+
+    account_id = scope.split('/')[0]
+    with assumed_roles_lock:
+        role_arns = get_role_arns(event) + list(assumed_roles)
+    for role_arn in role_arns:
+        if role_arn.split(':')[4] == account_id:
+            return get_assumed_role(role_arn)
+
+    raise ValueError(f'No role configured for account {account_id}')
+
+def get_scope_ec2_resource(scope, event=None):
+    ''' Retrieves the EC2 resource for a scope, assuming the account's role (see get_scope_role) where needed. '''
+    entry = get_scope_role(scope, event)
+    if entry is None:
+        return get_ec2_resource(scope)
+
+    region = scope.split('/')[1]
+    if region not in entry['resources']:
+        entry['resources'][region] = build_ec2_resource(scope, region, entry['credentials'])
+
+    return entry['resources'][region]
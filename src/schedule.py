@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Compilation of ec2_start/ec2_stop schedules into quarter-hour slots
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+from functools import lru_cache
+import logging
+import re
+from os import environ
+
+logger = logging.getLogger()
+
+TIME_PATTERN = re.compile('^([01][0-9]|2[0-3]):[0-5][0-9]$')
+
+# schedules are tracked as quarter-hour slots; slot 0 is 00:00-00:14, slot 95 is 23:45-23:59
+SLOTS_PER_HOUR = 4
+SLOTS_PER_DAY = 24 * SLOTS_PER_HOUR
+
+# number of distinct ec2_start/ec2_stop tag values kept parsed in memory
+SCHEDULE_CACHE_SIZE = int(environ.get('STATE_MGMT_SCHEDULE_CACHE_SIZE') or 1024)
+
+# tag AWS sets on the instances of an Auto Scaling group; these are never scheduled individually, as the group would replace them
+ASG_MEMBER_TAG = 'aws:autoscaling:groupName'
+
+@lru_cache(maxsize=SCHEDULE_CACHE_SIZE)
+def parse_schedule_slot(time_value):
+    '''
+    Parses an ec2_start or ec2_stop value down to its quarter-hour slot of the day, or None if incorrectly formatted.
+    Results are cached, so unchanged tag values are only ever validated once per container.
+    '''
+    if not re.match(TIME_PATTERN, time_value):
+        return None
+
+    tag_hour, tag_minute = time_value.split(':')
+    if int(tag_minute) % 15:
+        # mirrors ec2_state_mgmt.check_configured_time; additional specificity is rounded down to the containing quarter hour
+        logger.warning(f'Invalid minute specifier in schedule time {time_value} (assuming :{int(tag_minute) // 15 * 15:02})')
+
+    return int(tag_hour) * SLOTS_PER_HOUR + int(tag_minute) // 15
+
+def get_schedule(tags):
+    '''
+    Compiles an instance's ec2_start/ec2_stop tags down to a (start_slot, stop_slot, start_on_weekends) schedule.
+    Returns None if the instance has no valid schedule tags, is a member of an Auto Scaling group, or carries an ec2_schedule tag
+    (which takes precedence over ec2_start/ec2_stop in classification).
+    '''
+    if ASG_MEMBER_TAG in tags or 'ec2_schedule' in tags:
+        return None
+
+    start_slot = parse_schedule_slot(tags['ec2_start']) if 'ec2_start' in tags else None
+    stop_slot = parse_schedule_slot(tags['ec2_stop']) if 'ec2_stop' in tags else None
+    if start_slot is None and stop_slot is None:
+        return None
+
+    return start_slot, stop_slot, tags.get('ec2_start_on_weekends', '').lower() == 'true'
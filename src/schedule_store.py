@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Persistent store of instance schedules, kept up to date from EC2 state-change and tag-change events
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+import logging
+import random
+import time
+
+logger = logging.getLogger()
+
+# DynamoDB BatchWriteItem accepts at most this many requests per call
+BATCH_WRITE_SIZE = 25
+
+# sort key of the per-scope item tracking the last full reconciliation
+RECONCILED_ITEM_ID = '#reconciled'
+
+class UnprocessedItemsError(Exception):
+    ''' Raised when DynamoDB keeps leaving batch write requests unprocessed (throttled) after every retry. '''
+
+class MemoryScheduleStore:
+    '''
+    In-memory schedule store, for tests and local runs.
+
+    Schedules are (start_slot, stop_slot, start_on_weekends) tuples, with either slot possibly None.
+    Scopes partition the store, typically one per region.
+    '''
+    def __init__(self):
+        self.items = {}
+        self.reconciled = {}
+
+    def put(self, scope, instance_id, schedule, state):
+        ''' Records (or replaces) an instance's schedule and last known state. '''
+        self.items[(scope, instance_id)] = (schedule, state)
+
+    def update_state(self, scope, instance_id, state):
+        ''' Updates the last known state of an instance; returns False if the instance is not in the store. '''
+        if (scope, instance_id) not in self.items:
+            return False
+
+        self.items[(scope, instance_id)] = (self.items[(scope, instance_id)][0], state)
+        return True
+
+    def delete(self, scope, instance_id):
+        ''' Drops an instance from the store. '''
+        self.items.pop((scope, instance_id), None)
+
+    def due(self, scope, slot, is_weekend):
+        ''' Returns the IDs of the stopped instances due to start, and the running instances due to stop, in the given slot. '''
+        start_ids = []
+        stop_ids = []
+        for (item_scope, instance_id), ((start_slot, stop_slot, start_on_weekends), state) in self.items.items():
+            if item_scope != scope:
+                continue
+
+            if start_slot == slot and state == 'stopped' and (start_on_weekends or not is_weekend):
+                start_ids.append(instance_id)
+            if stop_slot == slot and state == 'running':
+                stop_ids.append(instance_id)
+
+        return start_ids, stop_ids
+
+    def replace_scope(self, scope, entries):
+        ''' Replaces every instance in a scope with the given {instance_id: (schedule, state)} entries, marking it reconciled. '''
+        for key in [key for key in self.items if key[0] == scope]:
+            del self.items[key]
+
+        for instance_id, (schedule, state) in entries.items():
+            self.put(scope, instance_id, schedule, state)
+
+        self.reconciled[scope] = time.time()
+
+    def get_reconciled_at(self, scope):
+        ''' Returns the epoch time of the scope's last full reconciliation, or None if it has never been reconciled. '''
+        return self.reconciled.get(scope)
+
+class DynamoDBScheduleStore:
+    '''
+    DynamoDB-backed schedule store.
+
+    The table is keyed on "scope" (partition) and "instance_id" (sort), with two global secondary indexes,
+    "start_key-index" and "stop_key-index", partitioned on the "start_key"/"stop_key" attributes ("<scope>#<slot>")
+    and projecting at least "state" and "start_on_weekends".  A tick therefore only ever reads its own slot.
+
+    Batch write requests DynamoDB leaves unprocessed (when throttled) are retried after an exponential backoff with full jitter.
+    '''
+    base_delay = 0.05
+    max_delay = 5.0
+    max_attempts = 8
+
+    def __init__(self, dynamodb_client, table_name):
+        self.client = dynamodb_client
+        self.table_name = table_name
+        # sleep is swapped out by tests, to retry without waiting
+        self.sleep = time.sleep
+
+    @staticmethod
+    def _to_item(scope, instance_id, schedule, state):
+        start_slot, stop_slot, start_on_weekends = schedule
+        item = {
+            'scope': {'S': scope},
+            'instance_id': {'S': instance_id},
+            'state': {'S': state},
+            'start_on_weekends': {'BOOL': bool(start_on_weekends)}
+        }
+        if start_slot is not None:
+            item['start_slot'] = {'N': str(start_slot)}
+            item['start_key'] = {'S': f'{scope}#{start_slot}'}
+        if stop_slot is not None:
+            item['stop_slot'] = {'N': str(stop_slot)}
+            item['stop_key'] = {'S': f'{scope}#{stop_slot}'}
+
+        return item
+
+    @staticmethod
+    def _key(scope, instance_id):
+        return {'scope': {'S': scope}, 'instance_id': {'S': instance_id}}
+
+    def put(self, scope, instance_id, schedule, state):
+        ''' Records (or replaces) an instance's schedule and last known state. '''
+        self.client.put_item(TableName=self.table_name, Item=self._to_item(scope, instance_id, schedule, state))
+
+    def update_state(self, scope, instance_id, state):
+        ''' Updates the last known state of an instance; returns False if the instance is not in the store. '''
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key=self._key(scope, instance_id),
+                UpdateExpression='SET #state = :state',
+                ConditionExpression='attribute_exists(instance_id)',
+                ExpressionAttributeNames={'#state': 'state'},
+                ExpressionAttributeValues={':state': {'S': state}}
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+        return True
+
+    def delete(self, scope, instance_id):
+        ''' Drops an instance from the store. '''
+        self.client.delete_item(TableName=self.table_name, Key=self._key(scope, instance_id))
+
+    def _query(self, **kwargs):
+        for page in self.client.get_paginator('query').paginate(TableName=self.table_name, **kwargs):
+            yield from page['Items']
+
+    def due(self, scope, slot, is_weekend):
+        ''' Returns the IDs of the stopped instances due to start, and the running instances due to stop, in the given slot. '''
+        start_ids = [
+            item['instance_id']['S'] for item in self._query(
+                IndexName='start_key-index',
+                KeyConditionExpression='start_key = :key',
+                ExpressionAttributeValues={':key': {'S': f'{scope}#{slot}'}}
+            )
+            if item['state']['S'] == 'stopped' and (item['start_on_weekends']['BOOL'] or not is_weekend)
+        ]
+        stop_ids = [
+            item['instance_id']['S'] for item in self._query(
+                IndexName='stop_key-index',
+                KeyConditionExpression='stop_key = :key',
+                ExpressionAttributeValues={':key': {'S': f'{scope}#{slot}'}}
+            )
+            if item['state']['S'] == 'running'
+        ]
+
+        return start_ids, stop_ids
+
+    def _batch_write(self, requests):
+        for offset in range(0, len(requests), BATCH_WRITE_SIZE):
+            pending = {self.table_name: requests[offset:offset + BATCH_WRITE_SIZE]}
+            for attempt in range(self.max_attempts):
+                if attempt:
+                    self.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+
+                pending = self.client.batch_write_item(RequestItems=pending).get('UnprocessedItems')
+                if not pending:
+                    break
+            else:
+                raise UnprocessedItemsError(f'{len(pending[self.table_name])} batch write requests to {self.table_name} '
+                    + f'were still unprocessed after {self.max_attempts} attempts')
+
+    def replace_scope(self, scope, entries):
+        ''' Replaces every instance in a scope with the given {instance_id: (schedule, state)} entries, marking it reconciled. '''
+        existing_ids = {
+            item['instance_id']['S'] for item in self._query(
+                KeyConditionExpression='#scope = :scope',
+                ExpressionAttributeNames={'#scope': 'scope'},
+                ExpressionAttributeValues={':scope': {'S': scope}},
+                ProjectionExpression='instance_id'
+            )
+        }
+        existing_ids.discard(RECONCILED_ITEM_ID)
+
+        requests = [{'PutRequest': {'Item': self._to_item(scope, instance_id, schedule, state)}}
+            for instance_id, (schedule, state) in entries.items()]
+        requests.extend({'DeleteRequest': {'Key': self._key(scope, instance_id)}} for instance_id in existing_ids - set(entries))
+        requests.append({'PutRequest': {'Item': {
+            **self._key(scope, RECONCILED_ITEM_ID),
+            'reconciled_at': {'N': str(time.time())}
+        }}})
+
+        self._batch_write(requests)
+
+        logger.info(f'Reconciled schedule store scope {scope}: {len(entries)} scheduled instances, '
+            + f'{len(existing_ids - set(entries))} stale instances removed')
+
+    def get_reconciled_at(self, scope):
+        ''' Returns the epoch time of the scope's last full reconciliation, or None if it has never been reconciled. '''
+        item = self.client.get_item(TableName=self.table_name, Key=self._key(scope, RECONCILED_ITEM_ID), ConsistentRead=True).get('Item')
+
+        return float(item['reconciled_at']['N']) if item else None
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# Persisted timing wheel of instance schedules, keyed by (weekday/weekend, quarter-hour slot)
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+logger = logging.getLogger()
+
+DAY_TYPE_WEEKDAY = 'weekday'
+DAY_TYPE_WEEKEND = 'weekend'
+
+# the instance index of a scope is spread across this many shard documents, keyed on a hash of the instance ID,
+#   keeping each document far below the backends' item size limits (400 KB on DynamoDB) on large fleets.
+#   changing it orphans the existing shards, so the wheel must be rebuilt afterwards.
+INDEX_SHARDS = 64
+
+# conditional writes losing to concurrent updates are retried (from a fresh read) up to this many times
+MAX_WRITE_ATTEMPTS = 10
+
+class ConcurrentUpdateError(Exception):
+    ''' Raised when a conditional write keeps losing to concurrent updates of the same document. '''
+
+class FileWheelBackend:
+    '''
+    Stores timing wheel documents as JSON files in a local directory, for tests and local runs.
+    Conditional writes compare the file's content, and are only atomic within a single process.
+    '''
+    lock = threading.Lock()
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, *key.split('/')) + '.json'
+
+    def _read(self, key):
+        try:
+            with open(self._path(key), encoding='utf-8') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def get(self, key):
+        ''' Reads a document, or returns None if it does not exist. '''
+        content = self._read(key)
+
+        return json.loads(content) if content is not None else None
+
+    def get_versioned(self, key):
+        ''' Reads a document and its version, or returns (None, None) if it does not exist. '''
+        content = self._read(key)
+
+        return (json.loads(content), content) if content is not None else (None, None)
+
+    def put(self, key, document):
+        ''' Writes a document. '''
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(document, file)
+
+    def put_if(self, key, document, version):
+        ''' Writes a document only if it is still at the given version (None: does not exist); returns whether it was written. '''
+        with self.lock:
+            if self._read(key) != version:
+                return False
+
+            self.put(key, document)
+
+        return True
+
+class S3WheelBackend:
+    ''' Stores timing wheel documents as JSON objects in an S3 bucket, versioned by their ETags. '''
+    def __init__(self, s3_client, bucket, prefix=''):
+        self.client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get(self, key):
+        ''' Reads a document, or returns None if it does not exist. '''
+        return self.get_versioned(key)[0]
+
+    def get_versioned(self, key):
+        ''' Reads a document and its version, or returns (None, None) if it does not exist. '''
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=f'{self.prefix}{key}.json')
+        except self.client.exceptions.NoSuchKey:
+            return None, None
+
+        return json.loads(response['Body'].read()), response.get('ETag')
+
+    def put(self, key, document, **conditions):
+        ''' Writes a document. '''
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=f'{self.prefix}{key}.json',
+            Body=json.dumps(document).encode('utf-8'),
+            ContentType='application/json',
+            **conditions
+        )
+
+    def put_if(self, key, document, version):
+        ''' Writes a document only if it is still at the given version (None: does not exist); returns whether it was written. '''
+        try:
+            self.put(key, document, **({'IfMatch': version} if version is not None else {'IfNoneMatch': '*'}))
+        except self.client.exceptions.ClientError as ex:
+            if ex.response.get('Error', {}).get('Code') in ['PreconditionFailed', 'ConditionalRequestConflict']:
+                return False
+            raise
+
+        return True
+
+class DynamoDBWheelBackend:
+    '''
+    Stores timing wheel documents as items (keyed on the string attribute "key") of a DynamoDB table,
+    versioned by the numeric attribute "version".
+    '''
+    def __init__(self, dynamodb_client, table_name):
+        self.client = dynamodb_client
+        self.table_name = table_name
+
+    def get(self, key):
+        ''' Reads a document, or returns None if it does not exist. '''
+        return self.get_versioned(key)[0]
+
+    def get_versioned(self, key):
+        ''' Reads a document and its version, or returns (None, None) if it does not exist. '''
+        item = self.client.get_item(TableName=self.table_name, Key={'key': {'S': key}}, ConsistentRead=True).get('Item')
+        if not item:
+            return None, None
+
+        return json.loads(item['document']['S']), int(item.get('version', {}).get('N', 0))
+
+    def put(self, key, document):
+        ''' Writes a document. '''
+        self.client.put_item(TableName=self.table_name, Item={'key': {'S': key}, 'document': {'S': json.dumps(document)}})
+
+    def put_if(self, key, document, version):
+        ''' Writes a document only if it is still at the given version (None: does not exist); returns whether it was written. '''
+        if version is None:
+            conditions = {'ConditionExpression': 'attribute_not_exists(#key)', 'ExpressionAttributeNames': {'#key': 'key'}}
+        else:
+            # items written unconditionally carry no version attribute, and count as version 0
+            conditions = {
+                'ConditionExpression': 'attribute_not_exists(#version) OR #version = :version',
+                'ExpressionAttributeNames': {'#version': 'version'},
+                'ExpressionAttributeValues': {':version': {'N': str(version)}}
+            }
+
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={'key': {'S': key}, 'document': {'S': json.dumps(document)}, 'version': {'N': str((version or 0) + 1)}},
+                **conditions
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+        return True
+
+class TimingWheel:
+    '''
+    Timing wheel of instance schedules.
+
+    Each (day type, slot) bucket is its own document listing the instances due to start and stop in it,
+    so a tick costs one small read regardless of fleet size.  A per-scope index, sharded across INDEX_SHARDS documents,
+    records every instance's schedule, so that rebuilds only rewrite the buckets of instances whose schedules changed.
+    The time of the scope's last rebuild is kept in a document of its own, so ticks never read the index.
+
+    Index shards and buckets are only written conditionally, on the version they were read at, so concurrent updates
+    (e.g. event handler invocations) never lose each other's changes: the losing write is retried from a fresh read.
+
+    Schedules are (start_slot, stop_slot, start_on_weekends) tuples, with either slot possibly None.
+    '''
+    def __init__(self, backend):
+        self.backend = backend
+
+    @staticmethod
+    def _bucket_key(scope, day_type, slot):
+        return f'{scope}/{day_type}/{slot}'
+
+    @staticmethod
+    def _index_key(scope, shard):
+        return f'{scope}/index/{shard}'
+
+    @staticmethod
+    def _rebuilt_at_key(scope):
+        return f'{scope}/rebuilt_at'
+
+    @staticmethod
+    def _shard(instance_id):
+        return zlib.crc32(instance_id.encode('utf-8')) % INDEX_SHARDS
+
+    @staticmethod
+    def _buckets(schedule):
+        ''' Lists the (day type, slot, action) bucket memberships of a schedule. '''
+        if schedule is None:
+            return []
+
+        start_slot, stop_slot, start_on_weekends = schedule
+        memberships = []
+        if start_slot is not None:
+            memberships.append((DAY_TYPE_WEEKDAY, start_slot, 'start'))
+            if start_on_weekends:
+                memberships.append((DAY_TYPE_WEEKEND, start_slot, 'start'))
+        if stop_slot is not None:
+            memberships.append((DAY_TYPE_WEEKDAY, stop_slot, 'stop'))
+            memberships.append((DAY_TYPE_WEEKEND, stop_slot, 'stop'))
+
+        return memberships
+
+    def read(self, scope, slot, is_weekend):
+        ''' Returns the IDs of the instances scheduled to start and to stop in the given slot. '''
+        bucket = self.backend.get(self._bucket_key(scope, DAY_TYPE_WEEKEND if is_weekend else DAY_TYPE_WEEKDAY, slot)) or {}
+
+        return bucket.get('start', []), bucket.get('stop', [])
+
+    def get_rebuilt_at(self, scope):
+        ''' Returns the epoch time of the scope's last full rebuild, or None if it has never been built. '''
+        return (self.backend.get(self._rebuilt_at_key(scope)) or {}).get('rebuilt_at')
+
+    def read_index(self, scope, instance_ids=None):
+        ''' Returns the {instance_id: schedule} index of a scope, only reading the shards of the given instances if there are any. '''
+        shards = range(INDEX_SHARDS) if instance_ids is None else {self._shard(instance_id) for instance_id in instance_ids}
+
+        index = {}
+        for shard in shards:
+            index.update((self.backend.get(self._index_key(scope, shard)) or {}).get('instances', {}))
+
+        return index
+
+    def _update_shard(self, scope, shard, changes):
+        '''
+        Applies {instance_id: schedule} changes to a single index shard.
+        Returns the (day type, slot) buckets whose membership changed, with the instances changing in each.
+        '''
+        key = self._index_key(scope, shard)
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            document, version = self.backend.get_versioned(key)
+            instances = dict((document or {}).get('instances', {}))
+
+            touched = {}
+            for instance_id, schedule in changes.items():
+                previous = instances.get(instance_id)
+                current = list(schedule) if schedule is not None else None
+                if previous == current:
+                    continue
+
+                for day_type, slot, _ in set(self._buckets(previous)) ^ set(self._buckets(current)):
+                    touched.setdefault((day_type, slot), set()).add(instance_id)
+                if current is not None:
+                    instances[instance_id] = current
+                else:
+                    instances.pop(instance_id, None)
+
+            if instances == (document or {}).get('instances', {}):
+                return {}
+            if self.backend.put_if(key, {'instances': instances}, version):
+                return touched
+
+        raise ConcurrentUpdateError(f'Gave up updating timing wheel index {key} after {MAX_WRITE_ATTEMPTS} conflicting writes')
+
+    def _apply_memberships(self, document, day_type, slot, schedules):
+        ''' Returns a bucket document with the membership of each {instance_id: schedule} instance following its schedule. '''
+        members = {action: set((document or {}).get(action, [])) for action in ['start', 'stop']}
+        for instance_id, schedule in schedules.items():
+            memberships = self._buckets(schedule)
+            for action, member_ids in members.items():
+                if (day_type, slot, action) in memberships:
+                    member_ids.add(instance_id)
+                else:
+                    member_ids.discard(instance_id)
+
+        # the revision is bumped on every write, so that even unchanged buckets fail concurrent conditional writes
+        return {
+            'start': sorted(members['start']),
+            'stop': sorted(members['stop']),
+            'revision': (document or {}).get('revision', 0) + 1
+        }
+
+    def _update_buckets(self, scope, touched):
+        '''
+        Rewrites the membership of the given instances in the given (day type, slot) buckets, following their indexed schedules.
+        The index is read after the buckets it is applied to, so an update racing with another one either sees its index changes,
+        or conflicts with its bucket writes and gets retried.
+        '''
+        pending = touched
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            buckets = {bucket: self.backend.get_versioned(self._bucket_key(scope, *bucket)) for bucket in pending}
+            index = self.read_index(scope, {instance_id for instance_ids in pending.values() for instance_id in instance_ids})
+
+            conflicts = {}
+            for (day_type, slot), instance_ids in pending.items():
+                document, version = buckets[(day_type, slot)]
+                schedules = {instance_id: index.get(instance_id) for instance_id in instance_ids}
+                updated = self._apply_memberships(document, day_type, slot, schedules)
+                if not self.backend.put_if(self._bucket_key(scope, day_type, slot), updated, version):
+                    conflicts[(day_type, slot)] = instance_ids
+
+            if not conflicts:
+                return
+            pending = conflicts
+
+        raise ConcurrentUpdateError(f'Gave up updating {len(pending)} timing wheel buckets of {scope} '
+            + f'after {MAX_WRITE_ATTEMPTS} conflicting writes')
+
+    def update(self, scope, changes, rebuilt_at=None):
+        '''
+        Applies {instance_id: schedule} changes (a None schedule removes the instance) to a scope of the wheel.
+        Only the buckets of instances whose schedules actually changed are rewritten; returns how many were.
+        '''
+        shard_changes = {}
+        for instance_id, schedule in changes.items():
+            shard_changes.setdefault(self._shard(instance_id), {})[instance_id] = schedule
+
+        touched = {}
+        for shard, changes_in_shard in shard_changes.items():
+            for bucket, instance_ids in self._update_shard(scope, shard, changes_in_shard).items():
+                touched.setdefault(bucket, set()).update(instance_ids)
+
+        self._update_buckets(scope, touched)
+
+        if rebuilt_at is not None:
+            self.backend.put(self._rebuilt_at_key(scope), {'rebuilt_at': rebuilt_at})
+
+        return len(touched)
+
+    def rebuild(self, scope, schedules):
+        '''
+        Brings a scope of the wheel in line with the full set of {instance_id: schedule} schedules.
+        Instances missing from the set are removed; only changed instances touch their buckets.
+        '''
+        changes = {instance_id: None for instance_id in self.read_index(scope) if instance_id not in schedules}
+        changes.update(schedules)
+
+        touched = self.update(scope, changes, rebuilt_at=time.time())
+
+        logger.info(f'Rebuilt timing wheel scope {scope}: {len(schedules)} scheduled instances, {touched} buckets rewritten')
+
+        return touched
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+'''
+#
+# cr.imson.co
+#
+# AWS X-Ray tracing: subsegments around the handler's hot paths, and opt-in patching of every botocore call
+#
+# @author Damian Bushong <katana@odios.us>
+#
+'''
+
+from contextlib import contextmanager
+import traceback
+
+# tracing modes:
+# - full: hot path subsegments, plus a subsegment for every botocore call
+# - coarse: hot path subsegments only, for when per-call tracing overhead matters
+# - off: no tracing; the X-Ray SDK is never imported
+XRAY_MODE_FULL = 'full'
+XRAY_MODE_COARSE = 'coarse'
+XRAY_MODE_OFF = 'off'
+XRAY_MODES = [XRAY_MODE_FULL, XRAY_MODE_COARSE, XRAY_MODE_OFF]
+
+# the X-Ray recorder, once tracing is configured (reassigned by configure, so it is state rather than a constant)
+recorder = None # pylint: disable=C0103
+
+class NullSubsegment:
+    ''' Stands in for a subsegment while tracing is off, or outside of any trace. '''
+    def put_annotation(self, key, value):
+        ''' Discards an annotation. '''
+
+NULL_SUBSEGMENT = NullSubsegment()
+
+def get_xray_mode(value):
+    ''' Identifies the tracing mode from a STATE_MGMT_XRAY value; "true" and "false" are accepted for "full" and "off". '''
+    value = (value or XRAY_MODE_OFF).lower()
+    value = {'true': XRAY_MODE_FULL, 'false': XRAY_MODE_OFF}.get(value, value)
+    if value not in XRAY_MODES:
+        raise ValueError(f'Unknown X-Ray mode "{value}"')
+
+    return value
+
+def configure(mode):
+    ''' Configures tracing; the X-Ray SDK is only imported when tracing is on, as it is costly to import and apply on cold starts. '''
+    global recorder # pylint: disable=W0603
+    if mode == XRAY_MODE_OFF:
+        recorder = None
+        return
+
+    from aws_xray_sdk.core import patch_all, xray_recorder # pylint: disable=C0415
+    if mode == XRAY_MODE_FULL:
+        patch_all()
+
+    recorder = xray_recorder
+
+@contextmanager
+def subsegment(name, **annotations):
+    ''' Traces a block as a subsegment of the current trace entity, with the given annotations. '''
+    entity = recorder.begin_subsegment(name) if recorder is not None else None
+    if entity is None:
+        yield NULL_SUBSEGMENT
+        return
+
+    try:
+        for key, value in annotations.items():
+            entity.put_annotation(key, value)
+        yield entity
+    except Exception as ex:
+        entity.add_exception(ex, traceback.extract_tb(ex.__traceback__))
+        raise
+    finally:
+        recorder.end_subsegment()
+
+def wrap(func):
+    ''' Binds a function to the current trace entity, so that its subsegments are nested under it when run on another thread. '''
+    entity = recorder.get_trace_entity() if recorder is not None else None
+    if entity is None:
+        return func
+
+    def traced(*args, **kwargs):
+        recorder.set_trace_entity(entity)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            recorder.clear_trace_entities()
+
+    return traced
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# pylint: skip-file
+
+import unittest
+import unittest.mock
+from datetime import datetime
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
+
+import ec2_state_mgmt
+import asg
+import runtime
+from tests.test_ec2_state_mgmt import MockEc2Resource, MockInstance
+
+ec2_state_mgmt.logger.disabled = True
+ec2_state_mgmt.metrics.emf_logger.disabled = True
+
+NOW = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+
+def make_group(name, min_size, max_size, desired_capacity, tags):
+    return {
+        'AutoScalingGroupName': name,
+        'MinSize': min_size,
+        'MaxSize': max_size,
+        'DesiredCapacity': desired_capacity,
+        'Tags': [{ 'ResourceId': name, 'ResourceType': 'auto-scaling-group', 'Key': key, 'Value': value } for key, value in tags.items()]
+    }
+
+class MockPaginator:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return [{ 'AutoScalingGroups': page } for page in self.pages]
+
+class MockAsgClient:
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    def get_paginator(self, operation):
+        return MockPaginator(self.pages)
+
+    def create_or_update_tags(self, Tags):
+        self.calls.append(('create_or_update_tags', Tags[0]['ResourceId'], Tags[0]['Value']))
+
+    def delete_tags(self, Tags):
+        self.calls.append(('delete_tags', Tags[0]['ResourceId']))
+
+    def update_auto_scaling_group(self, AutoScalingGroupName, **capacity):
+        self.calls.append(('update_auto_scaling_group', AutoScalingGroupName, capacity))
+
+class ProcessGroupsTestCase(unittest.TestCase):
+    def test_scales_due_groups(self):
+        client = MockAsgClient([[
+            make_group('web', 2, 4, 3, { 'ec2_stop': '07:00' }),
+            make_group('batch', 0, 5, 0, { 'ec2_start': '07:00', 'ec2_asg_capacity': '1,5,2' }),
+            make_group('idle', 1, 1, 1, { 'ec2_stop': '18:00' })
+        ]])
+
+        self.assertEqual(asg.process_groups(client, NOW, 4), 0)
+        self.assertCountEqual(client.calls, [
+            ('create_or_update_tags', 'web', '2,4,3'),
+            ('update_auto_scaling_group', 'web', { 'MinSize': 0, 'DesiredCapacity': 0 }),
+            ('update_auto_scaling_group', 'batch', { 'MinSize': 1, 'MaxSize': 5, 'DesiredCapacity': 2 }),
+            ('delete_tags', 'batch')
+        ])
+        # the capacity is recorded before the group is scaled down
+        self.assertLess(client.calls.index(('create_or_update_tags', 'web', '2,4,3')),
+            client.calls.index(('update_auto_scaling_group', 'web', { 'MinSize': 0, 'DesiredCapacity': 0 })))
+
+    def test_missing_capacity(self):
+        client = MockAsgClient([[make_group('batch', 0, 5, 0, { 'ec2_start': '07:00' })]])
+
+        self.assertEqual(asg.process_groups(client, NOW, 4), 0)
+        self.assertEqual(client.calls, [])
+
+    def test_scaled_down_group_not_stopped_again(self):
+        client = MockAsgClient([[make_group('web', 0, 4, 0, { 'ec2_stop': '07:00', 'ec2_asg_capacity': '2,4,3' })]])
+
+        self.assertEqual(asg.process_groups(client, NOW, 4), 0)
+        self.assertEqual(client.calls, [])
+
+class GetAsgClientTestCase(unittest.TestCase):
+    def test_payload_roles(self):
+        role_arn = 'arn:aws:iam::222222222222:role/test'
+        client = MockAsgClient([[]])
+        runtime.assumed_roles.clear()
+        self.addCleanup(runtime.assumed_roles.clear)
+
+        with unittest.mock.patch.object(runtime, 'get_assumed_role', return_value={ 'credentials': None }) as get_assumed_role, \
+            unittest.mock.patch.object(asg, 'build_resource', return_value=client):
+            self.assertIs(asg.get_asg_client('222222222222/us-east-2', { 'role_arns': [role_arn] }), client)
+
+        get_assumed_role.assert_called_once_with(role_arn)
+
+class AsgMemberTestCase(unittest.TestCase):
+    def test_members_not_classified(self):
+        member = MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }, { 'Key': 'aws:autoscaling:groupName', 'Value': 'web' }])
+
+        self.assertEqual(ec2_state_mgmt.classify_zoned_instances([member], NOW), ([], []))
+        self.assertIsNone(ec2_state_mgmt.get_schedule(ec2_state_mgmt.get_instance_tags(member)))
+        self.assertIn('aws:autoscaling:groupName', ec2_state_mgmt.InstanceRecord.from_instance(member).tag_dict)
+
+    def test_process_region(self):
+        client = MockAsgClient([[make_group('web', 2, 4, 3, { 'ec2_stop': '07:00' })]])
+        resource = MockEc2Resource([[
+            MockInstance('i-1', 'running', [{ 'Key': 'ec2_stop', 'Value': '07:00' }]),
+            MockInstance('i-2', 'running', [{ 'Key': 'ec2_stop', 'Value': '07:00' }, { 'Key': 'aws:autoscaling:groupName', 'Value': 'web' }])
+        ]])
+
+        with unittest.mock.patch.object(asg, 'get_asg_client', return_value=client) as get_asg_client:
+            self.assertEqual(ec2_state_mgmt.process_region(resource, { 'auto_scaling_groups': 'true' }, NOW, 'us-east-2'), 0)
+
+        get_asg_client.assert_called_once_with('us-east-2', { 'auto_scaling_groups': 'true' })
+        self.assertEqual(resource.meta.client.calls, [('stop', ['i-1'])])
+        self.assertIn(('update_auto_scaling_group', 'web', { 'MinSize': 0, 'DesiredCapacity': 0 }), client.calls)
+
+    def test_failure_isolated(self):
+        resource = MockEc2Resource([[MockInstance('i-1', 'running', [{ 'Key': 'ec2_stop', 'Value': '07:00' }])]])
+
+        with unittest.mock.patch.object(asg, 'get_asg_client', side_effect=ValueError('No role configured for account 222222222222')):
+            self.assertEqual(ec2_state_mgmt.process_region(resource, { 'auto_scaling_groups': 'true' }, NOW, '222222222222/us-east-2'), 1)
+
+        self.assertEqual(resource.meta.client.calls, [('stop', ['i-1'])])
+
+    def test_disabled_by_default(self):
+        with unittest.mock.patch.object(asg, 'get_asg_client') as get_asg_client:
+            ec2_state_mgmt.process_region(MockEc2Resource([[]]), {}, NOW, 'us-east-2')
+
+        get_asg_client.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
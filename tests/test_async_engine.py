@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# pylint: skip-file
+
+import unittest
+import unittest.mock
+from datetime import datetime
+import sys
+import os
+import threading
+import time
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
+
+import ec2_state_mgmt
+import runtime
+import async_engine
+from tests.test_ec2_state_mgmt import FakeContext, MockEc2Client, MockEc2Resource, MockInstance
+
+ec2_state_mgmt.logger.disabled = True
+ec2_state_mgmt.metrics.emf_logger.disabled = True
+
+NOW = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+
+class SlowEc2Client(MockEc2Client):
+    ''' Mock EC2 client taking a while over each action request, tracking how many are in flight at once. '''
+    def __init__(self, bad_ids=None, latency=0.02):
+        super().__init__(bad_ids)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _control(self, action, InstanceIds):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency)
+            return super()._control(action, InstanceIds)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+def make_resource(count, client=None, state='stopped'):
+    return MockEc2Resource([[
+        MockInstance(f'i-{i}', state, [{ 'Key': 'ec2_start', 'Value': '07:00' }]) for i in range(count)
+    ]], client=client)
+
+class AsyncEngineTestCase(unittest.TestCase):
+    def run_engine(self, resources, event=None, max_scopes=4, max_batches=4):
+        engine = async_engine.AsyncEngine(ec2_state_mgmt.process_region, max_scopes, max_batches)
+        with unittest.mock.patch.object(ec2_state_mgmt, 'engine', engine):
+            return engine.run(event or {}, NOW, resources)
+
+    def test_matches_thread_engine_failures(self):
+        def build():
+            return {
+                'us-east-1': make_resource(6, MockEc2Client(bad_ids=['i-1', 'i-4'])),
+                'us-east-2': make_resource(3),
+                'us-west-2': unittest.mock.Mock(side_effect=RuntimeError)
+            }
+        event = { 'action_batch_size': 2 }
+
+        expected = ec2_state_mgmt.process_regions(build(), event, NOW, 4)
+        failure_count, failed_targets = self.run_engine(build(), event)
+
+        self.assertEqual(failure_count, expected[0])
+        self.assertEqual(failure_count, 2)
+        self.assertEqual(failed_targets, expected[1])
+
+    def test_concurrent_batches(self):
+        client = SlowEc2Client()
+        self.assertEqual(self.run_engine({ 'us-east-2': make_resource(20, client) }, { 'action_batch_size': 2 }, max_batches=3), (0, []))
+
+        self.assertEqual(sorted(instance_id for _, batch in client.calls for instance_id in batch), sorted(f'i-{i}' for i in range(20)))
+        self.assertEqual(len(client.calls), 10)
+        self.assertGreater(client.max_in_flight, 1)
+        self.assertLessEqual(client.max_in_flight, 3)
+
+    def test_batch_limit_spans_scopes(self):
+        client = SlowEc2Client()
+        resources = { region: make_resource(4, client) for region in ['us-east-1', 'us-east-2', 'us-west-2'] }
+
+        self.run_engine(resources, { 'action_batch_size': 1 }, max_batches=2)
+
+        self.assertEqual(len(client.calls), 12)
+        self.assertLessEqual(client.max_in_flight, 2)
+
+    def test_deadline(self):
+        client = SlowEc2Client()
+        continuation = ec2_state_mgmt.Continuation(FakeContext([60000, 60000, 0]))
+
+        with unittest.mock.patch.object(runtime, 'continuation', continuation):
+            self.assertEqual(self.run_engine({ 'us-east-2': make_resource(6, client) }, { 'action_batch_size': 2 }, max_batches=1), (0, []))
+
+        self.assertEqual(client.calls, [('start', ['i-0', 'i-1'])])
+        self.assertEqual(continuation.pending, { 'us-east-2': { 'start': ['i-2', 'i-3', 'i-4', 'i-5'] } })
+
+    def test_accounts(self):
+        role_arns = ['arn:aws:iam::111111111111:role/test', 'arn:aws:iam::222222222222:role/test']
+
+        def get_account_resources(role_arn, regions):
+            if role_arn == role_arns[0]:
+                raise RuntimeError('denied')
+            return { f'222222222222/{region}': make_resource(1, MockEc2Client(bad_ids=['i-0'])) for region in regions }
+
+        engine = async_engine.AsyncEngine(ec2_state_mgmt.process_region, 4, 4)
+        with unittest.mock.patch.object(ec2_state_mgmt, 'engine', engine), \
+            unittest.mock.patch.object(async_engine, 'get_account_resources', side_effect=get_account_resources):
+            failure_count, failed_targets = engine.run({}, NOW, None, role_arns, ['us-east-1', 'us-east-2'])
+
+        self.assertEqual(failure_count, 2)
+        self.assertEqual(failed_targets, ['111111111111'])
+
+class LambdaHandlerAsyncEngineTestCase(unittest.TestCase):
+    def test_handler(self):
+        client = SlowEc2Client(bad_ids=['i-3'])
+        resource = make_resource(8, client)
+
+        with unittest.mock.patch.dict(os.environ, { 'AWS_REGION': 'us-east-2', 'STATE_MGMT_ENGINE': 'asyncio' }), \
+            unittest.mock.patch.object(ec2_state_mgmt, 'datetime', wraps=datetime) as mock_datetime, \
+            unittest.mock.patch.object(ec2_state_mgmt, 'get_ec2_resource', return_value=resource), \
+            unittest.mock.patch.object(ec2_state_mgmt, 'get_client', return_value=unittest.mock.Mock()):
+            mock_datetime.now.return_value = NOW
+
+            with self.assertRaisesRegex(ec2_state_mgmt.RecoveredError, '1 instance control failures'):
+                ec2_state_mgmt.lambda_handler({ 'action_batch_size': 2 }, None)
+
+        self.assertIsNone(ec2_state_mgmt.engine)
+        self.assertEqual(len({instance_id for _, batch in client.calls for instance_id in batch}), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# pylint: skip-file
+
+import unittest
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
+
+import cron_schedule
+
+cron_schedule.logger.disabled = True
+
+def slots(mask):
+    return [slot for slot in range(cron_schedule.SLOTS_PER_WEEK) if mask >> slot & 1]
+
+class CompileCronScheduleTestCase(unittest.TestCase):
+    def test_compile(self):
+        schedule = cron_schedule.compile_cron_schedule('start 30 7 mon-thu; start 0 7 fri; stop 0 18 mon-fri')
+
+        self.assertEqual(slots(schedule.start_mask), [day * 96 + 30 for day in range(4)] + [4 * 96 + 28])
+        self.assertEqual(slots(schedule.stop_mask), [day * 96 + 72 for day in range(5)])
+
+    def test_minute_rounding_and_wildcards(self):
+        schedule = cron_schedule.compile_cron_schedule('stop 20 * sun')
+
+        self.assertEqual(slots(schedule.stop_mask), [6 * 96 + hour * 4 + 1 for hour in range(24)])
+        self.assertEqual(schedule.start_mask, 0)
+
+    def test_fields(self):
+        self.assertEqual(cron_schedule._parse_field('*/15', 0, 59), [0, 15, 30, 45])
+        self.assertEqual(cron_schedule._parse_field('8-18/5', 0, 23), [8, 13, 18])
+        self.assertEqual(cron_schedule._parse_field('1,3,5', 0, 23), [1, 3, 5])
+        self.assertEqual(cron_schedule._parse_days('fri-mon'), [0, 4, 5, 6])
+        self.assertEqual(cron_schedule._parse_days('Sat,SUN'), [5, 6])
+
+    def test_numeric_days(self):
+        # cron numbering; 0 and 7 are both Sunday
+        self.assertEqual(cron_schedule._parse_days('1-5'), [0, 1, 2, 3, 4])
+        self.assertEqual(cron_schedule._parse_days('0'), [6])
+        self.assertEqual(cron_schedule._parse_days('7'), [6])
+        self.assertEqual(cron_schedule._parse_days('*'), list(range(7)))
+
+    def test_invalid(self):
+        values = ['', 'start 0 7', 'boot 0 7 mon', 'start 60 7 mon', 'start 0 24 mon', 'start 0 7 funday', 'start */0 7 mon']
+        for value in values:
+            with self.subTest(value=value):
+                self.assertIsNone(cron_schedule.compile_cron_schedule(value))
+
+class GetCronDueTestCase(unittest.TestCase):
+    def test_due(self):
+        value = 'start 0 7 mon-fri; stop 0 7 sat'
+
+        self.assertEqual(cron_schedule.get_cron_due(value, cron_schedule.get_week_slot(0, 28)), (True, False))
+        self.assertEqual(cron_schedule.get_cron_due(value, cron_schedule.get_week_slot(5, 28)), (False, True))
+        self.assertEqual(cron_schedule.get_cron_due(value, cron_schedule.get_week_slot(6, 28)), (False, False))
+        self.assertEqual(cron_schedule.get_cron_due('bogus', 0), (False, False))
+
+class LatestTransitionsTestCase(unittest.TestCase):
+    def test_compile_slot_schedule(self):
+        schedule = cron_schedule.compile_slot_schedule((28, 72, False))
+
+        self.assertEqual(slots(schedule.start_mask), [day * 96 + 28 for day in range(5)])
+        self.assertEqual(slots(schedule.stop_mask), [day * 96 + 72 for day in range(7)])
+        self.assertEqual(slots(cron_schedule.compile_slot_schedule((28, None, True)).start_mask), [day * 96 + 28 for day in range(7)])
+
+    def test_window(self):
+        schedule = cron_schedule.compile_slot_schedule((28, 72, False))
+
+        # monday 06:00 through 19:45
+        self.assertEqual(cron_schedule.get_latest_transitions(schedule, 24, 56), (4, 48))
+        self.assertEqual(cron_schedule.get_latest_transitions(schedule, 24, 4), (-1, -1))
+
+    def test_window_wraps_around_week(self):
+        schedule = cron_schedule.compile_cron_schedule('start 0 7 mon; stop 0 22 sun')
+
+        # sunday 20:00 through monday 07:00
+        first_slot = cron_schedule.get_week_slot(6, 80)
+        self.assertEqual(cron_schedule.get_latest_transitions(schedule, first_slot, 16 + 29), (44, 8))
+
+
+if __name__ == '__main__':
+    unittest.main()
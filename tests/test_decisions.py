@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# pylint: skip-file
+
+import unittest
+import unittest.mock
+import sys
+import os
+import logging
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
+
+import decisions
+
+class DecisionLogTestCase(unittest.TestCase):
+    def test_to_record(self):
+        decision_log = decisions.DecisionLog()
+        decision_log.record('i-1', 'start_due')
+        decision_log.record('i-2', 'not_due')
+        decision_log.record('i-3', 'not_due')
+        decision_log.add_actioned('start', ['i-1'])
+
+        self.assertEqual(decision_log.to_record(), {
+            'reasons': { 'start_due': 1, 'not_due': 2 },
+            'actioned': { 'start': ['i-1'] }
+        })
+
+    def test_samples(self):
+        decision_log = decisions.DecisionLog(sample_rate=1.0, max_samples=2)
+        for instance_id in ['i-1', 'i-2', 'i-3']:
+            decision_log.record(instance_id, 'unscheduled')
+
+        record = decision_log.to_record()
+        self.assertEqual(record['reasons'], { 'unscheduled': 3 })
+        self.assertEqual(record['samples'], [
+            { 'instance_id': 'i-1', 'reason': 'unscheduled' },
+            { 'instance_id': 'i-2', 'reason': 'unscheduled' }
+        ])
+
+class DecideTestCase(unittest.TestCase):
+    def test_recording(self):
+        decision_log = decisions.DecisionLog()
+        with decisions.recording(decision_log):
+            self.assertIs(decisions.current(), decision_log)
+            self.assertEqual(decisions.decide('i-1', 'start_due', 'start'), 'start')
+
+        self.assertIsNone(decisions.current())
+        self.assertEqual(decision_log.reasons, { 'start_due': 1 })
+
+    def test_detailed(self):
+        with unittest.mock.patch.object(decisions.logger, 'disabled', False), self.assertLogs(decisions.logger, logging.DEBUG) as logs:
+            self.assertIsNone(decisions.decide('i-1', 'weekend'))
+
+        self.assertEqual(logs.records[0].getMessage(),
+            'Instance i-1 is not tagged with "ec2_start_on_weekends" and it is a weekend, ignoring')
+
+    def test_lazy(self):
+        with unittest.mock.patch.object(decisions.logger, 'isEnabledFor', return_value=False), \
+            unittest.mock.patch.object(decisions.logger, 'debug') as debug:
+            decisions.decide('i-1', 'weekend')
+
+        debug.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
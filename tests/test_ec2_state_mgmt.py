@@ -2,23 +2,95 @@
 # pylint: skip-file
 
 import unittest
-from datetime import datetime
+import unittest.mock
+from datetime import datetime, timedelta, timezone
+import json
 import sys
 import os
 import logging
+import subprocess
+import tempfile
+import tracemalloc
+from types import SimpleNamespace
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
 
 import ec2_state_mgmt
+import runtime
+from botocore.exceptions import ClientError
 
 ec2_state_mgmt.logger.disabled = True
+ec2_state_mgmt.metrics.emf_logger.disabled = True
 
 # todo: reduce repetition throughout for filter_start_instance and filter_stop_instance tests
 
 class MockInstance:
-    def __init__(self, id, state, tags):
+    def __init__(self, id, state, tags, hibernation_configured=False):
         self.id = id
         self.state = { 'Name': state }
         self.tags = tags
+        self.hibernation_options = { 'Configured': hibernation_configured }
+
+class MockCollection:
+    def __init__(self, pages):
+        self._pages = pages
+
+    def page_size(self, count):
+        return self
+
+    def pages(self):
+        for page in self._pages:
+            yield page
+
+class MockInstanceCollectionManager:
+    def __init__(self, all_pages, filtered_pages):
+        self.all_pages = all_pages
+        self.filtered_pages = filtered_pages
+        self.filter_calls = []
+
+    def all(self):
+        return MockCollection(self.all_pages)
+
+    def filter(self, Filters):
+        self.filter_calls.append(Filters)
+        return MockCollection(self.filtered_pages[len(self.filter_calls) - 1])
+
+class MockPaginator:
+    def __init__(self, pages, calls):
+        self.pages = pages
+        self.calls = calls
+
+    def paginate(self, **kwargs):
+        self.calls.append(kwargs)
+        return iter(self.pages)
+
+class MockEc2Client:
+    def __init__(self, bad_ids=None, error_code='IncorrectInstanceState', describe_pages=None):
+        self.bad_ids = bad_ids or []
+        self.error_code = error_code
+        self.describe_pages = describe_pages or []
+        self.describe_calls = []
+        self.calls = []
+
+    def get_paginator(self, operation):
+        assert operation == 'describe_instances'
+        return MockPaginator(self.describe_pages, self.describe_calls)
+
+    def _control(self, action, InstanceIds):
+        self.calls.append((action, list(InstanceIds)))
+        if any(instance_id in self.bad_ids for instance_id in InstanceIds):
+            raise ClientError({ 'Error': { 'Code': self.error_code, 'Message': 'mock failure' } }, f'{action.title()}Instances')
+        return {}
+
+    def start_instances(self, InstanceIds):
+        return self._control('start', InstanceIds)
+
+    def stop_instances(self, InstanceIds):
+        return self._control('stop', InstanceIds)
+
+class MockEc2Resource:
+    def __init__(self, all_pages, filtered_pages=None, client=None):
+        self.instances = MockInstanceCollectionManager(all_pages, filtered_pages or [])
+        self.meta = SimpleNamespace(client=client or MockEc2Client())
 
 
 class GetInvokeTimeTestCase(unittest.TestCase):
@@ -636,6 +708,967 @@ class FilterStopInstancesPhaseFourTestCase(unittest.TestCase):
 
         self.assertIs(ec2_state_mgmt._filter_stop_instances(instance, event_hour, phase), False)
 
+class ClassifyInstancesTestCase(unittest.TestCase):
+    def classify(self, timestamp, instances):
+        event = datetime.fromisoformat(timestamp)
+        event_hour, event_minute = ec2_state_mgmt.get_invoke_time(event)
+        phase = ec2_state_mgmt.get_hour_phase(event_minute)
+        is_weekend = ec2_state_mgmt.check_if_weekend(event)
+
+        return ec2_state_mgmt.classify_instances(instances, event_hour, phase, is_weekend, event.weekday())
+
+    def test_buckets(self):
+        start = MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }])
+        stop = MockInstance('i-2', 'running', [{ 'Key': 'ec2_stop', 'Value': '07:05' }])
+        instances = [
+            start,
+            stop,
+            MockInstance('i-3', 'running', [{ 'Key': 'ec2_start', 'Value': '07:00' }]),
+            MockInstance('i-4', 'stopped', [{ 'Key': 'ec2_stop', 'Value': '07:00' }]),
+            MockInstance('i-5', 'pending', [{ 'Key': 'ec2_start', 'Value': '07:00' }]),
+            MockInstance('i-6', 'stopped', [{ 'Key': 'ec2_start', 'Value': '7:00' }]),
+            MockInstance('i-7', 'stopped', None)
+        ]
+
+        self.assertEqual(self.classify('2020-06-26T07:13:00+00:00', instances), ([start], [stop]))
+
+    def test_weekend(self):
+        weekend_start = MockInstance('i-1', 'stopped', [
+            { 'Key': 'ec2_start', 'Value': '07:00' },
+            { 'Key': 'ec2_start_on_weekends', 'Value': 'TRUE' }
+        ])
+        weekday_start = MockInstance('i-2', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }])
+        stop = MockInstance('i-3', 'running', [{ 'Key': 'ec2_stop', 'Value': '07:00' }])
+
+        self.assertEqual(
+            self.classify('2020-06-27T07:13:00+00:00', [weekend_start, weekday_start, stop]),
+            ([weekend_start], [stop])
+        )
+
+    def test_cron_schedule(self):
+        schedule = { 'Key': 'ec2_schedule', 'Value': 'start 30 7 mon-thu; start 0 7 fri; stop 0 18 mon-fri' }
+        friday = MockInstance('i-1', 'stopped', [schedule, { 'Key': 'ec2_start', 'Value': '07:30' }])
+        running = MockInstance('i-2', 'running', [schedule])
+        malformed = MockInstance('i-3', 'stopped', [{ 'Key': 'ec2_schedule', 'Value': 'start 0 7' }])
+
+        # friday 07:00; the ec2_schedule tag overrides ec2_start
+        self.assertEqual(self.classify('2020-06-26T07:03:00+00:00', [friday, running, malformed]), ([friday], []))
+        self.assertEqual(self.classify('2020-06-26T07:33:00+00:00', [friday, running, malformed]), ([], []))
+        # thursday 07:30
+        self.assertEqual(self.classify('2020-06-25T07:33:00+00:00', [friday, running, malformed]), ([friday], []))
+        self.assertEqual(self.classify('2020-06-26T18:03:00+00:00', [friday, running, malformed]), ([], [running]))
+
+    def test_cron_schedule_without_weekday(self):
+        instance = MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_schedule', 'Value': 'start 0 7 *' }])
+        phase = ec2_state_mgmt.get_hour_phase('03')
+
+        self.assertEqual(ec2_state_mgmt.classify_instances([instance], '07', phase, False), ([], []))
+        self.assertEqual(ec2_state_mgmt.classify_instance(instance, '07', phase, False, 4), ec2_state_mgmt.ACTION_START)
+
+class GetCatchUpWindowTestCase(unittest.TestCase):
+    def test_without_watermark(self):
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        self.assertEqual(ec2_state_mgmt.get_catch_up_window(None, now), (4 * 96 + 28, 1))
+
+    def test_missed_ticks(self):
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        watermark = datetime.fromisoformat('2020-06-26T06:18:00+00:00').timestamp()
+        self.assertEqual(ec2_state_mgmt.get_catch_up_window(watermark, now), (4 * 96 + 26, 3))
+
+    def test_same_slot(self):
+        now = datetime.fromisoformat('2020-06-26T07:13:00+00:00')
+        watermark = datetime.fromisoformat('2020-06-26T07:03:00+00:00').timestamp()
+        self.assertEqual(ec2_state_mgmt.get_catch_up_window(watermark, now)[1], 0)
+
+    def test_capped_at_a_week(self):
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        watermark = datetime.fromisoformat('2020-06-01T07:03:00+00:00').timestamp()
+        self.assertEqual(ec2_state_mgmt.get_catch_up_window(watermark, now), (4 * 96 + 29, 672))
+
+class ClassifyCatchUpTestCase(unittest.TestCase):
+    def test_desired_state(self):
+        missed_start = MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '06:30' }, { 'Key': 'ec2_stop', 'Value': '18:00' }])
+        running = MockInstance('i-2', 'running', [{ 'Key': 'ec2_start', 'Value': '06:30' }, { 'Key': 'ec2_stop', 'Value': '18:00' }])
+        missed_stop = MockInstance('i-3', 'running', [{ 'Key': 'ec2_schedule', 'Value': 'start 0 5 *; stop 45 6 *' }])
+        restarted = MockInstance('i-4', 'stopped', [{ 'Key': 'ec2_schedule', 'Value': 'stop 0 6 *; start 30 6 *' }])
+        unscheduled = MockInstance('i-5', 'stopped', [{ 'Key': 'Name', 'Value': 'test' }])
+        instances = [missed_start, running, missed_stop, restarted, unscheduled]
+
+        # friday 06:00 through 07:00
+        self.assertEqual(ec2_state_mgmt.classify_catch_up(instances, 4 * 96 + 24, 5), ([missed_start, restarted], [missed_stop]))
+        # the stop at 18:00 lies beyond the window, so nothing is stopped early
+        self.assertEqual(ec2_state_mgmt.classify_catch_up([running], 4 * 96 + 24, 5), ([], []))
+
+class ClassifyZonedInstancesTestCase(unittest.TestCase):
+    def test_per_instance_timezone(self):
+        # 07:03 UTC is 09:03 in Paris, and 16:03 in Tokyo
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        local = MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }])
+        paris = MockInstance('i-2', 'stopped', [{ 'Key': 'ec2_start', 'Value': '09:00' }, { 'Key': 'ec2_timezone', 'Value': 'Europe/Paris' }])
+        paris_late = MockInstance('i-3', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }, { 'Key': 'ec2_timezone', 'Value': 'Europe/Paris' }])
+        tokyo = MockInstance('i-4', 'running', [{ 'Key': 'ec2_schedule', 'Value': 'stop 0 16 fri' }, { 'Key': 'ec2_timezone', 'Value': 'Asia/Tokyo' }])
+
+        self.assertEqual(ec2_state_mgmt.classify_zoned_instances([local, paris, paris_late, tokyo], now), ([local, paris], [tokyo]))
+
+    def test_weekend_per_timezone(self):
+        # friday 23:30 UTC is already saturday in Tokyo
+        now = datetime.fromisoformat('2020-06-26T23:30:00+00:00')
+        utc = MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '23:30' }])
+        tokyo = MockInstance('i-2', 'stopped', [{ 'Key': 'ec2_start', 'Value': '08:30' }, { 'Key': 'ec2_timezone', 'Value': 'Asia/Tokyo' }])
+
+        self.assertEqual(ec2_state_mgmt.classify_zoned_instances([utc, tokyo], now), ([utc], []))
+
+    def test_unknown_timezone(self):
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        instance = MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }, { 'Key': 'ec2_timezone', 'Value': 'Mars/Olympus_Mons' }])
+
+        self.assertEqual(ec2_state_mgmt.classify_zoned_instances([instance], now), ([], []))
+
+    def test_time_computed_once_per_timezone(self):
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        instances = [
+            MockInstance(f'i-{number}', 'stopped', [{ 'Key': 'ec2_start', 'Value': '09:00' }, { 'Key': 'ec2_timezone', 'Value': zone }])
+            for number, zone in enumerate(['Europe/Paris', 'Asia/Tokyo'] * 5)
+        ]
+
+        with unittest.mock.patch('classify.get_time_info', wraps=ec2_state_mgmt.get_time_info) as get_time_info:
+            start_instances, _ = ec2_state_mgmt.classify_zoned_instances(instances, now)
+
+        self.assertEqual(get_time_info.call_count, 2)
+        self.assertEqual(len(start_instances), 5)
+        self.assertIs(ec2_state_mgmt.get_zone('Europe/Paris'), ec2_state_mgmt.get_zone('Europe/Paris'))
+
+    def test_catch_up(self):
+        # 06:18 through 07:03 UTC is 08:18 through 09:03 in Paris
+        watermark = datetime.fromisoformat('2020-06-26T06:18:00+00:00').timestamp()
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        local = MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '06:30' }])
+        paris = MockInstance('i-2', 'stopped', [{ 'Key': 'ec2_start', 'Value': '08:30' }, { 'Key': 'ec2_timezone', 'Value': 'Europe/Paris' }])
+        paris_early = MockInstance('i-3', 'stopped', [{ 'Key': 'ec2_start', 'Value': '06:30' }, { 'Key': 'ec2_timezone', 'Value': 'Europe/Paris' }])
+
+        self.assertEqual(ec2_state_mgmt.classify_zoned_catch_up([local, paris, paris_early], watermark, now), ([local, paris], []))
+
+    def test_client_inventory_keeps_timezone_tag(self):
+        record = ec2_state_mgmt.InstanceRecord.from_description({
+            'InstanceId': 'i-1',
+            'State': { 'Name': 'stopped' },
+            'Tags': [{ 'Key': 'ec2_start', 'Value': '09:00' }, { 'Key': 'ec2_timezone', 'Value': 'Europe/Paris' }]
+        })
+
+        self.assertEqual(ec2_state_mgmt.get_instance_tags(record)['ec2_timezone'], 'Europe/Paris')
+
+class ProcessRegionCatchUpTestCase(unittest.TestCase):
+    def test_missed_tick(self):
+        instance = MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '06:30' }])
+        resource = MockEc2Resource([[instance]])
+        backend = ec2_state_mgmt.FileWheelBackend(tempfile.mkdtemp())
+        backend.put('us-east-2/watermark', { 'watermark': datetime.fromisoformat('2020-06-26T06:18:00+00:00').timestamp() })
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+
+        with unittest.mock.patch.object(ec2_state_mgmt, 'get_watermark_backend', return_value=backend):
+            self.assertEqual(ec2_state_mgmt.process_region(resource, {}, now, 'us-east-2'), 0)
+
+        self.assertEqual(resource.meta.client.calls, [('start', ['i-1'])])
+        self.assertEqual(backend.get('us-east-2/watermark'), { 'watermark': now.timestamp(), 'retries': {} })
+
+    def test_failure_retried_alone(self):
+        failing = MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }])
+        healthy = MockInstance('i-2', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }])
+        client = MockEc2Client(bad_ids=['i-1'], describe_pages=[describe_page(('i-1', 'stopped', []), ('i-2', 'pending', []))])
+        backend = ec2_state_mgmt.FileWheelBackend(tempfile.mkdtemp())
+        watermark = datetime.fromisoformat('2020-06-26T06:48:00+00:00').timestamp()
+        backend.put('us-east-2/watermark', { 'watermark': watermark })
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        later = datetime.fromisoformat('2020-06-26T07:18:00+00:00')
+
+        with unittest.mock.patch.object(ec2_state_mgmt, 'get_watermark_backend', return_value=backend):
+            self.assertEqual(ec2_state_mgmt.process_region(MockEc2Resource([[failing, healthy]], client=client), {}, now, 'us-east-2'), 1)
+
+            # the watermark advances regardless; only the failed instance is carried forward, from the watermark it failed on
+            self.assertEqual(backend.get('us-east-2/watermark'), { 'watermark': now.timestamp(), 'retries': { 'i-1': watermark } })
+
+            # i-2 was started by hand in the meantime, so only i-1 is retried; i-3 was stopped by hand, and is left alone
+            stopped = MockInstance('i-3', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }])
+            started = MockInstance('i-2', 'running', [{ 'Key': 'ec2_start', 'Value': '07:00' }])
+            resource = MockEc2Resource([[failing, started, stopped]])
+            self.assertEqual(ec2_state_mgmt.process_region(resource, {}, later, 'us-east-2'), 0)
+
+        self.assertEqual(resource.meta.client.calls, [('start', ['i-1'])])
+        self.assertEqual(backend.get('us-east-2/watermark'), { 'watermark': later.timestamp(), 'retries': {} })
+
+class GetSlotTestCase(unittest.TestCase):
+    def test_matches_hour_phase(self):
+        for minute in range(60):
+            with self.subTest(minute=minute):
+                phase = ec2_state_mgmt.get_hour_phase(f'{minute:02}')
+                self.assertEqual(ec2_state_mgmt.get_slot('07', phase), 28 + minute // 15)
+
+class ParseScheduleSlotTestCase(unittest.TestCase):
+    def test_valid(self):
+        self.assertEqual(ec2_state_mgmt.parse_schedule_slot('00:00'), 0)
+        self.assertEqual(ec2_state_mgmt.parse_schedule_slot('07:30'), 30)
+        self.assertEqual(ec2_state_mgmt.parse_schedule_slot('23:45'), 95)
+
+    def test_rounding(self):
+        for value in ['07:15', '07:22', '07:29']:
+            with self.subTest(value=value):
+                self.assertEqual(ec2_state_mgmt.parse_schedule_slot(value), 29)
+
+    def test_invalid(self):
+        for value in ['0:00', '00:0', 'A0:00', '00:A0', '25:00', '00:60']:
+            with self.subTest(value=value):
+                self.assertIsNone(ec2_state_mgmt.parse_schedule_slot(value))
+
+class GetSettingTestCase(unittest.TestCase):
+    def test_event_preferred(self):
+        with unittest.mock.patch.dict(os.environ, { 'STATE_MGMT_TEST_SETTING': 'env' }):
+            self.assertEqual(ec2_state_mgmt.get_setting({ 'test_setting': 'event' }, 'test_setting', 'STATE_MGMT_TEST_SETTING'), 'event')
+
+    def test_env_fallback(self):
+        with unittest.mock.patch.dict(os.environ, { 'STATE_MGMT_TEST_SETTING': 'env' }):
+            self.assertEqual(ec2_state_mgmt.get_setting({}, 'test_setting', 'STATE_MGMT_TEST_SETTING'), 'env')
+
+    def test_default(self):
+        self.assertEqual(ec2_state_mgmt.get_setting(None, 'test_setting', 'STATE_MGMT_TEST_SETTING', 'default'), 'default')
+
+class GetInventoryTestCase(unittest.TestCase):
+    def test_full(self):
+        first = MockInstance('i-1', 'running', [])
+        second = MockInstance('i-2', 'stopped', [])
+        resource = MockEc2Resource([[first], [second]])
+
+        instances = ec2_state_mgmt.get_inventory(resource, ec2_state_mgmt.INVENTORY_MODE_FULL)
+
+        self.assertEqual(instances, [first, second])
+        self.assertEqual(resource.instances.filter_calls, [])
+
+    def test_filtered(self):
+        stopped = MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }])
+        running = MockInstance('i-2', 'running', [{ 'Key': 'ec2_stop', 'Value': '16:00' }])
+        resource = MockEc2Resource([], [[[stopped]], [[running]]])
+
+        instances = ec2_state_mgmt.get_inventory(resource, ec2_state_mgmt.INVENTORY_MODE_FILTERED)
+
+        self.assertEqual(instances, [stopped, running])
+        self.assertEqual(resource.instances.filter_calls, [
+            ec2_state_mgmt.START_CANDIDATE_FILTERS,
+            ec2_state_mgmt.STOP_CANDIDATE_FILTERS
+        ])
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            ec2_state_mgmt.get_inventory(MockEc2Resource([]), 'bogus')
+
+    def test_resource_page_size(self):
+        # real ec2.Instance collections only send MaxResults (and so only paginate) once given a page size
+        import boto3
+        from botocore.stub import Stubber
+        resource = boto3.session.Session().resource('ec2', region_name='us-east-1', aws_access_key_id='stub', aws_secret_access_key='stub')
+        page_size = ec2_state_mgmt.DESCRIBE_PAGE_SIZE
+        stubber = Stubber(resource.meta.client)
+        stubber.add_response('describe_instances', describe_page(('i-1', 'running', [])), { 'MaxResults': page_size })
+        for filters in [ec2_state_mgmt.START_CANDIDATE_FILTERS, ec2_state_mgmt.STOP_CANDIDATE_FILTERS]:
+            stubber.add_response('describe_instances', describe_page(), { 'Filters': filters, 'MaxResults': page_size })
+
+        with stubber:
+            self.assertEqual(len(ec2_state_mgmt.get_inventory(resource, ec2_state_mgmt.INVENTORY_MODE_FULL)), 1)
+            self.assertEqual(ec2_state_mgmt.get_inventory(resource, ec2_state_mgmt.INVENTORY_MODE_FILTERED), [])
+        stubber.assert_no_pending_responses()
+
+def describe_page(*instances):
+    return { 'Reservations': [{ 'Instances': [
+        { 'InstanceId': instance_id, 'State': { 'Name': state }, 'Tags': tags, 'InstanceType': 't3.micro' }
+        for instance_id, state, tags in instances
+    ]}]}
+
+class InstanceRecordTestCase(unittest.TestCase):
+    def test_from_description(self):
+        record = ec2_state_mgmt.InstanceRecord.from_description({
+            'InstanceId': 'i-1',
+            'State': { 'Code': 80, 'Name': 'stopped' },
+            'Tags': [{ 'Key': 'Name', 'Value': 'test' }, { 'Key': 'ec2_start', 'Value': '07:00' }]
+        })
+
+        self.assertEqual(record.id, 'i-1')
+        self.assertEqual(record.state, { 'Name': 'stopped' })
+        self.assertEqual(record.tags, [{ 'Key': 'ec2_start', 'Value': '07:00' }])
+        self.assertFalse(record.hibernation_configured)
+        self.assertFalse(hasattr(record, '__dict__'))
+
+    def test_hibernation_configured(self):
+        record = ec2_state_mgmt.InstanceRecord.from_description({
+            'InstanceId': 'i-1', 'State': { 'Name': 'running' }, 'HibernationOptions': { 'Configured': True }
+        })
+
+        self.assertTrue(record.hibernation_configured)
+        self.assertTrue(ec2_state_mgmt.InstanceRecord.from_instance(record).hibernation_configured)
+        self.assertTrue(ec2_state_mgmt.InstanceRecord.from_instance(MockInstance('i-2', 'running', [], True)).hibernation_configured)
+        self.assertFalse(ec2_state_mgmt.InstanceRecord.from_instance(MockInstance('i-3', 'running', [])).hibernation_configured)
+
+    def test_untagged(self):
+        record = ec2_state_mgmt.InstanceRecord.from_description({ 'InstanceId': 'i-1', 'State': { 'Name': 'running' } })
+        self.assertEqual(record.tags, [])
+        self.assertEqual(ec2_state_mgmt.get_instance_tags(record), {})
+
+    def test_classification(self):
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        event_hour, event_minute = ec2_state_mgmt.get_invoke_time(now)
+        phase = ec2_state_mgmt.get_hour_phase(event_minute)
+        start = ec2_state_mgmt.InstanceRecord('i-1', 'stopped', { 'ec2_start': '07:00' })
+        stop = ec2_state_mgmt.InstanceRecord('i-2', 'running', { 'ec2_stop': '07:00' })
+
+        self.assertEqual(ec2_state_mgmt.classify_instances([start, stop], event_hour, phase, False), ([start], [stop]))
+        self.assertIs(ec2_state_mgmt.filter_start_instances(start, event_hour, phase, False), True)
+        self.assertIs(ec2_state_mgmt.filter_stop_instances(stop, event_hour, phase), True)
+
+    def test_memory_footprint(self):
+        # compares against real ec2.Instance resources, paginated through a stubbed DescribeInstances
+        import boto3
+        from botocore.stub import Stubber
+        resource = boto3.session.Session().resource('ec2', region_name='us-east-1', aws_access_key_id='stub', aws_secret_access_key='stub')
+
+        def make_page():
+            return describe_page(*[
+                (f'i-{i:017x}', 'running', [{ 'Key': 'Name', 'Value': f'test-{i}' }, { 'Key': 'ec2_stop', 'Value': '18:00' }])
+                for i in range(1000)
+            ])
+
+        def build_resources():
+            stubber = Stubber(resource.meta.client)
+            stubber.add_response('describe_instances', make_page())
+            with stubber:
+                return list(resource.instances.all())
+
+        def build_records():
+            client = MockEc2Client(describe_pages=[make_page()])
+            return [record for page in ec2_state_mgmt.iter_record_pages(client) for record in page]
+
+        def measure(build):
+            tracemalloc.start()
+            instances = build()
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            self.assertEqual(len(instances), 1000)
+            return size
+
+        self.assertLess(measure(build_records) * 2, measure(build_resources))
+
+class ClientInventoryTestCase(unittest.TestCase):
+    def test_full(self):
+        client = MockEc2Client(describe_pages=[
+            describe_page(('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }])),
+            describe_page(('i-2', 'running', []))
+        ])
+        resource = MockEc2Resource([], client=client)
+
+        instances = ec2_state_mgmt.get_inventory(resource, ec2_state_mgmt.INVENTORY_MODE_FULL, ec2_state_mgmt.INVENTORY_SOURCE_CLIENT)
+
+        self.assertEqual([instance.id for instance in instances], ['i-1', 'i-2'])
+        self.assertTrue(all(isinstance(instance, ec2_state_mgmt.InstanceRecord) for instance in instances))
+        self.assertEqual(client.describe_calls, [{ 'PaginationConfig': { 'PageSize': ec2_state_mgmt.DESCRIBE_PAGE_SIZE } }])
+
+    def test_filtered(self):
+        client = MockEc2Client(describe_pages=[describe_page(('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }]))])
+        resource = MockEc2Resource([], client=client)
+
+        ec2_state_mgmt.get_inventory(resource, ec2_state_mgmt.INVENTORY_MODE_FILTERED, ec2_state_mgmt.INVENTORY_SOURCE_CLIENT)
+
+        self.assertEqual([call['Filters'] for call in client.describe_calls], [
+            ec2_state_mgmt.START_CANDIDATE_FILTERS,
+            ec2_state_mgmt.STOP_CANDIDATE_FILTERS
+        ])
+
+    def test_unknown_source(self):
+        with self.assertRaises(ValueError):
+            ec2_state_mgmt.get_inventory(MockEc2Resource([]), ec2_state_mgmt.INVENTORY_MODE_FULL, 'bogus')
+
+class CachedInventoryTestCase(unittest.TestCase):
+    def setUp(self):
+        ec2_state_mgmt.inventory_cache.clear()
+
+    def make_resource(self):
+        client = MockEc2Client(describe_pages=[describe_page(('i-1', 'running', [{ 'Key': 'ec2_stop', 'Value': '18:00' }]))])
+        return MockEc2Resource([[
+            MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_stop', 'Value': '18:00' }]),
+            MockInstance('i-2', 'stopped', [{ 'Key': 'Name', 'Value': 'unscheduled' }])
+        ]], client=client)
+
+    def get(self, resource, ttl=900, full_rescan=False, inventory_mode=ec2_state_mgmt.INVENTORY_MODE_FULL):
+        return ec2_state_mgmt.get_cached_inventory(
+            resource, 'us-east-2', inventory_mode, ec2_state_mgmt.INVENTORY_SOURCE_RESOURCE, ttl=ttl, full_rescan=full_rescan
+        )
+
+    def test_miss_then_hit(self):
+        resource = self.make_resource()
+
+        self.assertEqual([instance.id for instance in self.get(resource)], ['i-1', 'i-2'])
+        self.assertEqual(resource.meta.client.describe_calls, [])
+
+        refreshed = self.get(resource)
+        self.assertEqual([(record.id, record.state['Name']) for record in refreshed], [('i-1', 'running')])
+        self.assertEqual(
+            [call['Filters'] for call in resource.meta.client.describe_calls],
+            [[{ 'Name': 'instance-id', 'Values': ['i-1'] }]]
+        )
+
+    def test_deleted_instances_dropped(self):
+        resource = self.make_resource()
+        resource.meta.client.describe_pages = [describe_page()]
+
+        self.get(resource)
+        self.assertEqual(self.get(resource), [])
+        self.assertEqual(ec2_state_mgmt.inventory_cache[('us-east-2', 'full', 'resource')]['records'], [])
+
+    def test_resource_rebuilt_for_scope(self):
+        # refreshed assumed role credentials bring a new resource for the same scope, which reuses (and replaces) its entry
+        self.get(self.make_resource())
+        resource = self.make_resource()
+
+        self.assertEqual([record.id for record in self.get(resource)], ['i-1'])
+        self.assertEqual(len(resource.meta.client.describe_calls), 1)
+        self.assertEqual(list(ec2_state_mgmt.inventory_cache), [('us-east-2', 'full', 'resource')])
+
+    def test_keyed_by_mode(self):
+        resource = self.make_resource()
+        resource.instances.filtered_pages = [[[MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_stop', 'Value': '18:00' }])]]]
+
+        self.get(resource)
+        self.get(resource, inventory_mode=ec2_state_mgmt.INVENTORY_MODE_FILTERED)
+        self.assertEqual(resource.meta.client.describe_calls, [])
+        self.assertEqual(len(ec2_state_mgmt.inventory_cache), 2)
+
+    def test_expired(self):
+        resource = self.make_resource()
+
+        self.get(resource)
+        self.assertEqual(len(self.get(resource, ttl=0)), 2)
+        self.assertEqual(resource.meta.client.describe_calls, [])
+
+    def test_full_rescan(self):
+        resource = self.make_resource()
+
+        self.get(resource)
+        self.assertEqual(len(self.get(resource, full_rescan=True)), 2)
+        self.assertEqual(resource.meta.client.describe_calls, [])
+
+    def test_filtered_mode_caches_every_scheduled_instance(self):
+        # i-1 is running, so no start candidate query would list it; it is stopped by the next tick
+        client = MockEc2Client(describe_pages=[describe_page(('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }]))])
+        resource = MockEc2Resource([], [[[MockInstance('i-1', 'running', [{ 'Key': 'ec2_start', 'Value': '07:00' }])]]], client=client)
+
+        self.get(resource, inventory_mode=ec2_state_mgmt.INVENTORY_MODE_FILTERED)
+        self.assertEqual(resource.instances.filter_calls, [ec2_state_mgmt.SCHEDULED_FILTERS])
+
+        refreshed = self.get(resource, inventory_mode=ec2_state_mgmt.INVENTORY_MODE_FILTERED)
+        self.assertEqual([(record.id, record.state['Name']) for record in refreshed], [('i-1', 'stopped')])
+
+class ControlInstancesTestCase(unittest.TestCase):
+    def test_batching(self):
+        client = MockEc2Client()
+        instance_ids = [f'i-{i}' for i in range(5)]
+
+        self.assertEqual(ec2_state_mgmt.control_instances(client, 'start', instance_ids, 2), 0)
+        self.assertEqual(client.calls, [
+            ('start', ['i-0', 'i-1']),
+            ('start', ['i-2', 'i-3']),
+            ('start', ['i-4'])
+        ])
+
+    def test_bisection(self):
+        client = MockEc2Client(bad_ids=['i-2'])
+        instance_ids = [f'i-{i}' for i in range(4)]
+
+        self.assertEqual(ec2_state_mgmt.control_instances(client, 'stop', instance_ids, 4), 1)
+        succeeded = [call[1] for call in client.calls if 'i-2' not in call[1]]
+        self.assertEqual(sorted(sum(succeeded, [])), ['i-0', 'i-1', 'i-3'])
+
+    def test_multiple_failures(self):
+        client = MockEc2Client(bad_ids=['i-0', 'i-3'])
+        instance_ids = [f'i-{i}' for i in range(4)]
+
+        self.assertEqual(ec2_state_mgmt.control_instances(client, 'start', instance_ids), 2)
+
+    def test_non_bisectable_failure(self):
+        client = MockEc2Client(bad_ids=['i-1'], error_code='UnauthorizedOperation')
+        instance_ids = [f'i-{i}' for i in range(4)]
+
+        self.assertEqual(ec2_state_mgmt.control_instances(client, 'start', instance_ids), 4)
+        self.assertEqual(len(client.calls), 1)
+
+    def test_unknown_action(self):
+        with self.assertRaises(ValueError):
+            ec2_state_mgmt.control_instances(MockEc2Client(), 'reboot', ['i-1'])
+
+class ProcessRegionTestCase(unittest.TestCase):
+    def test_actions_due_instances(self):
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        resource = MockEc2Resource([[
+            MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }]),
+            MockInstance('i-2', 'running', [{ 'Key': 'ec2_stop', 'Value': '07:00' }]),
+            MockInstance('i-3', 'running', [{ 'Key': 'ec2_stop', 'Value': '08:00' }])
+        ]])
+
+        self.assertEqual(ec2_state_mgmt.process_region(resource, {}, now), 0)
+        self.assertEqual(resource.meta.client.calls, [('start', ['i-1']), ('stop', ['i-2'])])
+
+class StreamRegionTestCase(unittest.TestCase):
+    def test_actions_before_inventory_completes(self):
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        timeline = []
+
+        class TimelineCollection(MockCollection):
+            def pages(self):
+                for number, page in enumerate(self._pages):
+                    timeline.append(f'page-{number}')
+                    yield page
+
+        class TimelineClient(MockEc2Client):
+            def _control(self, action, InstanceIds):
+                timeline.append(f'{action}-{",".join(InstanceIds)}')
+                return super()._control(action, InstanceIds)
+
+        resource = MockEc2Resource([], client=TimelineClient())
+        resource.instances.all = lambda: TimelineCollection([
+            [MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }])],
+            [MockInstance('i-2', 'running', [])],
+            [MockInstance('i-3', 'running', [{ 'Key': 'ec2_stop', 'Value': '07:00' }])]
+        ])
+
+        self.assertEqual(ec2_state_mgmt.process_region(resource, { 'streaming': 'true' }, now), 0)
+        self.assertEqual(timeline, ['page-0', 'start-i-1', 'page-1', 'page-2', 'stop-i-3'])
+
+class ProcessRegionsTestCase(unittest.TestCase):
+    def test_combined_results(self):
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        resources = {
+            'us-east-1': MockEc2Resource([[MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }])]]),
+            'us-east-2': MockEc2Resource(
+                [[MockInstance('i-2', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }])]],
+                client=MockEc2Client(bad_ids=['i-2'])
+            ),
+            'us-west-2': MockEc2Resource(None)
+        }
+
+        failure_count, failed_regions = ec2_state_mgmt.process_regions(resources, {}, now, 2)
+
+        self.assertEqual(failure_count, 1)
+        self.assertEqual(failed_regions, ['us-west-2'])
+        self.assertEqual(resources['us-east-1'].meta.client.calls, [('start', ['i-1'])])
+
+    def test_metrics(self):
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        resources = {
+            '111111111111/us-east-2': MockEc2Resource(
+                [[MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }]), MockInstance('i-2', 'running', [])]],
+                client=MockEc2Client(bad_ids=['i-1'])
+            )
+        }
+
+        with unittest.mock.patch.object(ec2_state_mgmt.metrics, 'emit') as emit:
+            ec2_state_mgmt.process_regions(resources, {}, now, 2)
+
+        self.assertEqual(emit.call_count, 1)
+        record = emit.call_args.args[0].to_emf('test')
+        self.assertEqual((record['Account'], record['Region'], record['HourPhase']), ('111111111111', 'us-east-2', 'PHASE_ONE'))
+        self.assertEqual((record['PagesFetched'], record['InstancesSeen']), (1, 2))
+        self.assertEqual((record['StartDue'], record['StopDue'], record['Failures']), (1, 0, 1))
+        for timing in ['InventoryTime', 'ClassificationTime', 'StartTime', 'TotalTime']:
+            with self.subTest(timing=timing):
+                self.assertIn(timing, record)
+        self.assertNotIn('111111111111/us-east-2', runtime.scope_metrics)
+
+    def test_decision_summary(self):
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        resources = {
+            'us-east-2': MockEc2Resource([[
+                MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }]),
+                MockInstance('i-2', 'running', [{ 'Key': 'ec2_stop', 'Value': '18:00' }]),
+                MockInstance('i-3', 'running', [{ 'Key': 'ec2_stop', 'Value': 'bad' }]),
+                MockInstance('i-4', 'pending', [])
+            ]], client=MockEc2Client())
+        }
+
+        with unittest.mock.patch.object(ec2_state_mgmt.logger, 'info') as info, \
+            unittest.mock.patch.object(ec2_state_mgmt.metrics, 'emit'):
+            ec2_state_mgmt.process_regions(resources, { 'decision_sample_rate': '1' }, now, 2)
+
+        summaries = [call for call in info.call_args_list if call.args[0] == 'Decision summary for %s']
+        self.assertEqual(len(summaries), 1)
+        record = summaries[0].kwargs['extra']['decisions']
+        self.assertEqual(record['reasons'], { 'start_due': 1, 'not_due': 1, 'malformed_schedule': 1, 'not_stopped_or_running': 1 })
+        self.assertEqual(record['actioned'], { 'start': ['i-1'] })
+        self.assertEqual(len(record['samples']), 4)
+        self.assertNotIn('us-east-2', runtime.scope_decisions)
+
+    def test_decision_log_detailed(self):
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        resources = { 'us-east-2': MockEc2Resource([[MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }])]]) }
+
+        with unittest.mock.patch.object(ec2_state_mgmt.logger, 'info') as info, \
+            unittest.mock.patch.object(ec2_state_mgmt.metrics, 'emit'):
+            ec2_state_mgmt.process_regions(resources, { 'decision_log': 'detailed' }, now, 2)
+
+        self.assertNotIn('Decision summary for %s', [call.args[0] for call in info.call_args_list])
+
+class ControlActionsDecisionsTestCase(unittest.TestCase):
+    def test_deferred_not_actioned(self):
+        decision_log = ec2_state_mgmt.decisions.DecisionLog()
+        remaining = [1000000] + [0] * 10
+        with unittest.mock.patch.object(runtime, 'continuation', ec2_state_mgmt.Continuation(FakeContext(remaining), 0)), \
+            ec2_state_mgmt.decisions.recording(decision_log):
+            with self.assertRaises(ec2_state_mgmt.DeadlineReached):
+                ec2_state_mgmt.control_actions(MockEc2Client(), { 'start': ['i-1', 'i-2'], 'stop': ['i-3'] }, 1)
+
+        self.assertEqual(decision_log.actioned, { 'start': ['i-1'], 'stop': [] })
+
+class GetRateLimiterTestCase(unittest.TestCase):
+    def setUp(self):
+        runtime.rate_limiters.clear()
+
+    def test_per_scope(self):
+        with unittest.mock.patch.dict(os.environ, { 'STATE_MGMT_EC2_RATE_LIMIT': '5', 'STATE_MGMT_EC2_BURST': '10' }):
+            limiter = runtime.get_rate_limiter('us-east-2')
+
+            self.assertIs(runtime.get_rate_limiter('us-east-2'), limiter)
+            self.assertIsNot(runtime.get_rate_limiter('111111111111/us-east-2'), limiter)
+            self.assertEqual((limiter.rate, limiter.capacity), (5.0, 10.0))
+
+    def test_disabled(self):
+        with unittest.mock.patch.dict(os.environ, { 'STATE_MGMT_EC2_RATE_LIMIT': '0' }):
+            self.assertIsNone(runtime.get_rate_limiter('us-east-2'))
+
+class GetRegionsTestCase(unittest.TestCase):
+    def test_default(self):
+        with unittest.mock.patch.dict(os.environ, { 'AWS_REGION': 'us-east-2' }):
+            self.assertEqual(ec2_state_mgmt.get_regions({}), ['us-east-2'])
+
+    def test_env(self):
+        with unittest.mock.patch.dict(os.environ, { 'STATE_MGMT_REGIONS': 'us-east-1, us-west-2,us-east-1' }):
+            self.assertEqual(ec2_state_mgmt.get_regions({}), ['us-east-1', 'us-west-2'])
+
+    def test_event(self):
+        self.assertEqual(ec2_state_mgmt.get_regions({ 'regions': ['eu-west-1'] }), ['eu-west-1'])
+
+class MockStsClient:
+    def __init__(self, lifetime):
+        self.lifetime = lifetime
+        self.calls = []
+
+    def assume_role(self, RoleArn, RoleSessionName):
+        self.calls.append(RoleArn)
+        return { 'Credentials': {
+            'AccessKeyId': 'AKIA', 'SecretAccessKey': 'secret', 'SessionToken': 'token',
+            'Expiration': datetime.now(timezone.utc) + self.lifetime
+        }}
+
+class GetAssumedRoleTestCase(unittest.TestCase):
+    def setUp(self):
+        runtime.assumed_roles.clear()
+
+    def test_cached(self):
+        sts = MockStsClient(timedelta(hours=1))
+        with unittest.mock.patch.object(runtime, 'get_client', return_value=sts):
+            first = runtime.get_assumed_role('arn:aws:iam::111111111111:role/test')
+            second = runtime.get_assumed_role('arn:aws:iam::111111111111:role/test')
+
+        self.assertIs(first, second)
+        self.assertEqual(len(sts.calls), 1)
+
+    def test_refresh_near_expiry(self):
+        sts = MockStsClient(timedelta(minutes=2))
+        with unittest.mock.patch.object(runtime, 'get_client', return_value=sts):
+            runtime.get_assumed_role('arn:aws:iam::111111111111:role/test')
+            runtime.get_assumed_role('arn:aws:iam::111111111111:role/test')
+
+        self.assertEqual(len(sts.calls), 2)
+
+class ProcessAccountsTestCase(unittest.TestCase):
+    def setUp(self):
+        runtime.assumed_roles.clear()
+
+    def test_combined_results(self):
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        sts = MockStsClient(timedelta(hours=1))
+        build_resource = lambda *args: MockEc2Resource(
+            [[MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }])]],
+            client=MockEc2Client(bad_ids=['i-1'])
+        )
+        role_arns = ['arn:aws:iam::111111111111:role/test', 'arn:aws:iam::222222222222:role/test']
+
+        with unittest.mock.patch.object(runtime, 'get_client', return_value=sts), \
+            unittest.mock.patch.object(runtime, 'build_resource', side_effect=build_resource):
+            failure_count, failed_targets = ec2_state_mgmt.process_accounts(role_arns, ['us-east-1', 'us-east-2'], {}, now)
+
+        self.assertEqual(failure_count, 4)
+        self.assertEqual(failed_targets, [])
+        self.assertEqual(sorted(sts.calls), role_arns)
+
+    def test_failed_account(self):
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        with unittest.mock.patch.object(runtime, 'get_client', side_effect=RuntimeError('denied')):
+            failure_count, failed_targets = ec2_state_mgmt.process_accounts(['arn:aws:iam::111111111111:role/test'], ['us-east-1'], {}, now)
+
+        self.assertEqual(failure_count, 0)
+        self.assertEqual(failed_targets, ['111111111111'])
+
+class ProcessRegionFromStoreTestCase(unittest.TestCase):
+    def test_reconciles_then_reads_due_set(self):
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        store = ec2_state_mgmt.MemoryScheduleStore()
+        client = MockEc2Client(describe_pages=[describe_page(
+            ('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }]),
+            ('i-2', 'running', [{ 'Key': 'ec2_stop', 'Value': '07:00' }]),
+            ('i-3', 'running', [{ 'Key': 'Name', 'Value': 'unscheduled' }])
+        )])
+        resource = MockEc2Resource(None, client=client)
+
+        with unittest.mock.patch.object(ec2_state_mgmt, 'get_schedule_store', return_value=store):
+            self.assertEqual(ec2_state_mgmt.process_region(resource, {}, now, 'us-east-2'), 0)
+            self.assertEqual(len(client.describe_calls), 1)
+            self.assertEqual(client.calls, [('start', ['i-1']), ('stop', ['i-2'])])
+
+            # reconciled recently, so the next tick never describes instances
+            ec2_state_mgmt.process_region(resource, {}, now, 'us-east-2')
+            self.assertEqual(len(client.describe_calls), 1)
+
+            ec2_state_mgmt.process_region(resource, { 'reconcile': True }, now, 'us-east-2')
+            self.assertEqual(len(client.describe_calls), 2)
+
+class GetScheduleEntriesTestCase(unittest.TestCase):
+    def test_zoned_instances_excluded(self):
+        records = [
+            ec2_state_mgmt.InstanceRecord('i-1', 'running', { 'ec2_stop': '18:00' }),
+            ec2_state_mgmt.InstanceRecord('i-2', 'running', { 'ec2_stop': '18:00', 'ec2_timezone': 'Asia/Tokyo' }),
+            ec2_state_mgmt.InstanceRecord('i-3', 'running', { 'ec2_stop': '18:00', 'ec2_timezone': 'Europe/Paris' })
+        ]
+
+        with unittest.mock.patch.dict(os.environ, { 'STATE_MGMT_TIMEZONE': 'Europe/Paris' }):
+            self.assertEqual(ec2_state_mgmt.get_schedule_entries(records), {
+                'i-1': ((None, 72, False), 'running'),
+                'i-3': ((None, 72, False), 'running')
+            })
+
+    def test_cron_scheduled_instances_excluded(self):
+        # ec2_schedule overrides ec2_start/ec2_stop in classification, so the store and wheel must not act on them
+        records = [ec2_state_mgmt.InstanceRecord('i-1', 'running', { 'ec2_stop': '18:00', 'ec2_schedule': 'stop 0 20 mon-fri' })]
+
+        self.assertIsNone(ec2_state_mgmt.get_schedule(records[0].tag_dict))
+        self.assertEqual(ec2_state_mgmt.get_schedule_entries(records), {})
+
+class ProcessRegionFromWheelTestCase(unittest.TestCase):
+    def test_rebuilds_then_checks_only_slot_instances(self):
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        wheel = ec2_state_mgmt.TimingWheel(ec2_state_mgmt.FileWheelBackend(tempfile.mkdtemp()))
+        client = MockEc2Client(describe_pages=[describe_page(
+            ('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }]),
+            ('i-2', 'stopped', [{ 'Key': 'ec2_stop', 'Value': '07:00' }]),
+            ('i-3', 'running', [{ 'Key': 'ec2_stop', 'Value': '18:00' }])
+        )])
+        resource = MockEc2Resource(None, client=client)
+
+        with unittest.mock.patch.object(ec2_state_mgmt, 'get_timing_wheel', return_value=wheel):
+            self.assertEqual(ec2_state_mgmt.process_region(resource, {}, now, 'us-east-2'), 0)
+
+            # a full rebuild sweep, then a state check of just the slot's instances
+            self.assertEqual(len(client.describe_calls), 2)
+            self.assertEqual(client.describe_calls[1]['Filters'], [{ 'Name': 'instance-id', 'Values': ['i-1', 'i-2'] }])
+            self.assertEqual(client.calls, [('start', ['i-1'])])
+
+class EventHandlerTestCase(unittest.TestCase):
+    context = SimpleNamespace(invoked_function_arn='arn:aws:lambda:us-east-2:111111111111:function:ec2-state-mgmt')
+
+    def setUp(self):
+        self.store = ec2_state_mgmt.MemoryScheduleStore()
+        self.store.put('us-east-2', 'i-1', (28, 72, False), 'stopped')
+
+    def handle(self, event, client=None):
+        with unittest.mock.patch.object(ec2_state_mgmt, 'get_schedule_store', return_value=self.store), \
+            unittest.mock.patch.object(runtime, 'get_ec2_resource', return_value=MockEc2Resource(None, client=client)):
+            ec2_state_mgmt.event_handler({ 'account': '111111111111', 'region': 'us-east-2', **event }, self.context)
+
+    def test_state_change(self):
+        self.handle({ 'detail-type': 'EC2 Instance State-change Notification', 'detail': { 'instance-id': 'i-1', 'state': 'running' } })
+        self.assertEqual(self.store.items[('us-east-2', 'i-1')][1], 'running')
+
+    def test_terminated(self):
+        self.handle({ 'detail-type': 'EC2 Instance State-change Notification', 'detail': { 'instance-id': 'i-1', 'state': 'terminated' } })
+        self.assertEqual(self.store.items, {})
+
+    def test_tag_change(self):
+        client = MockEc2Client(describe_pages=[describe_page(
+            ('i-1', 'stopped', [{ 'Key': 'Name', 'Value': 'untagged' }]),
+            ('i-2', 'running', [{ 'Key': 'ec2_stop', 'Value': '18:00' }])
+        )])
+        self.handle({ 'detail-type': 'AWS API Call via CloudTrail', 'detail': {
+            'eventName': 'CreateTags',
+            'requestParameters': { 'resourcesSet': { 'items': [{ 'resourceId': 'i-1' }, { 'resourceId': 'i-2' }, { 'resourceId': 'vol-1' }] } }
+        }}, client)
+
+        self.assertEqual(self.store.items, { ('us-east-2', 'i-2'): ((None, 72, False), 'running') })
+        self.assertEqual(client.describe_calls[0]['Filters'], [{ 'Name': 'instance-id', 'Values': ['i-1', 'i-2'] }])
+
+    def test_other_account_scope(self):
+        self.handle({ 'account': '222222222222', 'detail-type': 'EC2 Instance State-change Notification',
+            'detail': { 'instance-id': 'i-1', 'state': 'terminated' } })
+        self.assertEqual(len(self.store.items), 1)
+
+class LambdaHandlerTestCase(unittest.TestCase):
+    def test_failure_notification(self):
+        sns = unittest.mock.Mock()
+        resource = MockEc2Resource(
+            [[MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }])]],
+            client=MockEc2Client(bad_ids=['i-1'])
+        )
+
+        with unittest.mock.patch.dict(os.environ, { 'NOTIFICATION_ARN': 'arn:aws:sns:us-east-2:111111111111:test', 'AWS_REGION': 'us-east-2' }), \
+            unittest.mock.patch.object(ec2_state_mgmt, 'datetime', wraps=datetime) as mock_datetime, \
+            unittest.mock.patch.object(ec2_state_mgmt, 'get_ec2_resource', return_value=resource), \
+            unittest.mock.patch.object(ec2_state_mgmt, 'get_client', return_value=sns):
+            mock_datetime.now.return_value = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+
+            with self.assertRaises(ec2_state_mgmt.RecoveredError):
+                ec2_state_mgmt.lambda_handler({}, None)
+
+        self.assertEqual(sns.publish.call_count, 1)
+
+class FakeContext:
+    aws_request_id = '00000000-0000-0000-0000-000000000001'
+    invoked_function_arn = 'arn:aws:lambda:us-east-2:111111111111:function:ec2-state-mgmt'
+
+    def __init__(self, remaining):
+        # remaining times reported on successive calls, the last one repeating
+        self.remaining = list(remaining)
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining.pop(0) if len(self.remaining) > 1 else self.remaining[0]
+
+class ControlActionsDeadlineTestCase(unittest.TestCase):
+    def test_defers_unsent_batches(self):
+        client = MockEc2Client()
+        actions = { 'start': [f'i-{i}' for i in range(5)], 'stop': ['i-5'] }
+
+        with unittest.mock.patch.object(runtime, 'continuation', ec2_state_mgmt.Continuation(FakeContext([60000, 0]))):
+            with self.assertRaises(ec2_state_mgmt.DeadlineReached) as context:
+                ec2_state_mgmt.control_actions(client, actions, 2)
+
+        self.assertEqual(client.calls, [('start', ['i-0', 'i-1'])])
+        self.assertEqual(context.exception.pending, { 'start': ['i-2', 'i-3', 'i-4'], 'stop': ['i-5'] })
+
+    def test_no_context(self):
+        client = MockEc2Client()
+
+        self.assertEqual(ec2_state_mgmt.control_actions(client, { 'start': ['i-0'], 'stop': [] }, 2), 0)
+        self.assertEqual(client.calls, [('start', ['i-0'])])
+
+class ContinuationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.environ = unittest.mock.patch.dict(os.environ, {
+            'AWS_REGION': 'us-east-2',
+            'STATE_MGMT_CHECKPOINT_STORE': 'file',
+            'STATE_MGMT_CHECKPOINT_LOCATION': self.directory
+        })
+        self.environ.start()
+        self.addCleanup(self.environ.stop)
+        self.addCleanup(setattr, runtime, 'continuation', ec2_state_mgmt.Continuation())
+
+    def test_checkpoint_and_resume(self):
+        now = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+        resource = MockEc2Resource([[
+            MockInstance(f'i-{i}', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }]) for i in range(4)
+        ]])
+        lambda_client = unittest.mock.Mock()
+
+        with unittest.mock.patch.object(ec2_state_mgmt, 'datetime', wraps=datetime) as mock_datetime, \
+            unittest.mock.patch.object(ec2_state_mgmt, 'get_ec2_resource', return_value=resource), \
+            unittest.mock.patch.object(ec2_state_mgmt, 'get_client', return_value=lambda_client):
+            mock_datetime.now.return_value = now
+
+            # the deadline is reached once the first batch has been sent
+            ec2_state_mgmt.lambda_handler({ 'action_batch_size': 2 }, FakeContext([60000, 60000, 0]))
+
+        self.assertEqual(resource.meta.client.calls, [('start', ['i-0', 'i-1'])])
+
+        backend = ec2_state_mgmt.FileWheelBackend(self.directory)
+        key = f'checkpoints/{FakeContext.aws_request_id}'
+        self.assertEqual(backend.get(key), {
+            'tick': now.isoformat(),
+            'scopes': { 'us-east-2': { 'start': ['i-2', 'i-3'] } },
+            'done': False
+        })
+
+        invoke = lambda_client.invoke.call_args.kwargs
+        self.assertEqual(invoke['FunctionName'], FakeContext.invoked_function_arn)
+        self.assertEqual(invoke['InvocationType'], 'Event')
+        payload = json.loads(invoke['Payload'])
+        self.assertEqual(payload, { 'action_batch_size': 2, 'resume_checkpoint': key, 'continuation_depth': 1 })
+
+        # i-3 was started by hand in the meantime, so only i-2 is still to be started
+        resumed = MockEc2Resource([], client=MockEc2Client(describe_pages=[describe_page(('i-2', 'stopped', []), ('i-3', 'running', []))]))
+        lambda_client.reset_mock()
+        with unittest.mock.patch.object(ec2_state_mgmt, 'get_scope_ec2_resource', return_value=resumed), \
+            unittest.mock.patch.object(ec2_state_mgmt, 'get_client', return_value=lambda_client):
+            ec2_state_mgmt.lambda_handler(payload, FakeContext([60000]))
+
+            self.assertEqual(resumed.meta.client.calls, [('start', ['i-2'])])
+            self.assertTrue(backend.get(key)['done'])
+            lambda_client.invoke.assert_not_called()
+
+            # a duplicate delivery of the continuation is a no-op
+            ec2_state_mgmt.lambda_handler(payload, FakeContext([60000]))
+
+            self.assertEqual(resumed.meta.client.calls, [('start', ['i-2'])])
+
+    def test_resume_account_scope(self):
+        runtime.assumed_roles.clear()
+        self.addCleanup(runtime.assumed_roles.clear)
+        backend = ec2_state_mgmt.FileWheelBackend(self.directory)
+        backend.put('checkpoints/account', {
+            'tick': '2020-06-26T07:03:00+00:00', 'scopes': { '222222222222/us-east-2': { 'start': ['i-2'] } }, 'done': False
+        })
+        resumed = MockEc2Resource([], client=MockEc2Client(describe_pages=[describe_page(('i-2', 'stopped', []))]))
+        sts = MockStsClient(timedelta(hours=1))
+
+        # the roles only ever came with the payload, which continuations carry over
+        with unittest.mock.patch.object(runtime, 'get_client', return_value=sts), \
+            unittest.mock.patch.object(runtime, 'build_resource', return_value=resumed):
+            ec2_state_mgmt.lambda_handler({
+                'role_arns': ['arn:aws:iam::222222222222:role/test'], 'resume_checkpoint': 'checkpoints/account', 'continuation_depth': 1
+            }, FakeContext([60000]))
+
+        self.assertEqual(sts.calls, ['arn:aws:iam::222222222222:role/test'])
+        self.assertEqual(resumed.meta.client.calls, [('start', ['i-2'])])
+        self.assertTrue(backend.get('checkpoints/account')['done'])
+
+    def test_continuation_limit(self):
+        resource = MockEc2Resource([[MockInstance('i-0', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }])]])
+
+        with unittest.mock.patch.object(ec2_state_mgmt, 'get_ec2_resource', return_value=resource), \
+            unittest.mock.patch.object(ec2_state_mgmt, 'get_client', return_value=unittest.mock.Mock()):
+            with self.assertRaises(ec2_state_mgmt.RecoveredError):
+                ec2_state_mgmt.lambda_handler({ 'continuation_depth': 10 }, FakeContext([0]))
+
+class ImportTimeTestCase(unittest.TestCase):
+    # generous, to avoid flakiness on slow CI agents; the real guard is which modules get loaded
+    budget_ms = int(os.environ.get('IMPORT_TIME_BUDGET_MS') or 250)
+
+    def test_import_time(self):
+        src = os.path.dirname(os.path.realpath(__file__)) + '/../src'
+        env = { key: value for key, value in os.environ.items() if key != 'STATE_MGMT_XRAY' }
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import sys, ec2_state_mgmt; print(",".join(sys.modules))'],
+            cwd=src, env=env, capture_output=True, text=True, check=True
+        )
+
+        modules = result.stdout.strip().split(',')
+        for heavy_module in ['boto3', 'botocore', 'aws_xray_sdk']:
+            with self.subTest(module=heavy_module):
+                self.assertNotIn(heavy_module, modules)
+
+        cumulative_us = [int(line.split('|')[1]) for line in result.stderr.splitlines() if line.rstrip().endswith('| ec2_state_mgmt')]
+        self.assertEqual(len(cumulative_us), 1)
+        self.assertLess(cumulative_us[0] / 1000, self.budget_ms)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# pylint: skip-file
+
+import unittest
+import unittest.mock
+from datetime import datetime
+from types import SimpleNamespace
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
+
+import ec2_state_mgmt
+import hibernation
+import runtime
+from botocore.exceptions import ClientError
+from tests.test_ec2_state_mgmt import MockEc2Client, MockEc2Resource, MockInstance
+
+ec2_state_mgmt.logger.disabled = True
+ec2_state_mgmt.metrics.emf_logger.disabled = True
+
+class HibernatingEc2Client(MockEc2Client):
+    ''' Fails hibernation requests for the instances not configured for it, as EC2 does. '''
+    def __init__(self, unsupported_ids=None):
+        super().__init__()
+        self.unsupported_ids = unsupported_ids or []
+        self.tag_calls = []
+
+    def stop_instances(self, InstanceIds, Hibernate=False):
+        if not Hibernate:
+            return self._control('stop', InstanceIds)
+
+        self.calls.append(('hibernate', list(InstanceIds)))
+        if any(instance_id in self.unsupported_ids for instance_id in InstanceIds):
+            raise ClientError({ 'Error': { 'Code': 'UnsupportedHibernationConfiguration', 'Message': 'mock failure' } }, 'StopInstances')
+        return {}
+
+    def create_tags(self, Resources, Tags):
+        self.tag_calls.append((list(Resources), Tags))
+
+class SplitStopsTestCase(unittest.TestCase):
+    def test_tag_and_default(self):
+        tagged = MockInstance('i-1', 'running', [{ 'Key': 'ec2_hibernate', 'Value': 'true' }], True)
+        opted_out = MockInstance('i-2', 'running', [{ 'Key': 'ec2_hibernate', 'Value': 'false' }], True)
+        untagged = MockInstance('i-3', 'running', [], True)
+
+        self.assertEqual(hibernation.split_stops([tagged, opted_out, untagged]), ([tagged], [opted_out, untagged]))
+        with unittest.mock.patch.dict(os.environ, { 'STATE_MGMT_HIBERNATE': 'true' }):
+            self.assertEqual(hibernation.split_stops([tagged, opted_out, untagged]), ([tagged, untagged], [opted_out]))
+
+    def test_unconfigured_instances_stopped(self):
+        configured = MockInstance('i-1', 'running', [], True)
+        unconfigured = MockInstance('i-2', 'running', [])
+        record = ec2_state_mgmt.InstanceRecord('i-3', 'running', { 'ec2_hibernate': 'true' })
+
+        with unittest.mock.patch.dict(os.environ, { 'STATE_MGMT_HIBERNATE': 'true' }):
+            self.assertEqual(hibernation.split_stops([configured, unconfigured, record]), ([configured], [unconfigured, record]))
+
+class HibernateBatchTestCase(unittest.TestCase):
+    def test_separate_batches(self):
+        client = HibernatingEc2Client()
+        instances = [
+            MockInstance('i-1', 'running', [{ 'Key': 'ec2_hibernate', 'Value': 'true' }], True),
+            MockInstance('i-2', 'running', [])
+        ]
+
+        self.assertEqual(ec2_state_mgmt.action_instances(client, [], instances, 50), 0)
+        self.assertEqual(client.calls, [('stop', ['i-2']), ('hibernate', ['i-1'])])
+
+    def test_unconfigured_fleet_stopped_in_one_batch(self):
+        client = HibernatingEc2Client(unsupported_ids=[f'i-{n}' for n in range(50)])
+        instances = [MockInstance(f'i-{n}', 'running', []) for n in range(50)]
+
+        with unittest.mock.patch.dict(os.environ, { 'STATE_MGMT_HIBERNATE': 'true' }):
+            self.assertEqual(ec2_state_mgmt.action_instances(client, [], instances, 50), 0)
+        self.assertEqual(client.calls, [('stop', [f'i-{n}' for n in range(50)])])
+
+    def test_fallback_to_stop(self):
+        client = HibernatingEc2Client(unsupported_ids=['i-2'])
+
+        self.assertEqual(ec2_state_mgmt.control_instances(client, 'hibernate', ['i-1', 'i-2'], 50), 0)
+        self.assertEqual(client.calls, [('hibernate', ['i-1', 'i-2']), ('hibernate', ['i-1']), ('hibernate', ['i-2']), ('stop', ['i-2'])])
+
+    def test_tracking_tags(self):
+        client = HibernatingEc2Client()
+        with unittest.mock.patch.dict(os.environ, { 'STATE_MGMT_TRACK_RESUME_LATENCY': 'true' }), \
+            unittest.mock.patch.object(hibernation.time, 'time', return_value=1593155000.0):
+            ec2_state_mgmt.control_instances(client, 'hibernate', ['i-1'], 50)
+            ec2_state_mgmt.control_instances(client, 'start', ['i-2'], 50)
+
+        self.assertEqual(client.tag_calls, [
+            (['i-1'], [{ 'Key': 'ec2_stop_mode', 'Value': 'hibernate' }]),
+            (['i-2'], [{ 'Key': 'ec2_start_requested_at', 'Value': '1593155000.000' }])
+        ])
+
+    def test_tracking_off_by_default(self):
+        client = HibernatingEc2Client()
+        ec2_state_mgmt.control_instances(client, 'stop', ['i-1'], 50)
+
+        self.assertEqual(client.tag_calls, [])
+
+class ResumeLatencyTestCase(unittest.TestCase):
+    context = SimpleNamespace(invoked_function_arn='arn:aws:lambda:us-east-2:111111111111:function:ec2-state-mgmt')
+
+    def make_client(self, tags):
+        client = unittest.mock.Mock()
+        client.describe_tags.return_value = { 'Tags': [{ 'Key': key, 'Value': value } for key, value in tags.items()] }
+        return client
+
+    def make_event(self):
+        return {
+            'account': '111111111111',
+            'region': 'us-east-2',
+            'time': '2020-06-26T07:01:30Z',
+            'detail-type': 'EC2 Instance State-change Notification',
+            'detail': { 'instance-id': 'i-1', 'state': 'running' }
+        }
+
+    def test_record(self):
+        started_at = datetime.fromisoformat('2020-06-26T07:00:00+00:00').timestamp()
+        client = self.make_client({ 'ec2_stop_mode': 'hibernate', 'ec2_start_requested_at': f'{started_at:.3f}' })
+
+        with unittest.mock.patch.object(ec2_state_mgmt.metrics, 'emit_value') as emit_value:
+            self.assertEqual(hibernation.record_resume_latency(client, self.make_event()), 90)
+
+        emit_value.assert_called_once_with('ResumeLatency', 90000, { 'Account': '111111111111', 'Region': 'us-east-2', 'StopMode': 'hibernate' },
+            'ec2-state-mgmt')
+        client.delete_tags.assert_called_once_with(Resources=['i-1'], Tags=[{ 'Key': 'ec2_start_requested_at' }])
+
+    def test_untracked_start(self):
+        client = self.make_client({ 'ec2_stop_mode': 'stop' })
+
+        with unittest.mock.patch.object(ec2_state_mgmt.metrics, 'emit_value') as emit_value:
+            self.assertIsNone(hibernation.record_resume_latency(client, self.make_event()))
+
+        emit_value.assert_not_called()
+        client.delete_tags.assert_not_called()
+
+    def test_event_handler(self):
+        resource = MockEc2Resource(None)
+        with unittest.mock.patch.dict(os.environ, { 'STATE_MGMT_TRACK_RESUME_LATENCY': 'true' }), \
+            unittest.mock.patch.object(runtime, 'get_ec2_resource', return_value=resource), \
+            unittest.mock.patch.object(hibernation, 'record_resume_latency') as record_resume_latency:
+            ec2_state_mgmt.event_handler(self.make_event(), self.context)
+            # the lambda's own tracking tags are not schedule changes
+            ec2_state_mgmt.event_handler({ **self.make_event(), 'detail-type': 'AWS API Call via CloudTrail', 'detail': {
+                'eventName': 'CreateTags',
+                'requestParameters': {
+                    'resourcesSet': { 'items': [{ 'resourceId': 'i-1' }] },
+                    'tagSet': { 'items': [{ 'key': 'ec2_stop_mode', 'value': 'hibernate' }] }
+                }
+            }}, self.context)
+
+        record_resume_latency.assert_called_once_with(resource.meta.client, self.make_event())
+
+
+if __name__ == '__main__':
+    unittest.main()
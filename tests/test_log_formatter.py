@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# pylint: skip-file
+
+import unittest
+import unittest.mock
+import sys
+import os
+import json
+import logging
+from datetime import datetime
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
+
+import log_formatter
+
+def make_record(msg, args=None, exc_info=None, **extra):
+    record = logging.LogRecord('root', logging.WARNING, __file__, 1, msg, args, exc_info)
+    record.__dict__.update(extra)
+    return record
+
+class JsonFormatterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.formatter = log_formatter.JsonFormatter()
+
+    def test_format(self):
+        record = make_record('Starting instances %s', ('i-1',), decisions={ 'reasons': { 'start_due': 1 } }, when=datetime(2020, 6, 26))
+        output = json.loads(self.formatter.format(record))
+
+        self.assertEqual(list(output), ['message', 'decisions', 'when', 'timestamp', 'level'])
+        self.assertEqual(output['message'], 'Starting instances i-1')
+        self.assertEqual(output['decisions'], { 'reasons': { 'start_due': 1 } })
+        self.assertEqual(output['when'], '2020-06-26T00:00:00')
+        self.assertEqual(output['timestamp'], datetime.fromtimestamp(record.created, log_formatter.timezone.utc).isoformat())
+        self.assertEqual(output['level'], 'WARNING')
+
+    def test_level_field(self):
+        output = json.loads(self.formatter.format(make_record('message', level='notice')))
+
+        self.assertEqual(output['level'], 'NOTICE')
+
+    def test_dict_message(self):
+        output = json.loads(self.formatter.format(make_record({ 'action': 'start' })))
+
+        self.assertEqual((output['message'], output['action']), ('', 'start'))
+
+    def test_exc_info(self):
+        try:
+            raise RuntimeError('failed')
+        except RuntimeError:
+            output = json.loads(self.formatter.format(make_record('message', exc_info=sys.exc_info())))
+
+        self.assertIn('RuntimeError: failed', output['exc_info'])
+
+    def test_json_fallback(self):
+        record = make_record('message', when=datetime(2020, 6, 26), other=object)
+        with unittest.mock.patch.object(log_formatter, 'orjson', None):
+            fallback = json.loads(self.formatter.format(record))
+
+        self.assertEqual(fallback, json.loads(self.formatter.format(record)))
+        self.assertEqual(fallback['other'], "<class 'object'>")
+
+
+if __name__ == '__main__':
+    unittest.main()
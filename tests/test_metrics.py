@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# pylint: skip-file
+
+import unittest
+import unittest.mock
+import sys
+import os
+import json
+import threading
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
+
+import metrics
+
+class ScopeMetricsTestCase(unittest.TestCase):
+    def test_to_emf(self):
+        recorder = metrics.ScopeMetrics('111111111111', 'us-east-2', 'PHASE_ONE')
+        recorder.add('InstancesSeen', 10)
+        recorder.add('InstancesSeen', 5)
+        recorder.add('InventoryTime', 1.23456)
+
+        record = recorder.to_emf('test', timestamp=1593155000)
+
+        self.assertEqual(record['_aws'], {
+            'Timestamp': 1593155000000,
+            'CloudWatchMetrics': [{
+                'Namespace': 'test',
+                'Dimensions': [['Account', 'Region'], ['Account', 'Region', 'HourPhase']],
+                'Metrics': [{ 'Name': 'InventoryTime', 'Unit': 'Milliseconds' }, { 'Name': 'InstancesSeen', 'Unit': 'Count' }]
+            }]
+        })
+        self.assertEqual(record['Account'], '111111111111')
+        self.assertEqual(record['Region'], 'us-east-2')
+        self.assertEqual(record['HourPhase'], 'PHASE_ONE')
+        self.assertEqual(record['InstancesSeen'], 15)
+        self.assertEqual(record['InventoryTime'], 1.235)
+
+    def test_stage(self):
+        recorder = metrics.ScopeMetrics('self', 'us-east-2', 'PHASE_ONE')
+        with self.assertRaises(RuntimeError):
+            with recorder.stage('InventoryTime'):
+                raise RuntimeError
+
+        self.assertGreaterEqual(recorder.values['InventoryTime'], 0)
+
+class RecordingTestCase(unittest.TestCase):
+    def test_thread_local(self):
+        recorder = metrics.ScopeMetrics('self', 'us-east-2', 'PHASE_ONE')
+        seen = []
+
+        with metrics.recording(recorder):
+            metrics.current().add('PagesFetched', 1)
+            thread = threading.Thread(target=lambda: seen.append(metrics.current()))
+            thread.start()
+            thread.join()
+
+        self.assertIs(seen[0], metrics.NULL_METRICS)
+        self.assertIs(metrics.current(), metrics.NULL_METRICS)
+        self.assertEqual(recorder.values, { 'PagesFetched': 1 })
+
+    def test_emit(self):
+        recorder = metrics.ScopeMetrics('self', 'us-east-2', 'PHASE_ONE')
+        recorder.add('Failures', 0)
+
+        with unittest.mock.patch.object(metrics.emf_logger, 'disabled', False), self.assertLogs(metrics.emf_logger) as logs:
+            metrics.emit(recorder)
+
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn('"Failures": 0', logs.records[0].getMessage())
+
+    def test_emit_value(self):
+        with unittest.mock.patch.object(metrics.emf_logger, 'disabled', False), self.assertLogs(metrics.emf_logger) as logs:
+            metrics.emit_value('ResumeLatency', 1234.5678, { 'Region': 'us-east-2', 'StopMode': 'hibernate' }, 'test')
+
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['_aws']['CloudWatchMetrics'], [{
+            'Namespace': 'test',
+            'Dimensions': [['Region', 'StopMode']],
+            'Metrics': [{ 'Name': 'ResumeLatency', 'Unit': 'Milliseconds' }]
+        }])
+        self.assertEqual((record['Region'], record['StopMode'], record['ResumeLatency']), ('us-east-2', 'hibernate', 1234.568))
+
+
+if __name__ == '__main__':
+    unittest.main()
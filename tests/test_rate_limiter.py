@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# pylint: skip-file
+
+import threading
+import unittest
+import sys
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+import rate_limiter
+
+rate_limiter.logger.disabled = True
+
+THROTTLED_RESPONSE = b'''<?xml version="1.0" encoding="UTF-8"?>
+<Response><Errors><Error><Code>RequestLimitExceeded</Code><Message>Request limit exceeded.</Message></Error></Errors>
+<RequestID>00000000-0000-0000-0000-000000000000</RequestID></Response>'''
+
+START_RESPONSE = b'''<?xml version="1.0" encoding="UTF-8"?>
+<StartInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">
+<requestId>00000000-0000-0000-0000-000000000000</requestId><instancesSet/></StartInstancesResponse>'''
+
+class FakeThrottlingEndpoint(BaseHTTPRequestHandler):
+    ''' Fake EC2 endpoint, throttling the first `throttle_count` requests it receives. '''
+    throttle_count = 0
+    request_count = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        type(self).request_count += 1
+
+        throttled = type(self).request_count <= type(self).throttle_count
+        body = THROTTLED_RESPONSE if throttled else START_RESPONSE
+        self.send_response(503 if throttled else 200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class RateLimiterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = rate_limiter.RateLimiter(10, burst=2)
+        self.limiter.clock = self.clock
+        self.limiter.sleep = self.clock.sleep
+
+    def test_token_bucket(self):
+        waits = [self.limiter.acquire() for _ in range(4)]
+
+        self.assertEqual(waits[:2], [0.0, 0.0])
+        self.assertAlmostEqual(waits[2], 0.1)
+        self.assertAlmostEqual(waits[3], 0.1)
+
+        # a full second refills the bucket, but never beyond its burst capacity
+        self.clock.now += 1
+        self.assertEqual([self.limiter.acquire() for _ in range(2)], [0.0, 0.0])
+        self.assertGreater(self.limiter.acquire(), 0)
+
+    def test_adaptive_rate(self):
+        self.limiter.record_throttle()
+        self.assertEqual(self.limiter.rate, 5.0)
+
+        for _ in range(5):
+            self.limiter.record_throttle()
+        self.assertEqual(self.limiter.rate, self.limiter.min_rate)
+
+        for _ in range(100):
+            self.limiter.record_success()
+        self.assertEqual(self.limiter.rate, 10.0)
+
+    def test_backoff(self):
+        for attempt in range(1, 10):
+            with self.subTest(attempt=attempt):
+                self.assertLessEqual(self.limiter.get_backoff(attempt), min(self.limiter.max_delay, self.limiter.base_delay * 2 ** attempt))
+
+    def test_pop_metrics(self):
+        self.limiter.acquire()
+        self.limiter.record_throttle()
+
+        self.assertEqual(self.limiter.pop_metrics(), { 'calls': 1, 'throttles': 1, 'wait_seconds': 0.0 })
+        self.assertEqual(self.limiter.pop_metrics(), { 'calls': 0, 'throttles': 0, 'wait_seconds': 0.0 })
+
+    def test_ignores_clients_without_events(self):
+        rate_limiter.attach_rate_limiter(object(), self.limiter)
+
+class ThrottlingEndpointTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeThrottlingEndpoint)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        FakeThrottlingEndpoint.request_count = 0
+        self.client = boto3.session.Session().client(
+            'ec2',
+            region_name='us-east-2',
+            endpoint_url=f'http://127.0.0.1:{self.server.server_address[1]}',
+            aws_access_key_id='stub',
+            aws_secret_access_key='stub',
+            config=Config(retries={ 'mode': 'standard', 'total_max_attempts': 10 })
+        )
+        self.limiter = rate_limiter.RateLimiter(1000)
+        self.limiter.base_delay = 0.001
+        rate_limiter.attach_rate_limiter(self.client, self.limiter)
+
+    def test_absorbs_throttles(self):
+        FakeThrottlingEndpoint.throttle_count = 3
+
+        self.client.start_instances(InstanceIds=['i-1'])
+
+        self.assertEqual(FakeThrottlingEndpoint.request_count, 4)
+        metrics = self.limiter.pop_metrics()
+        self.assertEqual(metrics['calls'], 4)
+        self.assertEqual(metrics['throttles'], 3)
+        self.assertLess(self.limiter.rate, 1000)
+
+    def test_gives_up_after_max_attempts(self):
+        FakeThrottlingEndpoint.throttle_count = 100
+        self.limiter.max_attempts = 3
+
+        with self.assertRaises(ClientError) as context:
+            self.client.start_instances(InstanceIds=['i-1'])
+
+        self.assertEqual(context.exception.response['Error']['Code'], 'RequestLimitExceeded')
+        self.assertEqual(FakeThrottlingEndpoint.request_count, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
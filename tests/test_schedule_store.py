@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# pylint: skip-file
+
+import unittest
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
+
+import boto3
+from botocore.stub import Stubber, ANY
+
+import schedule_store
+
+schedule_store.logger.disabled = True
+
+class MemoryScheduleStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.store = schedule_store.MemoryScheduleStore()
+        self.store.put('us-east-2', 'i-1', (28, 72, False), 'stopped')
+        self.store.put('us-east-2', 'i-2', (28, None, True), 'stopped')
+        self.store.put('us-east-2', 'i-3', (None, 28, False), 'running')
+        self.store.put('us-west-2', 'i-4', (28, None, False), 'stopped')
+
+    def test_due(self):
+        self.assertEqual(self.store.due('us-east-2', 28, False), (['i-1', 'i-2'], ['i-3']))
+        self.assertEqual(self.store.due('us-east-2', 28, True), (['i-2'], ['i-3']))
+        self.assertEqual(self.store.due('us-east-2', 72, False), ([], []))
+
+    def test_update_state(self):
+        self.assertIs(self.store.update_state('us-east-2', 'i-1', 'running'), True)
+        self.assertIs(self.store.update_state('us-east-2', 'i-9', 'running'), False)
+        self.assertEqual(self.store.due('us-east-2', 72, False), ([], ['i-1']))
+
+    def test_delete(self):
+        self.store.delete('us-east-2', 'i-3')
+        self.assertEqual(self.store.due('us-east-2', 28, False), (['i-1', 'i-2'], []))
+
+    def test_replace_scope(self):
+        self.assertIsNone(self.store.get_reconciled_at('us-east-2'))
+
+        self.store.replace_scope('us-east-2', { 'i-5': ((28, None, False), 'stopped') })
+
+        self.assertEqual(self.store.due('us-east-2', 28, False), (['i-5'], []))
+        self.assertEqual(self.store.due('us-west-2', 28, False), (['i-4'], []))
+        self.assertIsNotNone(self.store.get_reconciled_at('us-east-2'))
+
+class DynamoDBScheduleStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = boto3.session.Session().client(
+            'dynamodb', region_name='us-east-2', aws_access_key_id='stub', aws_secret_access_key='stub'
+        )
+        self.stubber = Stubber(self.client)
+        self.store = schedule_store.DynamoDBScheduleStore(self.client, 'schedules')
+
+    def tearDown(self):
+        self.stubber.assert_no_pending_responses()
+
+    def test_put(self):
+        self.stubber.add_response('put_item', {}, { 'TableName': 'schedules', 'Item': {
+            'scope': { 'S': 'us-east-2' },
+            'instance_id': { 'S': 'i-1' },
+            'state': { 'S': 'stopped' },
+            'start_on_weekends': { 'BOOL': False },
+            'start_slot': { 'N': '28' },
+            'start_key': { 'S': 'us-east-2#28' }
+        }})
+
+        with self.stubber:
+            self.store.put('us-east-2', 'i-1', (28, None, False), 'stopped')
+
+    def test_due(self):
+        def item(instance_id, state, start_on_weekends=False):
+            return { 'instance_id': { 'S': instance_id }, 'state': { 'S': state }, 'start_on_weekends': { 'BOOL': start_on_weekends } }
+
+        self.stubber.add_response('query', { 'Items': [item('i-1', 'stopped'), item('i-2', 'running'), item('i-3', 'stopped', True)] }, {
+            'TableName': 'schedules',
+            'IndexName': 'start_key-index',
+            'KeyConditionExpression': 'start_key = :key',
+            'ExpressionAttributeValues': { ':key': { 'S': 'us-east-2#28' } }
+        })
+        self.stubber.add_response('query', { 'Items': [item('i-4', 'running'), item('i-5', 'stopping')] }, {
+            'TableName': 'schedules',
+            'IndexName': 'stop_key-index',
+            'KeyConditionExpression': 'stop_key = :key',
+            'ExpressionAttributeValues': { ':key': { 'S': 'us-east-2#28' } }
+        })
+
+        with self.stubber:
+            self.assertEqual(self.store.due('us-east-2', 28, True), (['i-3'], ['i-4']))
+
+    def test_update_state_unknown_instance(self):
+        self.stubber.add_client_error('update_item', 'ConditionalCheckFailedException')
+
+        with self.stubber:
+            self.assertIs(self.store.update_state('us-east-2', 'i-1', 'running'), False)
+
+    def test_replace_scope(self):
+        self.stubber.add_response('query', { 'Items': [
+            { 'instance_id': { 'S': 'i-1' } },
+            { 'instance_id': { 'S': 'i-2' } },
+            { 'instance_id': { 'S': schedule_store.RECONCILED_ITEM_ID } }
+        ]}, None)
+        self.stubber.add_response('batch_write_item', { 'UnprocessedItems': {} }, { 'RequestItems': { 'schedules': [
+            { 'PutRequest': { 'Item': ANY } },
+            { 'DeleteRequest': { 'Key': { 'scope': { 'S': 'us-east-2' }, 'instance_id': { 'S': 'i-2' } } } },
+            { 'PutRequest': { 'Item': ANY } }
+        ]}})
+
+        with self.stubber:
+            self.store.replace_scope('us-east-2', { 'i-1': ((28, None, False), 'stopped') })
+
+    def test_replace_scope_retries_unprocessed_items(self):
+        delays = []
+        self.store.sleep = delays.append
+        unprocessed = { 'schedules': [{ 'DeleteRequest': { 'Key': { 'scope': { 'S': 'us-east-2' }, 'instance_id': { 'S': 'i-2' } } } }] }
+        self.stubber.add_response('query', { 'Items': [{ 'instance_id': { 'S': 'i-2' } }] }, None)
+        self.stubber.add_response('batch_write_item', { 'UnprocessedItems': unprocessed }, None)
+        self.stubber.add_response('batch_write_item', { 'UnprocessedItems': {} }, { 'RequestItems': unprocessed })
+
+        with self.stubber:
+            self.store.replace_scope('us-east-2', {})
+
+        self.assertEqual(len(delays), 1)
+        self.assertLessEqual(delays[0], self.store.base_delay * 2)
+
+    def test_replace_scope_gives_up_on_unprocessed_items(self):
+        delays = []
+        self.store.sleep = delays.append
+        unprocessed = { 'schedules': [{ 'DeleteRequest': { 'Key': { 'scope': { 'S': 'us-east-2' }, 'instance_id': { 'S': 'i-2' } } } }] }
+        self.stubber.add_response('query', { 'Items': [] }, None)
+        for _ in range(self.store.max_attempts):
+            self.stubber.add_response('batch_write_item', { 'UnprocessedItems': unprocessed }, None)
+
+        with self.stubber, self.assertRaises(schedule_store.UnprocessedItemsError):
+            self.store.replace_scope('us-east-2', {})
+
+        self.assertEqual(len(delays), self.store.max_attempts - 1)
+        self.assertTrue(all(delay <= self.store.max_delay for delay in delays))
+
+    def test_get_reconciled_at(self):
+        self.stubber.add_response('get_item', { 'Item': { 'reconciled_at': { 'N': '1593155000.5' } } }, None)
+        self.stubber.add_response('get_item', {}, None)
+
+        with self.stubber:
+            self.assertEqual(self.store.get_reconciled_at('us-east-2'), 1593155000.5)
+            self.assertIsNone(self.store.get_reconciled_at('us-east-2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
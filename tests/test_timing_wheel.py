@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# pylint: skip-file
+
+import io
+import json
+import tempfile
+import unittest
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
+
+import boto3
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+import timing_wheel
+
+timing_wheel.logger.disabled = True
+
+class CountingBackend(timing_wheel.FileWheelBackend):
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.puts = []
+        self.gets = []
+
+    def get(self, key):
+        self.gets.append(key)
+        return super().get(key)
+
+    def put(self, key, document):
+        self.puts.append(key)
+        super().put(key, document)
+
+class TimingWheelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.backend = CountingBackend(self.directory.name)
+        self.wheel = timing_wheel.TimingWheel(self.backend)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_read_empty(self):
+        self.assertEqual(self.wheel.read('us-east-2', 28, False), ([], []))
+        self.assertIsNone(self.wheel.get_rebuilt_at('us-east-2'))
+
+    def test_rebuild(self):
+        self.wheel.rebuild('us-east-2', { 'i-1': (28, 72, False), 'i-2': (28, None, True), 'i-3': (None, 28, False) })
+
+        self.assertEqual(self.wheel.read('us-east-2', 28, False), (['i-1', 'i-2'], ['i-3']))
+        self.assertEqual(self.wheel.read('us-east-2', 28, True), (['i-2'], ['i-3']))
+        self.assertEqual(self.wheel.read('us-east-2', 72, True), ([], ['i-1']))
+        self.assertEqual(self.wheel.read('us-west-2', 28, False), ([], []))
+        self.assertIsNotNone(self.wheel.get_rebuilt_at('us-east-2'))
+
+    def test_update_only_touches_changed_buckets(self):
+        self.wheel.rebuild('us-east-2', { 'i-1': (28, 72, False), 'i-2': (32, 68, False) })
+        self.backend.puts.clear()
+
+        self.assertEqual(self.wheel.update('us-east-2', { 'i-1': (28, 72, False), 'i-2': (36, 68, False) }), 2)
+        self.assertEqual(sorted(self.backend.puts), [
+            f'us-east-2/index/{timing_wheel.TimingWheel._shard("i-2")}', 'us-east-2/weekday/32', 'us-east-2/weekday/36'
+        ])
+
+        self.backend.puts.clear()
+        self.assertEqual(self.wheel.update('us-east-2', { 'i-1': (28, 72, False) }), 0)
+        self.assertEqual(self.backend.puts, [])
+
+    def test_rebuild_removes_missing_instances(self):
+        self.wheel.rebuild('us-east-2', { 'i-1': (28, 72, False), 'i-2': (28, 72, False) })
+        self.wheel.rebuild('us-east-2', { 'i-2': (28, 72, False) })
+
+        self.assertEqual(self.wheel.read('us-east-2', 28, False), (['i-2'], []))
+        self.assertEqual(self.wheel.read('us-east-2', 72, True), ([], ['i-2']))
+
+    def test_rebuilt_at_kept_apart_from_index(self):
+        self.wheel.rebuild('us-east-2', { 'i-1': (28, 72, False) })
+        self.backend.gets.clear()
+
+        self.assertIsNotNone(self.wheel.get_rebuilt_at('us-east-2'))
+        self.assertEqual(self.backend.gets, ['us-east-2/rebuilt_at'])
+
+    def test_index_sharded(self):
+        schedules = { f'i-{n}': (28, 72, False) for n in range(200) }
+        self.wheel.rebuild('us-east-2', schedules)
+
+        self.assertEqual(self.wheel.read_index('us-east-2'), { instance_id: [28, 72, False] for instance_id in schedules })
+        shards = os.listdir(os.path.join(self.directory.name, 'us-east-2', 'index'))
+        self.assertGreater(len(shards), 1)
+        self.assertLessEqual(len(shards), timing_wheel.INDEX_SHARDS)
+
+    def race(self, key_part, changes):
+        # applies another update of the same scope right before this update's first conditional write of a matching document
+        original_put_if = self.backend.put_if
+
+        def put_if(key, document, version):
+            if key_part in key and changes:
+                racing = dict(changes)
+                changes.clear()
+                timing_wheel.TimingWheel(self.backend).update('us-east-2', racing)
+            return original_put_if(key, document, version)
+
+        self.backend.put_if = put_if
+
+    def test_concurrent_index_updates_not_lost(self):
+        # two instances sharing an index shard
+        shard = timing_wheel.TimingWheel._shard('i-0')
+        other = next(f'i-{n}' for n in range(1, 1000) if timing_wheel.TimingWheel._shard(f'i-{n}') == shard)
+        self.race('/index/', { other: (32, None, False) })
+
+        self.wheel.update('us-east-2', { 'i-0': (28, None, False) })
+
+        self.assertEqual(self.wheel.read_index('us-east-2'), { 'i-0': [28, None, False], other: [32, None, False] })
+        self.assertEqual(self.wheel.read('us-east-2', 28, False), (['i-0'], []))
+        self.assertEqual(self.wheel.read('us-east-2', 32, False), ([other], []))
+
+    def test_concurrent_bucket_updates_not_lost(self):
+        self.race('/weekday/28', { 'i-2': (28, None, False) })
+
+        self.wheel.update('us-east-2', { 'i-1': (28, None, False) })
+
+        self.assertEqual(self.wheel.read('us-east-2', 28, False), (['i-1', 'i-2'], []))
+
+    def test_concurrent_moves_of_an_instance(self):
+        self.wheel.update('us-east-2', { 'i-1': (28, None, False) })
+        self.race('/weekday/', { 'i-1': (36, None, False) })
+
+        self.wheel.update('us-east-2', { 'i-1': (32, None, False) })
+
+        # whichever update lands last in the index wins, and the buckets follow it
+        start_slot = self.wheel.read_index('us-east-2')['i-1'][0]
+        for slot in [28, 32, 36]:
+            self.assertEqual(self.wheel.read('us-east-2', slot, False), (['i-1'] if slot == start_slot else [], []))
+
+    def test_update_removal(self):
+        self.wheel.update('us-east-2', { 'i-1': (28, 72, True) })
+        self.wheel.update('us-east-2', { 'i-1': None })
+
+        self.assertEqual(self.wheel.read('us-east-2', 28, True), ([], []))
+        self.assertEqual(self.wheel.read('us-east-2', 72, False), ([], []))
+
+class S3WheelBackendTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = boto3.session.Session().client(
+            's3', region_name='us-east-2', aws_access_key_id='stub', aws_secret_access_key='stub'
+        )
+        self.stubber = Stubber(self.client)
+        self.backend = timing_wheel.S3WheelBackend(self.client, 'wheel-bucket', 'ec2/')
+
+    def tearDown(self):
+        self.stubber.assert_no_pending_responses()
+
+    def test_get(self):
+        body = json.dumps({ 'start': ['i-1'], 'stop': [] }).encode('utf-8')
+        self.stubber.add_response('get_object', { 'Body': StreamingBody(io.BytesIO(body), len(body)) },
+            { 'Bucket': 'wheel-bucket', 'Key': 'ec2/us-east-2/weekday/28.json' })
+        self.stubber.add_client_error('get_object', 'NoSuchKey')
+
+        with self.stubber:
+            self.assertEqual(self.backend.get('us-east-2/weekday/28'), { 'start': ['i-1'], 'stop': [] })
+            self.assertIsNone(self.backend.get('us-east-2/weekday/32'))
+
+    def test_put_if(self):
+        body = b'{"start": [], "stop": []}'
+        self.stubber.add_response('put_object', {}, {
+            'Bucket': 'wheel-bucket', 'Key': 'ec2/us-east-2/weekday/28.json', 'Body': body, 'ContentType': 'application/json',
+            'IfMatch': '"etag"'
+        })
+        self.stubber.add_client_error('put_object', 'PreconditionFailed', http_status_code=412, expected_params={
+            'Bucket': 'wheel-bucket', 'Key': 'ec2/us-east-2/weekday/32.json', 'Body': body, 'ContentType': 'application/json',
+            'IfNoneMatch': '*'
+        })
+
+        with self.stubber:
+            self.assertTrue(self.backend.put_if('us-east-2/weekday/28', { 'start': [], 'stop': [] }, '"etag"'))
+            self.assertFalse(self.backend.put_if('us-east-2/weekday/32', { 'start': [], 'stop': [] }, None))
+
+class DynamoDBWheelBackendTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = boto3.session.Session().client(
+            'dynamodb', region_name='us-east-2', aws_access_key_id='stub', aws_secret_access_key='stub'
+        )
+        self.stubber = Stubber(self.client)
+        self.backend = timing_wheel.DynamoDBWheelBackend(self.client, 'wheel')
+
+    def tearDown(self):
+        self.stubber.assert_no_pending_responses()
+
+    def test_round_trip(self):
+        self.stubber.add_response('put_item', {}, { 'TableName': 'wheel', 'Item': {
+            'key': { 'S': 'us-east-2/weekday/28' },
+            'document': { 'S': '{"start": ["i-1"], "stop": []}' }
+        }})
+        self.stubber.add_response('get_item', { 'Item': { 'document': { 'S': '{"start": ["i-1"], "stop": []}' } } },
+            { 'TableName': 'wheel', 'Key': { 'key': { 'S': 'us-east-2/weekday/28' } }, 'ConsistentRead': True })
+        self.stubber.add_response('get_item', {}, None)
+
+        with self.stubber:
+            self.backend.put('us-east-2/weekday/28', { 'start': ['i-1'], 'stop': [] })
+            self.assertEqual(self.backend.get('us-east-2/weekday/28'), { 'start': ['i-1'], 'stop': [] })
+            self.assertIsNone(self.backend.get('us-east-2/weekday/32'))
+
+    def test_put_if(self):
+        self.stubber.add_response('get_item', { 'Item': { 'document': { 'S': '{"start": []}' }, 'version': { 'N': '3' } } }, None)
+        self.stubber.add_response('put_item', {}, {
+            'TableName': 'wheel',
+            'Item': { 'key': { 'S': 'us-east-2/weekday/28' }, 'document': { 'S': '{"start": ["i-1"]}' }, 'version': { 'N': '4' } },
+            'ConditionExpression': 'attribute_not_exists(#version) OR #version = :version',
+            'ExpressionAttributeNames': { '#version': 'version' },
+            'ExpressionAttributeValues': { ':version': { 'N': '3' } }
+        })
+        self.stubber.add_client_error('put_item', 'ConditionalCheckFailedException', expected_params={
+            'TableName': 'wheel',
+            'Item': { 'key': { 'S': 'us-east-2/weekday/32' }, 'document': { 'S': '{"start": ["i-1"]}' }, 'version': { 'N': '1' } },
+            'ConditionExpression': 'attribute_not_exists(#key)',
+            'ExpressionAttributeNames': { '#key': 'key' }
+        })
+
+        with self.stubber:
+            document, version = self.backend.get_versioned('us-east-2/weekday/28')
+            self.assertEqual((document, version), ({ 'start': [] }, 3))
+            self.assertTrue(self.backend.put_if('us-east-2/weekday/28', { 'start': ['i-1'] }, version))
+            self.assertFalse(self.backend.put_if('us-east-2/weekday/32', { 'start': ['i-1'] }, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
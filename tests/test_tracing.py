@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# pylint: skip-file
+
+import unittest
+import unittest.mock
+from datetime import datetime
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
+
+from aws_xray_sdk.core import AWSXRayRecorder
+from aws_xray_sdk.core.context import Context
+
+import ec2_state_mgmt
+import async_engine
+import tracing
+from tests.test_ec2_state_mgmt import MockEc2Client, MockEc2Resource, MockInstance
+
+ec2_state_mgmt.logger.disabled = True
+ec2_state_mgmt.metrics.emf_logger.disabled = True
+
+NOW = datetime.fromisoformat('2020-06-26T07:03:00+00:00')
+
+class InMemoryEmitter:
+    ''' X-Ray emitter keeping every entity sent in memory, instead of sending it to the daemon. '''
+    def __init__(self):
+        self.entities = []
+
+    def send_entity(self, entity):
+        self.entities.append(entity)
+
+    def set_daemon_address(self, address):
+        pass
+
+    @property
+    def daemon_address(self):
+        return None
+
+def make_resources():
+    return {
+        'us-east-1': MockEc2Resource([[
+            MockInstance('i-1', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }]),
+            MockInstance('i-2', 'stopped', [{ 'Key': 'ec2_start', 'Value': '07:00' }]),
+            MockInstance('i-3', 'running', [])
+        ]], client=MockEc2Client(bad_ids=['i-2'])),
+        'us-east-2': MockEc2Resource([[MockInstance('i-4', 'running', [{ 'Key': 'ec2_stop', 'Value': '07:00' }])]])
+    }
+
+class TracingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.emitter = InMemoryEmitter()
+        self.recorder = AWSXRayRecorder()
+        self.recorder.emitter._socket.close()
+        self.recorder.configure(emitter=self.emitter, context=Context(), sampling=False, streaming_threshold=1000)
+
+        patcher = unittest.mock.patch.object(tracing, 'recorder', self.recorder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def trace(self, func):
+        self.recorder.begin_segment('ec2-state-mgmt')
+        func()
+        self.recorder.end_segment()
+
+        self.assertEqual(len(self.emitter.entities), 1)
+        return { subsegment.annotations['scope']: subsegment for subsegment in self.emitter.entities[0].subsegments }
+
+    def check_scopes(self, scopes):
+        self.assertEqual(sorted(scopes), ['us-east-1', 'us-east-2'])
+
+        children = { subsegment.name: subsegment for subsegment in scopes['us-east-1'].subsegments }
+        self.assertEqual(scopes['us-east-1'].annotations['failed'], 1)
+        self.assertEqual(children['inventory'].annotations['instances_seen'], 3)
+        self.assertEqual(children['classification'].annotations, { 'start_due': 2, 'stop_due': 0 })
+        self.assertEqual(children['start_batch'].annotations, { 'action': 'start', 'batch_size': 2, 'failed': 1 })
+
+        children = { subsegment.name: subsegment for subsegment in scopes['us-east-2'].subsegments }
+        self.assertEqual(children['stop_batch'].annotations, { 'action': 'stop', 'batch_size': 1, 'failed': 0 })
+
+    def test_thread_engine(self):
+        self.check_scopes(self.trace(lambda: ec2_state_mgmt.process_regions(make_resources(), {}, NOW, 2)))
+
+    def test_async_engine(self):
+        self.check_scopes(self.trace(lambda: ec2_state_mgmt.run_async_engine({}, NOW, make_resources(), [], [])))
+
+    def test_exception(self):
+        scopes = self.trace(lambda: ec2_state_mgmt.process_regions({ 'us-east-1': MockEc2Resource(None) }, {}, NOW, 1))
+
+        self.assertTrue(scopes['us-east-1'].fault)
+
+    def test_off(self):
+        with unittest.mock.patch.object(tracing, 'recorder', None):
+            with tracing.subsegment('test', count=1) as trace:
+                trace.put_annotation('failed', 0)
+
+            func = lambda: None
+            self.assertIs(tracing.wrap(func), func)
+
+class ConfigureTestCase(unittest.TestCase):
+    def tearDown(self):
+        tracing.recorder = None
+
+    def test_get_xray_mode(self):
+        for value, mode in [(None, 'off'), ('false', 'off'), ('true', 'full'), ('FULL', 'full'), ('coarse', 'coarse')]:
+            with self.subTest(value=value):
+                self.assertEqual(tracing.get_xray_mode(value), mode)
+
+        with self.assertRaises(ValueError):
+            tracing.get_xray_mode('verbose')
+
+    def test_patching(self):
+        for mode, patched in [('full', True), ('coarse', False), ('off', False)]:
+            with self.subTest(mode=mode), unittest.mock.patch('aws_xray_sdk.core.patch_all') as patch_all, \
+                unittest.mock.patch('aws_xray_sdk.core.xray_recorder'):
+                tracing.configure(mode)
+
+                self.assertEqual(patch_all.called, patched)
+                self.assertEqual(tracing.recorder is not None, mode != 'off')
+
+
+if __name__ == '__main__':
+    unittest.main()